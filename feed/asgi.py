@@ -2,6 +2,7 @@
 ASGI config for feed project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+The usage info list requests are served asynchronously (see usage_info/asgi.py).
 
 For more information on this file, see
 https://docs.djangoproject.com/en/3.0/howto/deployment/asgi/
@@ -13,4 +14,8 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'feed.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+from usage_info.asgi import AsyncUsageInfoApp  # noqa: E402 (requires the configured Django)
+
+application = AsyncUsageInfoApp(django_application)
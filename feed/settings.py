@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/3.0/ref/settings/
 """
 
 import os
+import tempfile
 
 import environ
 import django_heroku
@@ -48,10 +49,12 @@ INSTALLED_APPS = [
     'django.contrib.messages',
     'django.contrib.staticfiles',
     'rest_framework',
-    'usage_info',
+    'usage_info.apps.UsageInfoConfig',
 ]
 
 MIDDLEWARE = [
+    # Server-Timing header, slow request log and metrics of the usage info requests (see usage_info/instrumentation.py)
+    'usage_info.instrumentation.InstrumentationMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -89,6 +92,33 @@ DATABASES = {
     'default': env.db(),
 }
 
+# Read replicas of the default database (comma separated database URLs), the usage info API reads are balanced
+# between the healthy ones (see usage_info/replicas.py), e.g. postgres://feed@replica-1/feed?connect_timeout=2
+USAGE_INFO_REPLICAS = []
+for number, url in enumerate(env.list('USAGE_INFO_REPLICA_URLS', default=[]), 1):
+    DATABASES[f'replica_{number}'] = {**env.db_url_config(url), 'TEST': {'MIRROR': 'default'}}
+    USAGE_INFO_REPLICAS.append(f'replica_{number}')
+
+DATABASE_ROUTERS = ['usage_info.replicas.ReplicaRouter']
+
+
+# Cache
+# https://docs.djangoproject.com/en/3.0/topics/cache/
+# The usage_info cache keeps UsageInfoView responses (LRU with MAX_ENTRIES, expiring after TIMEOUT seconds).
+# Any backend URL supported by django-environ works, e.g. rediscache://127.0.0.1:6379/1 or dummycache://
+# It has to be shared by the worker processes to coalesce their identical queries (see usage_info/coalescing.py):
+# the default file cache is, locmemcache:// is per process.
+
+CACHES = {
+    'default': env.cache('CACHE_URL', default='locmemcache://'),
+    'usage_info': env.cache(
+        'USAGE_INFO_CACHE_URL',
+        default=f'filecache://{os.path.join(tempfile.gettempdir(), "usage_info_cache")}?timeout=3600&max_entries=1000'),
+}
+# the file cache with add() atomic across the processes (see usage_info/filecache.py)
+if CACHES['usage_info']['BACKEND'] == 'django.core.cache.backends.filebased.FileBasedCache':
+    CACHES['usage_info']['BACKEND'] = 'usage_info.filecache.FileCache'
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.0/ref/settings/#auth-password-validators
@@ -136,4 +166,35 @@ REST_FRAMEWORK = {
     'PAGE_SIZE': 100,
 }
 
+# Answer group_by requests from the smallest pre-aggregated rollup table able to (see usage_info/rollups.py)
+USAGE_INFO_ROLLUPS = env.bool('USAGE_INFO_ROLLUPS', default=True)
+
+# number of the query plans (querysets built for the normalized query params) kept in memory, and of their SQL
+# compiled for the ASGI server; read once at startup
+USAGE_INFO_PLAN_CACHE_SIZE = env.int('USAGE_INFO_PLAN_CACHE_SIZE', default=256)
+
+# 'orm' (SQL) or 'columnar': answer the queries from an in-memory NumPy snapshot (see usage_info/columnar.py)
+USAGE_INFO_ENGINE = env.str('USAGE_INFO_ENGINE', default='orm')
+
+# max number of the asyncpg connections of an ASGI worker (see usage_info/asgi.py)
+USAGE_INFO_ASYNC_POOL_SIZE = env.int('USAGE_INFO_ASYNC_POOL_SIZE', default=10)
+
+# number of the threads running the queries of a batch request concurrently (see UsageInfoBatchView)
+USAGE_INFO_BATCH_WORKERS = env.int('USAGE_INFO_BATCH_WORKERS', default=4)
+
+# usage info requests taking longer (milliseconds) are logged with their spec and SQL (usage_info.slow logger)
+USAGE_INFO_SLOW_REQUEST_MS = env.float('USAGE_INFO_SLOW_REQUEST_MS', default=1000)
+
+# identical concurrent usage info requests share one query (see usage_info/coalescing.py)
+USAGE_INFO_COALESCE = env.bool('USAGE_INFO_COALESCE', default=True)
+
+# max seconds a worker waits for the identical query of another worker before running it itself
+USAGE_INFO_COALESCE_TIMEOUT = env.float('USAGE_INFO_COALESCE_TIMEOUT', default=30)
+
+# replicas lagging behind the default database more than this (seconds) are not read from
+USAGE_INFO_REPLICA_MAX_LAG = env.float('USAGE_INFO_REPLICA_MAX_LAG', default=10)
+
+# how often the health and the lag of a replica are checked, seconds
+USAGE_INFO_REPLICA_CHECK_INTERVAL = env.float('USAGE_INFO_REPLICA_CHECK_INTERVAL', default=5)
+
 django_heroku.settings(locals())
@@ -16,8 +16,13 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path, include
 
+from usage_info.views import UsageInfoExportView, UsageInfoBatchView, UsageInfoMetricsView
+
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('usage_info', include('usage_info.urls')),
+    path('usage_info/export', UsageInfoExportView.as_view(), name='usage-info-export'),
+    path('usage_info/batch', UsageInfoBatchView.as_view(), name='usage-info-batch'),
+    path('usage_info/metrics', UsageInfoMetricsView.as_view(), name='usage-info-metrics'),
 ]
@@ -1,4 +1,5 @@
 from django.contrib import admin
-from .models import UsageInfo
+from .models import UsageInfo, Channel, Country, OperatingSystem
 
 admin.site.register(UsageInfo)
+admin.site.register((Channel, Country, OperatingSystem))
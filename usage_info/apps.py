@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class UsageInfoConfig(AppConfig):
     name = 'usage_info'
+
+    def ready(self):
+        from . import rollups, cache, coalescing  # noqa: F401 (connects the signal receivers, registers the checks)
@@ -0,0 +1,344 @@
+"""
+Async (ASGI) serving path of the usage info endpoint: the queries of UsageInfoView run on a pool
+of asyncpg connections, so a worker keeps serving other requests while an aggregate is running.
+
+The request goes through the same steps as UsageInfoView.list: query spec, response cache, query plan,
+pagination and serializer, only the SQL of the plan is sent with asyncpg instead of the Django connection.
+Like the view, the request reads from the database chosen by replicas.py (a pool per database), the identical
+concurrent queries are coalesced (see Coalescer.run_async) and the phases are instrumented (see instrumentation.py).
+The SQL of a query plan is compiled in a thread, once per plan and database (see compile_plan_sql),
+the event loop only sends it.
+Everything the async path doesn't cover (other urls, the keyset pagination, totals, top rows, the browsable API,
+the columnar engine, databases other than PostgreSQL or asyncpg not installed) goes to the Django ASGI app.
+"""
+import re
+import time
+import asyncio
+import functools
+import typing as typ
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import DisallowedHost, EmptyResultSet
+from django.core.handlers.asgi import ASGIRequest
+from django.core.signals import setting_changed
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connection, connections, close_old_connections
+from django.db.models import query
+from django.dispatch import receiver
+from django.http import Http404, HttpRequest
+from rest_framework.exceptions import NotAcceptable
+from rest_framework.negotiation import DefaultContentNegotiation
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+from rest_framework.settings import api_settings
+
+from . import cache, coalescing, columnar, instrumentation, replicas
+from .dimensions import cache as dimension_cache
+from .models import UsageInfoVersion
+from .pagination import UsageInfoPagination
+from .query import QuerySpec, QueryPlan, compile_values_list, parse_query_params, get_plan
+from .validator import ValidationError
+
+try:
+    import asyncpg
+except ImportError:  # pragma: no cover
+    asyncpg = None
+
+PLACEHOLDER_RE = re.compile(r'%([s%])')
+
+
+def to_asyncpg_sql(sql: str) -> str:
+    """Replace the psycopg2 placeholders (%s) of the SQL compiled by Django with the asyncpg ones ($1, $2, ...)"""
+    counter = iter(range(1, len(sql) + 1))
+    return PLACEHOLDER_RE.sub(lambda match: f'${next(counter)}' if match.group(1) == 's' else '%', sql)
+
+
+class CompiledQuery(typ.NamedTuple):
+    """values_list() queryset compiled to SQL for asyncpg"""
+    sql: typ.Optional[str]  # None if the queryset has no rows (e.g. filtered by unknown names only)
+    params: tuple
+    convert: typ.Callable[[list], list]  # converts the fetched rows to the values_list() tuples
+
+    def page(self, offset: int, limit: int) -> typ.Tuple[str, tuple]:
+        """Get the SQL and params of a page of the rows"""
+        return f'{self.sql} LIMIT ${len(self.params) + 1} OFFSET ${len(self.params) + 2}', (*self.params, limit, offset)
+
+
+def compile_queryset(queryset: query.QuerySet, alias: str) -> CompiledQuery:
+    """
+    Compile the values_list() queryset to SQL for asyncpg
+
+    :param queryset: values_list() queryset
+    :param alias: database the SQL is sent to
+    :return: compiled query
+    """
+    try:
+        sql, params, _, convert = compile_values_list(queryset, connections[alias])
+    except EmptyResultSet:
+        return CompiledQuery(None, (), list)
+    return CompiledQuery(to_asyncpg_sql(sql), tuple(params), convert)
+
+
+class CompiledPlan(typ.NamedTuple):
+    rows: CompiledQuery
+    count: CompiledQuery  # the rows query without the ordering, for the pagination COUNT
+
+
+@functools.lru_cache(maxsize=getattr(settings, 'USAGE_INFO_PLAN_CACHE_SIZE', 256))
+def compile_plan_sql(plan: QueryPlan, alias: str) -> CompiledPlan:
+    """Compile (once per query plan of query.compile_plan and database) the SQL of the plan for asyncpg"""
+    return CompiledPlan(
+        compile_queryset(plan.values_list, alias), compile_queryset(plan.values_list.order_by(), alias))
+
+
+@receiver(setting_changed)
+def on_setting_changed(setting: str, **kwargs) -> None:
+    # the SQL of the plans dropped by query.on_setting_changed
+    if setting.startswith('USAGE_INFO_'):
+        compile_plan_sql.cache_clear()
+
+
+def compile_version_sql(alias: str) -> CompiledQuery:
+    """Compile the query of cache.current_version() for asyncpg"""
+    return compile_queryset(
+        UsageInfoVersion.objects.using(alias).values_list('generation', 'updated_at').order_by('pk')[:1], alias)
+
+
+class AsyncUsageInfoApp:
+    """
+    ASGI app answering GET /usage_info (offset pagination, JSON) asynchronously,
+    the other requests are passed to the Django ASGI app
+    """
+    path = '/usage_info'
+    endpoint = 'usage-info'  # url name of the path, for the instrumentation
+    paginator_class = UsageInfoPagination
+
+    def __init__(self, django_app: typ.Callable):
+        self.django_app = django_app
+        self._pools: typ.Dict[str, 'asyncpg.Pool'] = {}
+        self._version_queries: typ.Dict[str, CompiledQuery] = {}
+        self._pools_loop = None
+        self._pools_lock = None
+
+    async def __call__(self, scope: dict, receive: typ.Callable, send: typ.Callable) -> None:
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http' and scope['path'] == self.path and scope['method'] == 'GET' \
+                and asyncpg is not None and connection.vendor == 'postgresql' and not columnar.is_enabled():
+            await self.handle(scope, receive, send)
+        else:
+            await self.django_app(scope, receive, send)
+
+    async def lifespan(self, receive: typ.Callable, send: typ.Callable) -> None:
+        """The pools are created by the first requests and closed on shutdown"""
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def get_pool(self, alias: str) -> 'asyncpg.Pool':
+        """Get the connection pool of the database for the running event loop (created once per loop)"""
+        loop = asyncio.get_running_loop()
+        if self._pools_loop is not loop:
+            self._pools, self._pools_loop, self._pools_lock = {}, loop, asyncio.Lock()
+        async with self._pools_lock:
+            if alias not in self._pools:
+                db = connections[alias].settings_dict
+                self._version_queries[alias] = await sync_to_async(compile_version_sql)(alias)
+                self._pools[alias] = await asyncpg.create_pool(
+                    database=db['NAME'], user=db['USER'] or None, password=db['PASSWORD'] or None,
+                    host=db['HOST'] or None, port=db['PORT'] or None,
+                    min_size=1, max_size=settings.USAGE_INFO_ASYNC_POOL_SIZE)
+        return self._pools[alias]
+
+    async def close(self) -> None:
+        pools, self._pools = self._pools, {}
+        for pool in pools.values():
+            await pool.close()
+
+    async def execute(self, alias: str, sql: str, params: tuple, method: str = 'fetch') -> typ.Any:
+        """
+        Run the SQL on the pool of the database, time it for the request metrics
+
+        :param alias: database
+        :param sql: SQL with the asyncpg placeholders
+        :param params: params of the SQL
+        :param method: asyncpg.Pool method: 'fetch' (rows) or 'fetchval'
+        :return: result of the method
+        :raise: the asyncpg errors (a failed replica is skipped until its next check, like in replicas.reads())
+        """
+        try:
+            pool = await self.get_pool(alias)
+            started = time.perf_counter()
+            try:
+                return await getattr(pool, method)(sql, *params)
+            finally:
+                metrics = instrumentation.current()
+                if metrics is not None:
+                    metrics.record_query(sql, params, time.perf_counter() - started)
+        except (asyncpg.PostgresError, asyncpg.InterfaceError, OSError) as err:
+            if alias != DEFAULT_DB_ALIAS:
+                replicas.monitor.mark_failed(alias, err)
+            raise
+
+    async def fetch(self, alias: str, compiled: CompiledQuery, page: typ.Tuple[int, int] = None) -> list:
+        """Fetch the rows of the compiled query (the page of them: offset, limit)"""
+        if compiled.sql is None:
+            return []
+        sql, params = (compiled.sql, compiled.params) if page is None else compiled.page(*page)
+        return compiled.convert(await self.execute(alias, sql, params))
+
+    async def count(self, alias: str, compiled: CompiledQuery) -> int:
+        if compiled.sql is None:
+            return 0
+        return await self.execute(alias, f'SELECT COUNT(*) FROM ({compiled.sql}) subquery', compiled.params, 'fetchval')
+
+    async def current_version(self, alias: str) -> typ.Tuple[int, float]:
+        """Async cache.current_version()"""
+        await self.get_pool(alias)
+        rows = await self.fetch(alias, self._version_queries[alias])
+        return (rows[0][0], rows[0][1].timestamp()) if rows else (0, 0.0)
+
+    @staticmethod
+    async def run_sync(func: typ.Callable, *args) -> typ.Any:
+        """Run the function in a thread (sync_to_async), the Django queries are timed for the request metrics"""
+        metrics = instrumentation.current()
+
+        def run():
+            with instrumentation.track_queries(metrics):
+                return func(*args)
+        return await sync_to_async(run)()
+
+    async def handle(self, scope: dict, receive: typ.Callable, send: typ.Callable) -> None:
+        django_request = ASGIRequest(scope, None)
+        request = Request(django_request)
+        renderers = [renderer() for renderer in api_settings.DEFAULT_RENDERER_CLASSES]
+        try:
+            renderer, _ = DefaultContentNegotiation().select_renderer(request, renderers)
+        except (NotAcceptable, Http404):
+            renderer = None  # Django responds with the error
+        paginator = self.paginator_class()
+        if not isinstance(renderer, JSONRenderer) or \
+                request.query_params.get(paginator.mode_query_param) == 'cursor':
+            await self.django_app(scope, receive, send)
+            return
+
+        metrics = instrumentation.RequestMetrics()
+        with instrumentation.activate(metrics):
+            try:
+                with metrics.phase('validate'):
+                    spec = parse_query_params(request.query_params)
+            except ValidationError as err:
+                await self.respond(send, django_request, 400, {'detail': str(err)})
+                return
+            if spec.has_totals or spec.top:
+                await self.django_app(scope, receive, send)
+                return
+            metrics.spec = spec._asdict()
+
+            try:
+                # the queries of the request go to the database of UsageInfoView (replicas.reads())
+                alias = await self.run_sync(replicas.choose)
+                with replicas.using(alias):
+                    try:
+                        status, data, headers = await self.get_response(request, spec, alias, paginator)
+                    except DatabaseError as err:
+                        if alias != DEFAULT_DB_ALIAS:
+                            replicas.monitor.mark_failed(alias, err)
+                        raise
+            finally:
+                # release the Django connections of the thread like the request_finished signal does
+                await sync_to_async(close_old_connections)()
+            await self.respond(send, django_request, status, data, headers)
+
+    async def get_response(self, request: Request, spec: QuerySpec, alias: str,
+                           paginator: UsageInfoPagination) -> typ.Tuple[int, typ.Any, typ.Dict[str, str]]:
+        """
+        UsageInfoView.list with the async queries
+
+        :return: status, data and headers of the response
+        """
+        metrics = instrumentation.current()
+        with metrics.phase('cache'):
+            version = await self.current_version(alias)
+            try:
+                key = cache.response_key(request, spec, version)
+            except DisallowedHost as err:
+                return 400, {'detail': str(err)}, {}
+            headers = cache.validator_headers(key, version, JSONRenderer.format)
+            not_modified = cache.conditional_response(request, headers)
+            if not_modified is not None:
+                return not_modified.status_code, None, headers
+            data = await self.run_sync(cache.get_response, key)
+        if data is not None:
+            return 200, data, {'X-Cache': 'HIT', **headers}
+
+        async def run_query():
+            with metrics.phase('plan'):
+                plan, compiled = await self.run_sync(self.get_plan, spec, version, alias)
+            rows = await self.paginate(request, paginator, alias, compiled)
+            with metrics.phase('serialize'):
+                data = await self.run_sync(self.serialize, plan, rows)
+            metrics.rows = len(rows)
+            if paginator.limit is not None:
+                data = paginator.get_paginated_response(data).data
+            with metrics.phase('cache'):
+                await self.run_sync(cache.set_response, key, data)
+            return data
+
+        # the identical concurrent requests share the query (see coalescing.py)
+        data, source = await coalescing.coalescer.run_async(key, run_query)
+        headers = {'X-Cache': 'MISS', **headers}
+        if source != coalescing.LEADER:
+            headers['X-Coalesced'] = source
+        return 200, data, headers
+
+    async def paginate(self, request: Request, paginator: UsageInfoPagination, alias: str,
+                       compiled: CompiledPlan) -> list:
+        """UsageInfoPagination.paginate_queryset with the async count and fetch"""
+        paginator.request = request
+        paginator.limit = paginator.get_limit(request)
+        if paginator.limit is None:
+            return await self.fetch(alias, compiled.rows)
+        paginator.offset = paginator.get_offset(request)
+        paginator.count = await self.count(alias, compiled.count)
+        if paginator.count == 0 or paginator.offset > paginator.count:
+            return []
+        return await self.fetch(alias, compiled.rows, (paginator.offset, paginator.limit))
+
+    @staticmethod
+    def get_plan(spec: QuerySpec, version: typ.Tuple[int, float], alias: str) -> typ.Tuple[QueryPlan, CompiledPlan]:
+        """UsageInfoView.get_plan and its SQL, the dimension maps are loaded lazily with the Django connection"""
+        dimension_cache.refresh(version)
+        plan = get_plan(spec)
+        return plan, compile_plan_sql(plan, alias)
+
+    @staticmethod
+    def serialize(plan: QueryPlan, rows: list) -> typ.List[dict]:
+        """Serialize the rows (the names of new dimension ids are loaded with the Django connection)"""
+        return plan.serializer.serialize(rows)
+
+    async def respond(self, send: typ.Callable, request: HttpRequest, status: int, data: typ.Any,
+                      headers: typ.Dict[str, str] = None) -> None:
+        renderer = JSONRenderer()
+        metrics = instrumentation.current()
+        with metrics.phase('render'):
+            body = renderer.render(data)
+        headers = {
+            'Content-Type': renderer.media_type,
+            'Content-Length': str(len(body)),
+            'Vary': 'Accept',
+            'Allow': 'GET, HEAD, OPTIONS',
+            **(headers or {}),
+            'Server-Timing': instrumentation.finish(request, status, self.endpoint, metrics),
+        }
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers.items()],
+        })
+        await send({'type': 'http.response.body', 'body': body})
@@ -0,0 +1,126 @@
+import hashlib
+import threading
+import typing as typ
+from urllib.parse import urlencode
+
+from django.core.cache import caches
+from django.db.models import F
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.http import HttpRequest, HttpResponse
+from django.utils import timezone
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, parse_http_date_safe
+
+from .models import UsageInfo, UsageInfoVersion
+from .query import QuerySpec
+from .signals import usage_info_loaded
+
+
+# Django cache alias of the responses (see CACHES in settings): locmem, file, redis, ...
+CACHE_ALIAS = 'usage_info'
+
+# parameters changing the response besides the query spec
+PAGE_PARAMS = ('limit', 'offset', 'pagination', 'cursor')
+
+
+class CacheStats:
+    """Thread safe hit/miss counters of the response cache (per process)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def record(self, hit: bool) -> None:
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses}
+
+
+stats = CacheStats()
+
+
+def current_version() -> typ.Tuple[int, float]:
+    """Return the data generation and its update timestamp"""
+    version = UsageInfoVersion.objects.values_list('generation', 'updated_at').first()
+    return (version[0], version[1].timestamp()) if version else (0, 0.0)
+
+
+def bump_version() -> None:
+    """Mark the UsageInfo data as changed, so all the cached responses get stale"""
+    if not UsageInfoVersion.objects.update(generation=F('generation') + 1, updated_at=timezone.now()):
+        UsageInfoVersion.objects.create(generation=1)
+
+
+def response_key(request: HttpRequest, spec: QuerySpec, version: typ.Tuple[int, float], columns: bool = False) -> str:
+    """
+    Build the response cache key for the (normalized) request and the data version (see current_version),
+    the data serialized column-wise (for Arrow, Parquet) has its own key
+    """
+    generation, updated_at = version
+    page = urlencode([(param, request.GET[param]) for param in PAGE_PARAMS if param in request.GET])
+    url = f'{request.get_host()}{request.path}?{page}#{spec!r}{"#columns" if columns else ""}'
+    return f'usage_info:{generation}:{updated_at}:{hashlib.sha1(url.encode()).hexdigest()}'
+
+
+def validator_headers(key: str, version: typ.Tuple[int, float], response_format: str) -> typ.Dict[str, str]:
+    """
+    Build the conditional GET headers of the response: the ETag of the response cache key
+    (data version and normalized request) and the format, Last-Modified of the data version.
+    The clients have to revalidate the response (no-cache), the data may change any time.
+
+    :param key: response cache key (see response_key)
+    :param version: data version (see current_version)
+    :param response_format: format of the renderer (json, api, ...)
+    :return: ETag, Last-Modified and Cache-Control headers
+    """
+    headers = {
+        'ETag': f'W/"{hashlib.sha1(f"{key}:{response_format}".encode()).hexdigest()}"',
+        'Cache-Control': 'no-cache',
+    }
+    _, updated_at = version
+    if updated_at:
+        headers['Last-Modified'] = http_date(updated_at)
+    return headers
+
+
+def conditional_response(request: HttpRequest, headers: typ.Dict[str, str]) -> typ.Optional[HttpResponse]:
+    """
+    Check the If-None-Match/If-Modified-Since headers of the request against the validator headers
+
+    :return: 304 Not Modified response with the validator headers or None if the response has to be sent
+    """
+    last_modified = headers.get('Last-Modified')
+    response = get_conditional_response(
+        request, etag=headers['ETag'], last_modified=parse_http_date_safe(last_modified) if last_modified else None)
+    if response is not None:
+        for header, value in headers.items():
+            response[header] = value
+    return response
+
+
+def get_response(key: str) -> typ.Any:
+    """Get cached response data (None if there is no such key)"""
+    data = caches[CACHE_ALIAS].get(key)
+    stats.record(hit=data is not None)
+    return data
+
+
+def set_response(key: str, data: typ.Any) -> None:
+    caches[CACHE_ALIAS].set(key, data)
+
+
+@receiver(usage_info_loaded)
+@receiver(post_save, sender=UsageInfo)
+@receiver(post_delete, sender=UsageInfo)
+def on_usage_info_changed(sender, deferred: bool = False, **kwargs) -> None:
+    # the parallel ingestion bumps the version once, after all its chunks (see pipeline.apply_pending)
+    if not deferred:
+        bump_version()
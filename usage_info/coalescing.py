@@ -0,0 +1,224 @@
+"""
+Coalescing (single flight) of identical concurrent usage info queries.
+
+The concurrent requests of a process with the same response cache key (the normalized query spec, page params
+and data version, see cache.response_key) share one query: the first one runs it, the others wait for its result.
+Across the worker processes the response cache backend is the lock and the store: the worker running a query
+holds a lock key (cache.add is atomic on the shared backends: the default file cache of filecache.py, redis,
+memcached, database), the other workers poll the response cache for the result until the lock is released
+or USAGE_INFO_COALESCE_TIMEOUT passes, then run the query themselves. With a per-process backend (locmem)
+only the requests of a process are coalesced, the system check warns about it.
+
+The async (ASGI) path coalesces its queries with run_async(): the same protocol on asyncio futures and sleeps.
+"""
+import os
+import time
+import asyncio
+import threading
+import typing as typ
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core import checks
+from django.core.cache import caches
+
+from .cache import CACHE_ALIAS
+
+# how often a worker checks whether the query of another worker is done, seconds
+POLL_INTERVAL = 0.05
+
+# backends without an add() atomic across the worker processes
+NOT_SHARED_BACKENDS = (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+    'django.core.cache.backends.filebased.FileBasedCache',
+)
+
+# how the result of a query was obtained
+LEADER = 'leader'  # ran the query
+PROCESS = 'process'  # waited for a request of the same process
+WORKER = 'worker'  # waited for another worker process
+
+
+class CoalescingStats:
+    """Thread safe counters of the queries run and the requests coalesced (per process)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = dict.fromkeys((LEADER, PROCESS, WORKER), 0)
+
+    def record(self, source: str) -> None:
+        with self._lock:
+            self.counts[source] += 1
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            return {
+                'queries': self.counts[LEADER],
+                'coalesced': self.counts[PROCESS] + self.counts[WORKER],
+                'coalesced_in_process': self.counts[PROCESS],
+                'coalesced_across_workers': self.counts[WORKER],
+            }
+
+
+stats = CoalescingStats()
+
+
+class _Call:
+    """Query in flight"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: typ.Any = None
+        self.error: typ.Optional[BaseException] = None
+
+
+class Coalescer:
+    """Run a query once for the concurrent calls with the same key"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: typ.Dict[str, _Call] = {}
+        self._futures: typ.Dict[typ.Tuple[asyncio.AbstractEventLoop, str], asyncio.Future] = {}
+
+    def run(self, key: str, query: typ.Callable[[], typ.Any]) -> typ.Tuple[typ.Any, str]:
+        """
+        Get the result of the query, run by this call or by a concurrent one with the same key
+
+        :param key: response cache key of the query (the query stores its result under it)
+        :param query: function running the query and storing the result in the response cache
+        :return: result and how it was obtained (LEADER, PROCESS or WORKER)
+        :raise: the exception of the query (raised by all the coalesced calls)
+        """
+        if not getattr(settings, 'USAGE_INFO_COALESCE', True):
+            result = query()
+            stats.record(LEADER)
+            return result, LEADER
+
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            call.done.wait()
+            stats.record(PROCESS)
+            if call.error is not None:
+                raise call.error
+            result, _ = call.result
+            return result, PROCESS
+
+        try:
+            call.result = self._run_once(key, query)
+        except BaseException as err:
+            call.error = err
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        stats.record(call.result[1])
+        return call.result
+
+    @staticmethod
+    def _run_once(key: str, query: typ.Callable[[], typ.Any]) -> typ.Tuple[typ.Any, str]:
+        """Run the query unless another worker is running it (then wait for its result)"""
+        store = caches[CACHE_ALIAS]
+        timeout = getattr(settings, 'USAGE_INFO_COALESCE_TIMEOUT', 30)
+        lock_key, token = f'{key}:lock', f'{os.getpid()}:{threading.get_ident()}'
+        locked = store.add(lock_key, token, timeout=timeout)
+        if not locked:
+            deadline = time.monotonic() + timeout
+            while time.monotonic() < deadline:
+                time.sleep(POLL_INTERVAL)
+                result = store.get(key)
+                if result is not None:
+                    return result, WORKER
+                if store.get(lock_key) is None:
+                    # the other worker failed (or its result is already evicted)
+                    locked = store.add(lock_key, token, timeout=timeout)
+                    break
+        try:
+            return query(), LEADER
+        finally:
+            if locked and store.get(lock_key) == token:
+                store.delete(lock_key)
+
+    async def run_async(self, key: str, query: typ.Callable[[], typ.Awaitable]) -> typ.Tuple[typ.Any, str]:
+        """
+        run() for the event loop: the concurrent calls of the loop with the same key wait for the first one
+
+        :param key: response cache key of the query (the query stores its result under it)
+        :param query: coroutine function running the query and storing the result in the response cache
+        :return: result and how it was obtained (LEADER, PROCESS or WORKER)
+        :raise: the exception of the query (raised by all the coalesced calls)
+        """
+        if not getattr(settings, 'USAGE_INFO_COALESCE', True):
+            result = await query()
+            stats.record(LEADER)
+            return result, LEADER
+
+        call_key = asyncio.get_running_loop(), key
+        future = self._futures.get(call_key)
+        if future is not None:
+            # a cancelled waiter doesn't cancel the query
+            result, _ = await asyncio.shield(future)
+            stats.record(PROCESS)
+            return result, PROCESS
+
+        future = self._futures[call_key] = asyncio.get_running_loop().create_future()
+        try:
+            result = await self._run_once_async(key, query)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as err:
+            future.set_exception(err)
+            future.exception()  # retrieved: raised by the waiters, if any
+            raise
+        else:
+            future.set_result(result)
+        finally:
+            del self._futures[call_key]
+        stats.record(result[1])
+        return result
+
+    @staticmethod
+    async def _run_once_async(key: str, query: typ.Callable[[], typ.Awaitable]) -> typ.Tuple[typ.Any, str]:
+        """_run_once() for the event loop, the cache is used in the threads of sync_to_async"""
+        store = caches[CACHE_ALIAS]
+        timeout = getattr(settings, 'USAGE_INFO_COALESCE_TIMEOUT', 30)
+        lock_key, token = f'{key}:lock', f'{os.getpid()}:{threading.get_ident()}'
+        locked = await sync_to_async(store.add)(lock_key, token, timeout=timeout)
+        if not locked:
+            deadline = time.monotonic() + timeout
+            while time.monotonic() < deadline:
+                await asyncio.sleep(POLL_INTERVAL)
+                result = await sync_to_async(store.get)(key)
+                if result is not None:
+                    return result, WORKER
+                if await sync_to_async(store.get)(lock_key) is None:
+                    locked = await sync_to_async(store.add)(lock_key, token, timeout=timeout)
+                    break
+        try:
+            return await query(), LEADER
+        finally:
+            if locked and await sync_to_async(store.get)(lock_key) == token:
+                await sync_to_async(store.delete)(lock_key)
+
+
+coalescer = Coalescer()
+
+
+@checks.register(checks.Tags.caches)
+def check_cache_shared(app_configs: typ.Any = None, **kwargs) -> typ.List[checks.CheckMessage]:
+    """Warn if the identical queries of the worker processes can't be coalesced"""
+    backend = settings.CACHES.get(CACHE_ALIAS, {}).get('BACKEND')
+    if getattr(settings, 'USAGE_INFO_COALESCE', True) and backend in NOT_SHARED_BACKENDS:
+        return [checks.Warning(
+            f'The {CACHE_ALIAS!r} cache ({backend}) is not shared by the worker processes (or its add() is not '
+            f'atomic), the identical queries are only coalesced within a process.',
+            hint='Use the default filecache:// USAGE_INFO_CACHE_URL or a redis, memcached or database cache.',
+            id='usage_info.W001',
+        )]
+    return []
@@ -0,0 +1,280 @@
+"""
+In-process columnar engine: the usage info rows are kept in NumPy arrays (one per column,
+the dimensions as their integer ids) and the queries are answered with vectorized filters,
+grouped sums and sorts instead of SQL. Turned on with USAGE_INFO_ENGINE = 'columnar',
+requires NumPy (optional dependency).
+
+The snapshot of the table is reloaded when the data version changes (every load, save or delete,
+see cache.current_version), so an ingest is seen by the next query of every process.
+
+The grouped sums of the integer metrics are exact (int64). The float sums are rounded once (see float_sums),
+while the database adds the floats one by one in the order it reads the rows, so a float sum of the database
+may differ from the columnar one in the last digits (relative difference of the order of 1e-16 times the number
+of the summed rows).
+"""
+import math
+import datetime
+import threading
+import typing as typ
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from .derived import DERIVED_METRICS
+from .dimensions import DIMENSION_MODELS, cache as dimension_cache
+from .models import UsageInfo
+from .query import (
+    BUCKET_FIELDS, FILTER_FIELDS, DIMENSION_FILTERS, DimensionIds, QuerySpec, grouped_fields, get_ordering,
+)
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None
+
+INTEGER_METRICS = ('impressions', 'clicks', 'installs')
+FLOAT_METRICS = ('spend', 'revenue')
+METRICS = (*INTEGER_METRICS, *FLOAT_METRICS)
+
+
+def is_enabled() -> bool:
+    return getattr(settings, 'USAGE_INFO_ENGINE', 'orm') == 'columnar'
+
+
+class Snapshot(typ.NamedTuple):
+    """Usage info columns ordered by id"""
+    version: typ.Hashable
+    columns: typ.Dict[str, 'np.ndarray']  # id, date (ordinal), dimension ids, metrics
+    name_ranks: typ.Dict[str, 'np.ndarray']  # dimension -> rank of the name (in the database collation) by id
+
+    def __len__(self) -> int:
+        return len(self.columns['id'])
+
+
+def load_snapshot(version: typ.Hashable) -> Snapshot:
+    """Read the whole usage info table to the column arrays"""
+    if np is None:
+        raise ImproperlyConfigured('The columnar engine (USAGE_INFO_ENGINE) requires NumPy')
+
+    fields = ('id', 'date', *DIMENSION_MODELS, *METRICS)
+    rows = list(UsageInfo.objects.order_by('id').values_list(*fields))
+    values = list(zip(*rows)) if rows else [()] * len(fields)
+    size = len(rows)
+
+    columns = {
+        'id': np.fromiter(values[0], dtype=np.int64, count=size),
+        'date': np.fromiter((date.toordinal() for date in values[1]), dtype=np.int32, count=size),
+    }
+    for field, column in zip(fields[2:], values[2:]):
+        dtype = np.int32 if field in DIMENSION_MODELS else np.int64 if field in INTEGER_METRICS else np.float64
+        columns[field] = np.fromiter(column, dtype=dtype, count=size)
+
+    name_ranks = {}
+    for field, model in DIMENSION_MODELS.items():
+        ids = list(model.objects.order_by('name').values_list('id', flat=True))
+        ranks = np.zeros(max(ids, default=0) + 1, dtype=np.int32)
+        ranks[ids] = np.arange(len(ids), dtype=np.int32)
+        name_ranks[field] = ranks
+    return Snapshot(version, columns, name_ranks)
+
+
+_lock = threading.Lock()
+_snapshot: typ.Optional[Snapshot] = None
+
+
+def get_snapshot(version: typ.Hashable) -> Snapshot:
+    """Get the snapshot of the data version (loaded once per version)"""
+    global _snapshot
+    snapshot = _snapshot
+    if snapshot is None or snapshot.version != version:
+        with _lock:
+            if _snapshot is None or _snapshot.version != version:
+                _snapshot = load_snapshot(version)
+            snapshot = _snapshot
+    return snapshot
+
+
+def clear() -> None:
+    global _snapshot
+    with _lock:
+        _snapshot = None
+
+
+class Result:
+    """
+    Rows of a columnar query with the layout of the values_list() rows of the query plan.
+    Like a queryset, the rows are only built for the requested slice (a page).
+    """
+
+    def __init__(self, fields: typ.Sequence[str], columns: typ.Dict[str, 'np.ndarray'], size: int):
+        self.fields = tuple(fields)
+        self.columns = columns
+        self.size = size
+
+    def count(self) -> int:
+        return self.size
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __iter__(self) -> typ.Iterator[tuple]:
+        for start in range(0, self.size, 2000):
+            yield from self[start:start + 2000]
+
+    def __getitem__(self, item: slice) -> typ.List[tuple]:
+        if not isinstance(item, slice):
+            return self[item:item + 1][0]
+        return list(zip(*(self.to_python(field, self.columns[field][item]) for field in self.fields)))
+
+    @staticmethod
+    def to_python(field: str, values: 'np.ndarray') -> list:
+        if field == 'date' or field in BUCKET_FIELDS:
+            return [datetime.date.fromordinal(value) for value in values.tolist()]
+        if field in DERIVED_METRICS:
+            return [None if value != value else value for value in values.tolist()]  # NaN -> NULL
+        if field.endswith('__name'):
+            dimension = field[:-len('__name')]
+            return [dimension_cache.get_name(dimension, value) for value in values.tolist()]
+        return values.tolist()
+
+
+def _filter_mask(snapshot: Snapshot, spec: QuerySpec, dimension_ids: DimensionIds) -> 'np.ndarray':
+    columns = snapshot.columns
+    mask = np.ones(len(snapshot), dtype=bool)
+    if spec.date_from:
+        mask &= columns['date'] >= datetime.date.fromisoformat(spec.date_from).toordinal()
+    if spec.date_to:
+        mask &= columns['date'] <= datetime.date.fromisoformat(spec.date_to).toordinal()
+    for param, ids in zip(DIMENSION_FILTERS, dimension_ids):
+        if getattr(spec, param):
+            mask &= np.isin(columns[FILTER_FIELDS[param]], np.array(ids, dtype=np.int32))
+    return mask
+
+
+def truncate_dates(ordinals: 'np.ndarray', bucket: str) -> 'np.ndarray':
+    """Truncate the dates (ordinals) to the first date of the week (Monday), month, quarter or year"""
+    if bucket == 'week':
+        # 0001-01-01 (ordinal 1) is Monday
+        return ordinals - (ordinals - 1) % 7
+    epoch = datetime.date(1970, 1, 1).toordinal()
+    months = (ordinals - epoch).astype('datetime64[D]').astype('datetime64[M]').astype(np.int64)
+    if bucket == 'quarter':
+        months -= months % 3
+    elif bucket == 'year':
+        months -= months % 12
+    return (months.astype('datetime64[M]').astype('datetime64[D]').astype(np.int64) + epoch).astype(np.int32)
+
+
+def _group_column(snapshot: Snapshot, field: str, mask: 'np.ndarray') -> 'np.ndarray':
+    if field in BUCKET_FIELDS:
+        return truncate_dates(snapshot.columns['date'][mask], BUCKET_FIELDS[field])
+    return snapshot.columns[field][mask]
+
+
+def _two_sum(a: 'np.ndarray', b: 'np.ndarray') -> typ.Tuple['np.ndarray', 'np.ndarray']:
+    """Sums and their exact rounding errors (Knuth's TwoSum)"""
+    total = a + b
+    b_part = total - a
+    return total, (a - (total - b_part)) + (b - b_part)
+
+
+def float_sums(groups: 'np.ndarray', values: 'np.ndarray', size: int) -> 'np.ndarray':
+    """
+    Sum the float values per group without accumulating the rounding errors, like math.fsum: the values are split
+    into levels of high parts which np.bincount adds exactly in any order (Rump, Ogita, Oishi "Accurate floating-point
+    summation"), the exact level sums are added in double-double arithmetic and rounded once
+
+    :param groups: group index of every value
+    :param values: float values
+    :param size: number of groups
+    :return: sum per group
+    """
+    # the sum of n high parts (multiples of the ulp of sigma, each at most sigma / 2 ** bits) is exact
+    bits = math.ceil(math.log2(len(values) + 2))
+    total, error = np.zeros(size), np.zeros(size)
+    residual = values
+    while len(residual):
+        largest = float(np.max(np.abs(residual)))
+        if largest == 0:
+            break
+        if not math.isfinite(largest):
+            # the residuals of NaN or inf never shrink, the sums are NaN or inf anyway
+            return np.bincount(groups, weights=values, minlength=size)
+        sigma = math.ldexp(1.0, bits + math.frexp(largest)[1])
+        high = (sigma + residual) - sigma
+        residual = residual - high
+        total, rounding = _two_sum(total, np.bincount(groups, weights=high, minlength=size))
+        error += rounding
+    return total + error
+
+
+def _sort_key(snapshot: Snapshot, columns: typ.Dict[str, 'np.ndarray'], field: str) -> 'np.ndarray':
+    """Sort key of the ordering field (see query.build_queryset), the same order as the database one"""
+    name = field.lstrip('-')
+    if name.endswith('__name'):
+        dimension = name[:-len('__name')]
+        key = snapshot.name_ranks[dimension][columns[dimension]]
+    else:
+        key = columns[name]
+    if key.dtype.kind in 'iu':
+        # the integer sums above 2 ** 53 are not exact as floats, they are negated as integers
+        key = key.astype(np.int64)
+    key = -key if field.startswith('-') else key
+    if name in DERIVED_METRICS:
+        # NULLs (NaN) last in both directions (see query.order_by_expression)
+        key = np.where(np.isnan(key), np.inf, key)
+    return key
+
+
+def execute(spec: QuerySpec, dimension_ids: DimensionIds, fields: typ.Sequence[str],
+            version: typ.Hashable) -> Result:
+    """
+    Answer the query with the columnar snapshot: the rows of query.build_queryset in the same order,
+    the float sums rounded once (see the module docstring)
+
+    :param spec: query spec
+    :param dimension_ids: ids of the filtered dimension values
+    :param fields: fields of the rows (the values_list() fields of the query plan)
+    :param version: data version (see cache.current_version)
+    :return: rows
+    """
+    snapshot = get_snapshot(version)
+    mask = _filter_mask(snapshot, spec, dimension_ids)
+    if not mask.any():
+        # np.unique(axis=0) of no rows fails on older NumPy
+        return Result(fields, {field: np.empty(0) for field in fields}, 0)
+
+    if spec.group_by:
+        group_fields = grouped_fields(spec)
+        keys = np.stack([_group_column(snapshot, field, mask) for field in group_fields], axis=1)
+        groups, inverse = np.unique(keys, axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        columns = {field: groups[:, i] for i, field in enumerate(group_fields)}
+        for field in INTEGER_METRICS:
+            sums = np.zeros(len(groups), dtype=np.int64)
+            np.add.at(sums, inverse, snapshot.columns[field][mask])
+            # the database sums installs as a float (see query.build_queryset)
+            columns[field] = sums.astype(np.float64) if field == 'installs' else sums
+        for field in FLOAT_METRICS:
+            columns[field] = float_sums(inverse, snapshot.columns[field][mask], len(groups))
+    else:
+        columns = {field: column[mask] for field, column in snapshot.columns.items()}
+    ordering = get_ordering(spec)
+
+    for name in spec.metrics:
+        # the same arithmetic as derived.compute, NaN (NULL) if the denominator is 0
+        metric = DERIVED_METRICS[name]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            denominator = columns[metric.denominator].astype(np.float64)
+            numerator = columns[metric.numerator].astype(np.float64) * metric.scale
+            columns[name] = np.where(denominator == 0, np.nan, numerator / denominator)
+
+    size = len(next(iter(columns.values())))
+    if ordering:
+        # np.lexsort sorts by the last key first
+        order = np.lexsort([_sort_key(snapshot, columns, field) for field in reversed(ordering)])
+        columns = {field: column[order] for field, column in columns.items()}
+    for field in fields:
+        if field.endswith('__name'):
+            columns[field] = columns[field[:-len('__name')]]
+    return Result(fields, columns, size)
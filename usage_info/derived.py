@@ -0,0 +1,67 @@
+"""
+Derived metrics: ratios of the summed metrics, requested with metrics=cpi,ctr,ipm,roas (cpi=1 is metrics=cpi).
+
+A derived metric of a group is computed from the sums of the group (not summed up from the rows) and it is NULL
+(None) if the denominator is 0: NULLIF in SQL, None in Python, NaN in the columnar engine.
+The rollups store the derived metrics of their rows with an index on every one (see rollups.apply_delta),
+so the grouped queries answered row by row by a rollup are sorted by an index scan (see query.build_queryset).
+"""
+import typing as typ
+
+from django.db.models import F, FloatField, Value, ExpressionWrapper
+from django.db.models.functions import Cast, NullIf
+
+
+class DerivedMetric(typ.NamedTuple):
+    numerator: str
+    denominator: str
+    scale: int = 1  # e.g. 1000 for the "per mille" metrics
+
+
+DERIVED_METRICS = {
+    'cpi': DerivedMetric('spend', 'installs'),  # cost per install
+    'ctr': DerivedMetric('clicks', 'impressions'),  # click-through rate
+    'ipm': DerivedMetric('installs', 'impressions', 1000),  # installs per thousand impressions
+    'roas': DerivedMetric('revenue', 'spend'),  # return on ad spend
+}
+
+
+def compute(name: str, values: typ.Mapping[str, typ.Any]) -> typ.Optional[float]:
+    """
+    Compute a derived metric in Python
+
+    :param name: derived metric
+    :param values: metric -> value (the sums of a group)
+    :return: value, None if the denominator is 0 (or unknown)
+    """
+    metric = DERIVED_METRICS[name]
+    numerator, denominator = values[metric.numerator], values[metric.denominator]
+    if not denominator or numerator is None:
+        return None
+    return float(numerator) * metric.scale / denominator
+
+
+def expression(name: str) -> ExpressionWrapper:
+    """Build the ORM expression of a derived metric of the metric fields (or of the annotated sums)"""
+    metric = DERIVED_METRICS[name]
+    # the integer metrics are not divided as integers
+    numerator = Cast(F(metric.numerator), FloatField())
+    if metric.scale != 1:
+        numerator = numerator * Value(float(metric.scale))
+    return ExpressionWrapper(
+        numerator / NullIf(F(metric.denominator), Value(0), output_field=FloatField()), output_field=FloatField())
+
+
+def sql(name: str, column: typ.Callable[[str], str]) -> str:
+    """
+    Build the SQL expression of a derived metric (the same arithmetic as compute)
+
+    :param name: derived metric
+    :param column: metric -> SQL expression of its value, e.g. SUM("spend")
+    :return: SQL expression
+    """
+    metric = DERIVED_METRICS[name]
+    numerator = f'CAST({column(metric.numerator)} AS DOUBLE PRECISION)'
+    if metric.scale != 1:
+        numerator = f'{numerator} * {metric.scale}'
+    return f'{numerator} / NULLIF({column(metric.denominator)}, 0)'
@@ -0,0 +1,137 @@
+import threading
+import typing as typ
+
+from .models import Dimension, Channel, Country, OperatingSystem
+
+
+# usage info field -> dimension table of its values
+DIMENSION_MODELS: typ.Dict[str, typ.Type[Dimension]] = {
+    'channel': Channel,
+    'country': Country,
+    'os': OperatingSystem,
+}
+
+
+class DimensionEncoder:
+    """
+    Name -> id maps used while loading the data: the dimension tables are read once
+    and the new names are inserted (in the loading transaction) the first time they are met.
+    """
+
+    def __init__(self):
+        self.ids = {field: dict(model.objects.values_list('name', 'id')) for field, model in DIMENSION_MODELS.items()}
+
+    def get_ids(self, field: str, names: typ.Iterable[str]) -> typ.Dict[str, int]:
+        """
+        Get the ids of the dimension values, creating the missing ones
+
+        :param field: dimension field (channel, country or os)
+        :param names: dimension values
+        :return: name -> id of all the names
+        """
+        ids = self.ids[field]
+        missing = set(names).difference(ids)
+        if missing:
+            model = DIMENSION_MODELS[field]
+            # another loader could have inserted some of the names meanwhile,
+            # the sorted names are locked in the same order by the concurrent loaders (no deadlocks)
+            model.objects.bulk_create((model(name=name) for name in sorted(missing)), ignore_conflicts=True)
+            ids.update(model.objects.filter(name__in=missing).values_list('name', 'id'))
+        return ids
+
+    def encode_rows(self, rows: typ.Sequence[tuple], positions: typ.Dict[str, int]) -> typ.List[tuple]:
+        """
+        Replace the dimension names of the rows by their ids
+
+        :param rows: rows with dimension names
+        :param positions: dimension field -> its position in the rows
+        :return: rows with dimension ids
+        """
+        rows = [list(row) for row in rows]
+        for field, position in positions.items():
+            ids = self.get_ids(field, {row[position] for row in rows})
+            for row in rows:
+                row[position] = ids[row[position]]
+        return [tuple(row) for row in rows]
+
+
+class DimensionCache:
+    """
+    Thread safe name <-> id maps of the dimension tables, used to translate the query filters
+    to ids and the ids of the results back to names.
+
+    The maps are loaded lazily and dropped when the data version changes (every load, save or delete),
+    so the ids of rows inserted by a rolled back transaction are never served.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = None
+        self._ids: typ.Dict[str, typ.Dict[str, int]] = {}
+        self._names: typ.Dict[str, typ.Dict[int, str]] = {}
+        self._ranks: typ.Dict[str, typ.Dict[int, int]] = {}
+
+    def refresh(self, version: typ.Hashable) -> None:
+        """Drop the maps if the data version has changed"""
+        with self._lock:
+            if version != self._version:
+                self._version = version
+                self._ids, self._names, self._ranks = {}, {}, {}
+
+    def clear(self) -> None:
+        with self._lock:
+            self._version = None
+            self._ids, self._names, self._ranks = {}, {}, {}
+
+    def _load(self, field: str) -> typ.Tuple[typ.Dict[str, int], typ.Dict[int, str]]:
+        ids = dict(DIMENSION_MODELS[field].objects.values_list('name', 'id'))
+        names = {id_: name for name, id_ in ids.items()}
+        with self._lock:
+            self._ids[field], self._names[field] = ids, names
+        return ids, names
+
+    def get_ids(self, field: str, names: typ.Iterable[str]) -> typ.Tuple[int, ...]:
+        """
+        Translate the dimension values to ids
+
+        :param field: dimension field (channel, country or os)
+        :param names: dimension values
+        :return: sorted ids of the known values (the unknown ones are skipped)
+        """
+        ids = self._ids.get(field)
+        if ids is None:
+            ids, _ = self._load(field)
+        return tuple(sorted(ids[name] for name in names if name in ids))
+
+    def get_name(self, field: str, id_: int) -> str:
+        """
+        Translate a dimension id to its value
+
+        :param field: dimension field (channel, country or os)
+        :param id_: dimension id
+        :return: dimension value
+        """
+        names = self._names.get(field)
+        if names is None or id_ not in names:
+            # a value added after the maps were loaded
+            _, names = self._load(field)
+        return names[id_]
+
+    def get_rank(self, field: str, id_: int) -> int:
+        """
+        Get the position of the dimension value in the list of the values sorted by the database (its collation)
+
+        :param field: dimension field (channel, country or os)
+        :param id_: dimension id
+        :return: rank
+        """
+        ranks = self._ranks.get(field)
+        if ranks is None or id_ not in ranks:
+            ranks = {value_id: rank for rank, value_id in enumerate(
+                DIMENSION_MODELS[field].objects.order_by('name').values_list('id', flat=True))}
+            with self._lock:
+                self._ranks[field] = ranks
+        return ranks[id_]
+
+
+cache = DimensionCache()
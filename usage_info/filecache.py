@@ -0,0 +1,44 @@
+"""
+File based cache shared by the worker processes of a host, with add() atomic across the processes.
+
+Django's FileBasedCache checks the key and writes the file in two steps, so two workers can both add the same key:
+the query coalescing (see coalescing.py) takes its cross-worker lock with add(), so here the check and the write
+hold an exclusive fcntl lock of the cache directory. The values are written to a temporary file and renamed,
+the reads don't lock.
+
+Selected by settings for the filecache:// USAGE_INFO_CACHE_URL (the default one).
+"""
+import os
+import fcntl
+import contextlib
+import typing as typ
+
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.core.cache.backends.filebased import FileBasedCache
+
+# the lock file in the cache directory (not a *.djcache file: clear() and culling keep it)
+LOCK_FILE = '.lock'
+
+
+class FileCache(FileBasedCache):
+
+    @contextlib.contextmanager
+    def _locked(self) -> typ.Iterator[None]:
+        self._createdir()
+        fd = os.open(os.path.join(self._dir, LOCK_FILE), os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            # closing the file releases the lock
+            os.close(fd)
+
+    def add(self, key: str, value: typ.Any, timeout: typ.Any = DEFAULT_TIMEOUT,
+            version: typ.Optional[int] = None) -> bool:
+        with self._locked():
+            return super().add(key, value, timeout, version)
+
+    def delete(self, key: str, version: typ.Optional[int] = None) -> typ.Any:
+        # not in the middle of an add() of the key
+        with self._locked():
+            return super().delete(key, version)
@@ -0,0 +1,184 @@
+"""
+Aggregation of the same filtered usage info rows by several sets of fields at once (one scan):
+a GROUP BY GROUPING SETS query on PostgreSQL; on the other databases the rows are grouped by all the fields
+and summed up to the coarser sets in Python.
+The grouped rows are sorted in Python the same way the database sorts the rows of UsageInfoView.
+"""
+import typing as typ
+from collections import defaultdict
+
+from django.core.exceptions import EmptyResultSet
+from django.db import connection, connections
+from django.db.models import Sum, FloatField, query
+
+from . import derived, rollups
+from .dimensions import cache as dimension_cache
+from .query import (
+    BUCKET_FIELDS, GROUPED_FIELDS, METRIC_FIELDS, DimensionIds, QuerySpec, bucket_expression, filter_queryset,
+    get_levels, get_ordering, source_field,
+)
+
+GroupingSet = typ.Tuple[str, ...]  # grouped fields, () is the grand total
+Row = typ.Dict[str, typ.Any]  # grouped field (dimensions as ids) or metric -> value
+
+
+def supports_grouping_sets() -> bool:
+    return connection.vendor == 'postgresql'
+
+
+def aggregate(spec: QuerySpec, dimension_ids: DimensionIds,
+              grouping_sets: typ.Iterable[GroupingSet]) -> typ.Dict[GroupingSet, typ.List[Row]]:
+    """
+    Sum the metrics of the rows matching the filters of the query spec by every grouping set
+
+    :param spec: query spec (only the filters are used)
+    :param dimension_ids: ids of the filtered dimension values
+    :param grouping_sets: sets of the grouped fields
+    :return: grouping set -> rows (not ordered)
+    """
+    grouping_sets = list(dict.fromkeys(tuple(grouping_set) for grouping_set in grouping_sets))
+    fields = [field for field in GROUPED_FIELDS if any(field in grouping_set for grouping_set in grouping_sets)]
+    # the smallest rollup having all the fields answers all the sets
+    model = rollups.route({*map(source_field, fields), *spec.filtered_fields})
+    buckets = {field: bucket_expression(field) for field in fields if field in BUCKET_FIELDS}
+    queryset = filter_queryset(model.objects.annotate(**buckets), spec, dimension_ids)
+    if not supports_grouping_sets():
+        rows = _aggregate_one(queryset, tuple(fields))
+        return {grouping_set: _sum_rows(rows, grouping_set) for grouping_set in grouping_sets}
+
+    results = {grouping_set: [] for grouping_set in grouping_sets}
+    compiler = queryset.query.get_compiler(using=queryset.db)
+    try:
+        where, params = compiler.compile(queryset.query.where)
+    except EmptyResultSet:
+        return results  # e.g. filtered by unknown names only
+
+    quote = connection.ops.quote_name
+    columns = {
+        # PostgreSQL only, DATE_TRUNC() of a date is a timestamp
+        field: f"CAST(DATE_TRUNC('{BUCKET_FIELDS[field]}', {quote('date')}) AS date)" if field in BUCKET_FIELDS
+        else quote(model._meta.get_field(field).column)
+        for field in fields
+    }
+    # GROUPING(a, b, ...) has a bit set for every field not in the grouping set of the row (a is the highest)
+    # the same fields in another order are the same set
+    masks = defaultdict(list)
+    for grouping_set in grouping_sets:
+        masks[sum(1 << (len(fields) - 1 - i) for i, field in enumerate(fields) if field not in grouping_set)].append(
+            grouping_set)
+    select = [
+        *columns.values(),
+        f'GROUPING({", ".join(columns.values())})' if columns else '0',
+        *(f'SUM({quote(metric)})' for metric in METRIC_FIELDS),
+    ]
+    sets = ', '.join(f'({", ".join(columns[field] for field in same_sets[0])})' for same_sets in masks.values())
+    sql = f'SELECT {", ".join(select)} FROM {quote(model._meta.db_table)}'
+    if where:
+        sql += f' WHERE {where}'
+    sql += f' GROUP BY GROUPING SETS ({sets})'
+
+    with connections[queryset.db].cursor() as cursor:
+        cursor.execute(sql, params)
+        for row in cursor.fetchall():
+            values = dict(zip(fields, row))
+            metrics = _convert_metrics(row[len(fields) + 1:])
+            for grouping_set in masks[row[len(fields)]]:
+                results[grouping_set].append({**{field: values[field] for field in grouping_set}, **metrics})
+    return results
+
+
+def _aggregate_one(queryset: query.QuerySet, grouping_set: GroupingSet) -> typ.List[Row]:
+    sums = {metric: Sum(metric, output_field=FloatField()) for metric in METRIC_FIELDS}
+    if not grouping_set:
+        total = queryset.aggregate(**sums)
+        # no rows, no total (like GROUPING SETS)
+        return [] if total['impressions'] is None else [_convert_metrics(total.values())]
+    rows = queryset.values(*grouping_set).annotate(**sums).values_list(*grouping_set, *METRIC_FIELDS)
+    return [{**dict(zip(grouping_set, row)), **_convert_metrics(row[len(grouping_set):])} for row in rows]
+
+
+def _sum_rows(rows: typ.List[Row], grouping_set: GroupingSet) -> typ.List[Row]:
+    """Sum the metrics of the rows grouped by more fields up to the grouping set"""
+    sums: typ.Dict[tuple, Row] = {}
+    for row in rows:
+        key = tuple(row[field] for field in grouping_set)
+        if key not in sums:
+            sums[key] = {field: row[field] for field in (*grouping_set, *METRIC_FIELDS)}
+        else:
+            total = sums[key]
+            for metric in METRIC_FIELDS:
+                total[metric] += row[metric]
+    return list(sums.values())
+
+
+def _convert_metrics(values: typ.Sequence) -> Row:
+    # the types of the UsageInfoView sums: installs is a float (see query.build_queryset)
+    return {
+        metric: None if value is None else int(value) if metric in ('impressions', 'clicks') else float(value)
+        for metric, value in zip(METRIC_FIELDS, values)
+    }
+
+
+def add_derived(rows: typ.Iterable[Row], metrics: typ.Sequence[str]) -> typ.List[Row]:
+    """Add the derived metrics (see derived.py, NULL if the denominator is 0) to the grouped rows"""
+    if not metrics:
+        return list(rows)
+    return [{**row, **{name: derived.compute(name, row) for name in metrics}} for row in rows]
+
+
+def _sort_key(field: str, descending: bool) -> typ.Callable[[Row], typ.Any]:
+    if field.endswith('__name'):
+        dimension = field[:-len('__name')]
+        return lambda row: dimension_cache.get_rank(dimension, row[dimension])
+    # NULLs last in both directions (see query.order_by_expression)
+    return lambda row: ((row[field] is None) != descending, 0 if row[field] is None else row[field])
+
+
+def sort_rows(rows: typ.Iterable[Row], ordering: typ.Sequence[str]) -> typ.List[Row]:
+    """
+    Sort the grouped rows like the database does
+
+    :param rows: grouped rows
+    :param ordering: ordering fields (see query.get_ordering), the dimensions are sorted by the names
+    :return: sorted rows
+    """
+    rows = list(rows)
+    # stable sorts from the last ordering field to the first one
+    for field in reversed(ordering):
+        descending = field.startswith('-')
+        rows.sort(key=_sort_key(field.lstrip('-'), descending), reverse=descending)
+    return rows
+
+
+def as_values_list(rows: typ.Iterable[Row], fields: typ.Sequence[str]) -> typ.List[tuple]:
+    """Turn the rows to the values_list() tuples of the query plan (see query.build_values_list)"""
+    getters = [
+        (lambda row, dimension=field[:-len('__name')]:
+            None if row.get(dimension) is None else dimension_cache.get_name(dimension, row[dimension]))
+        if field.endswith('__name') else (lambda row, field=field: row.get(field))
+        for field in fields
+    ]
+    return [tuple(getter(row) for getter in getters) for row in rows]
+
+
+def execute_levels(spec: QuerySpec, dimension_ids: DimensionIds, fields: typ.Sequence[str]) -> typ.List[tuple]:
+    """
+    Get the rows of every grouping level of the query (see query.get_levels) with one scan.
+    The levels follow each other (the most detailed one first), the rows of a level are sorted like the query.
+
+    :param spec: query spec
+    :param dimension_ids: ids of the filtered dimension values
+    :param fields: fields of the values_list() rows of the query plan
+    :return: values_list() tuples (the fields out of the level are None) followed by the grouping level
+    """
+    levels = get_levels(spec)
+    sets = aggregate(spec, dimension_ids, levels)
+    rows = []
+    for level in levels:
+        level_rows = add_derived(sets[level], spec.metrics)
+        if level:
+            sort_by = tuple(field for field in spec.sort_by
+                            if field.lstrip('-') in level or field.lstrip('-') not in GROUPED_FIELDS)
+            level_rows = sort_rows(level_rows, get_ordering(spec._replace(group_by=level, sort_by=sort_by)))
+        rows.extend((*row, level) for row in as_values_list(level_rows, fields))
+    return rows
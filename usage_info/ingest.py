@@ -0,0 +1,309 @@
+import io
+import csv
+import math
+import time
+import datetime
+import typing as typ
+from collections import Counter
+
+from django.db import connection, transaction
+
+from . import partitions
+from .dimensions import DIMENSION_MODELS, DimensionEncoder
+from .models import UsageInfo
+from .signals import usage_info_loaded
+from .validator import ValidationError, date_validator
+
+
+COLUMNS = (
+    'date', 'channel', 'country', 'os', 'impressions',
+    'clicks', 'installs', 'spend', 'revenue',
+)
+DIMENSIONS = COLUMNS[:4]
+METRICS = COLUMNS[4:]
+INTEGER_METRICS = ('impressions', 'clicks', 'installs')
+# a usage info row per date, channel, country and os (the unique index of migration 0008)
+NATURAL_KEY = DIMENSIONS
+STAGING_TABLE = 'usage_info_staging'
+
+DEFAULT_CHUNK_SIZE = 10000
+
+Row = typ.Tuple[typ.Any, ...]
+
+
+class LoadStats(typ.NamedTuple):
+    rows: int
+    rejected: int
+    chunks: int
+    seconds: float
+    inserted: int = 0
+    updated: int = 0
+    unchanged: int = 0
+    skipped_chunks: int = 0  # loaded by an interrupted run (see pipeline.py)
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.rows / self.seconds if self.seconds else float(self.rows)
+
+
+def parse_row(record: typ.Sequence[str]) -> Row:
+    """Validate and convert one CSV record
+
+    :param record: raw CSV record in the COLUMNS order
+    :return: converted row (date, channel, country, os, impressions, clicks, installs, spend, revenue)
+    :raise ValidationError: if the record is not valid
+    """
+    if len(record) != len(COLUMNS):
+        raise ValidationError(f'Expected {len(COLUMNS)} columns, got {len(record)}')
+
+    date, *dimensions = (value.strip() for value in record[:4])
+    date_validator(date)
+    for name, value in zip(DIMENSIONS[1:], dimensions):
+        max_length = DIMENSION_MODELS[name]._meta.get_field('name').max_length
+        if not value or len(value) > max_length:
+            raise ValidationError(f'Got not correct {name}: {value!r}')
+
+    metrics = []
+    for name, value in zip(METRICS, record[4:]):
+        try:
+            metric = int(value) if name in INTEGER_METRICS else float(value)
+        except (ValueError, TypeError):
+            raise ValidationError(f'Got not correct {name}: {value!r}')
+        if not math.isfinite(metric):
+            raise ValidationError(f'Got not correct {name}: {value!r}')
+        if metric < 0:
+            raise ValidationError(f'Got negative {name}: {value!r}')
+        metrics.append(metric)
+
+    return (date, *dimensions, *metrics)
+
+
+def check_header(header: typ.Optional[typ.Sequence[str]]) -> None:
+    """
+    :param header: the first CSV record
+    :raise ValidationError: if the columns are not the COLUMNS
+    """
+    if header is None or tuple(column.strip() for column in header) != COLUMNS:
+        raise ValidationError(f'Got not correct header: {header!r}. Expected: {",".join(COLUMNS)!r}')
+
+
+def read_rows(file: typ.TextIO, skip_invalid: bool = False,
+              rejected: typ.Optional[typ.List[int]] = None, header: bool = True) -> typ.Iterator[Row]:
+    """Stream validated rows from a CSV file with a header line
+
+    :param file: opened CSV file
+    :param skip_invalid: skip (and count) invalid rows instead of failing
+    :param rejected: list to collect line numbers of the skipped rows
+    :param header: the file starts with the header line (off for a part of a file)
+    :return: iterator over the converted rows
+    :raise ValidationError: if a row is not valid and skip_invalid is off
+    """
+    reader = csv.reader(file)
+    if header:
+        check_header(next(reader, None))
+
+    for record in reader:
+        if not record:
+            continue
+        try:
+            yield parse_row(record)
+        except ValidationError as err:
+            if not skip_invalid:
+                raise ValidationError(f'Line {reader.line_num}: {err}')
+            if rejected is not None:
+                rejected.append(reader.line_num)
+
+
+def chunked(rows: typ.Iterable[Row], chunk_size: int) -> typ.Iterator[typ.List[Row]]:
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def copy_rows(rows: typ.Sequence[Row]) -> None:
+    """Load rows with PostgreSQL COPY FROM STDIN"""
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    buffer.seek(0)
+
+    quote = connection.ops.quote_name
+    columns = ', '.join(quote(UsageInfo._meta.get_field(name).column) for name in COLUMNS)
+    with connection.cursor() as cursor:
+        cursor.copy_expert(
+            f'COPY {quote(UsageInfo._meta.db_table)} ({columns}) FROM STDIN WITH (FORMAT csv)', buffer)
+
+
+def bulk_create_rows(rows: typ.Sequence[Row]) -> None:
+    """Load rows with batched INSERTs (for databases without COPY, e.g. SQLite),
+    the batches are as big as the database allows (about 500 rows on SQLite)"""
+    attnames = [UsageInfo._meta.get_field(name).attname for name in COLUMNS]
+    UsageInfo.objects.bulk_create(UsageInfo(**dict(zip(attnames, row))) for row in rows)
+
+
+def copy_upsert_rows(rows: typ.Sequence[Row]) -> typ.Tuple[typ.List[Row], typ.List[Row]]:
+    """Upsert rows on PostgreSQL: COPY FROM STDIN to a temporary staging table, then
+    INSERT ... ON CONFLICT on the natural key, the existing rows are only updated if a metric has changed.
+    The concurrent upsert loads write one after another.
+
+    :param rows: rows with the dimension ids, one row per natural key
+    :return: written (inserted or changed) rows and the previous values of the changed rows
+    """
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    buffer.seek(0)
+
+    quote = connection.ops.quote_name
+    table = quote(UsageInfo._meta.db_table)
+    columns = [quote(UsageInfo._meta.get_field(name).column) for name in COLUMNS]
+    keys = columns[:len(NATURAL_KEY)]
+    metrics = columns[len(NATURAL_KEY):]
+    with connection.cursor() as cursor:
+        # dropped at the end of the load transaction
+        cursor.execute(
+            f'CREATE TEMPORARY TABLE IF NOT EXISTS {STAGING_TABLE} ON COMMIT DROP AS '
+            f'SELECT {", ".join(columns)} FROM {table} WITH NO DATA')
+        cursor.execute(f'TRUNCATE {STAGING_TABLE}')
+        cursor.copy_expert(f'COPY {STAGING_TABLE} ({", ".join(columns)}) FROM STDIN WITH (FORMAT csv)', buffer)
+
+        # no other transaction writes to the table until the load is committed: a key committed by another one
+        # between the SELECT and the INSERT (READ COMMITTED) would be updated without its previous values.
+        # The table stays readable.
+        cursor.execute(f'LOCK TABLE {table} IN SHARE ROW EXCLUSIVE MODE')
+        # the previous values, the rows stay locked until the load is committed
+        cursor.execute(
+            f'SELECT {", ".join(f"{table}.{column}" for column in columns)} FROM {table} '
+            f'JOIN {STAGING_TABLE} USING ({", ".join(keys)}) FOR UPDATE OF {table}')
+        existing = {row[:len(keys)]: row for row in cursor.fetchall()}
+
+        cursor.execute(
+            f'INSERT INTO {table} ({", ".join(columns)}) SELECT {", ".join(columns)} FROM {STAGING_TABLE} '
+            f'ON CONFLICT ({", ".join(keys)}) DO UPDATE '
+            f'SET {", ".join(f"{metric} = EXCLUDED.{metric}" for metric in metrics)} '
+            f'WHERE ({", ".join(f"{table}.{metric}" for metric in metrics)}) '
+            f'IS DISTINCT FROM ({", ".join(f"EXCLUDED.{metric}" for metric in metrics)}) '
+            f'RETURNING {", ".join(columns)}')
+        written = cursor.fetchall()
+    return written, [existing[row[:len(keys)]] for row in written if row[:len(keys)] in existing]
+
+
+def bulk_upsert_rows(rows: typ.Sequence[Row]) -> typ.Tuple[typ.List[Row], typ.List[Row]]:
+    """Upsert rows with the ORM (for databases without COPY, e.g. SQLite): the existing rows are selected,
+    the new ones are created and the changed ones are updated with batched queries
+
+    :param rows: rows with the dimension ids, one row per natural key
+    :return: written (inserted or changed) rows and the previous values of the changed rows
+    """
+    attnames = [UsageInfo._meta.get_field(name).attname for name in COLUMNS]
+    keys = attnames[:len(NATURAL_KEY)]
+    candidates = UsageInfo.objects.select_for_update().filter(**{
+        f'{attname}__in': {row[i] for row in rows} for i, attname in enumerate(keys)})
+    existing = {row[1:len(keys) + 1]: row for row in candidates.values_list('pk', *attnames)}
+
+    created, changed, written, previous = [], [], [], []
+    for row in rows:
+        old = existing.get(row[:len(keys)])
+        if old is None:
+            created.append(UsageInfo(**dict(zip(attnames, row))))
+        elif old[len(keys) + 1:] != row[len(keys):]:
+            changed.append(UsageInfo(pk=old[0], **dict(zip(attnames, row))))
+            previous.append(old[1:])
+        else:
+            continue
+        written.append(row)
+
+    if created:
+        UsageInfo.objects.bulk_create(created)
+    if changed:
+        UsageInfo.objects.bulk_update(changed, METRICS, batch_size=1000)
+    return written, previous
+
+
+def _as_dates(rows: typ.Iterable[Row]) -> typ.List[Row]:
+    """Rows with the dates as datetime.date (like the ones read from the database), the last row of a key wins"""
+    by_key = {}
+    for row in rows:
+        date = datetime.date.fromisoformat(row[0]) if isinstance(row[0], str) else row[0]
+        row = (date, *row[1:])
+        by_key[row[:len(NATURAL_KEY)]] = row
+    return list(by_key.values())
+
+
+def load_rows(rows: typ.Iterable[Row], chunk_size: int = DEFAULT_CHUNK_SIZE,
+              on_chunk: typ.Optional[typ.Callable[[int], None]] = None, upsert: bool = False,
+              counts: typ.Optional[typ.Counter[str]] = None, deferred: bool = False) -> typ.Tuple[int, int]:
+    """Write rows to the usage info table chunk by chunk in a single transaction.
+    The dimension names are replaced by the ids of the dimension tables (new names are added),
+    so the chunks written to the table and sent with the usage_info_loaded signal have the ids.
+    The missing monthly partitions of a partitioned table (PostgreSQL) are created on the way.
+
+    With upsert the rows replace the existing rows of the same date, channel, country and os
+    (the last row of a key in a chunk wins): only the inserted and the changed rows are written
+    and sent with the signal, along with the previous values of the changed ones (removed),
+    so the rollups and the caches get the changes only, reloading a file changes nothing.
+
+    :param rows: validated rows
+    :param chunk_size: number of rows sent to the database at once
+    :param on_chunk: callback receiving the number of rows loaded so far
+    :param upsert: upsert the rows on the natural key instead of appending them
+    :param counts: counter to collect the number of inserted, updated and unchanged rows
+    :param deferred: send the signal with deferred=True: the rollup deltas are kept as pending and the data version
+        is not bumped, the caller applies them after the load (see pipeline.py)
+    :return: number of loaded rows and chunks
+    """
+    if upsert:
+        write = copy_upsert_rows if connection.vendor == 'postgresql' else bulk_upsert_rows
+    else:
+        write = copy_rows if connection.vendor == 'postgresql' else bulk_create_rows
+    positions = {field: COLUMNS.index(field) for field in DIMENSION_MODELS}
+    counts = Counter() if counts is None else counts
+    loaded = chunks = 0
+    with transaction.atomic():
+        encoder = DimensionEncoder()
+        months = set(partitions.list_partitions()) if partitions.is_partitioned() else None
+        for chunk in chunked(rows, chunk_size):
+            chunk = encoder.encode_rows(chunk, positions)
+            if months is not None:
+                partitions.ensure_partitions({row[0] for row in chunk}, months)
+            if upsert:
+                distinct = _as_dates(chunk)
+                written, previous = write(distinct)
+                counts['inserted'] += len(written) - len(previous)
+                counts['updated'] += len(previous)
+                counts['unchanged'] += len(distinct) - len(written)
+                if written:
+                    usage_info_loaded.send(sender=UsageInfo, rows=written, removed=previous, deferred=deferred)
+            else:
+                write(chunk)
+                counts['inserted'] += len(chunk)
+                usage_info_loaded.send(sender=UsageInfo, rows=chunk, deferred=deferred)
+            loaded += len(chunk)
+            chunks += 1
+            if on_chunk is not None:
+                on_chunk(loaded)
+    return loaded, chunks
+
+
+def load_csv(file: typ.TextIO, chunk_size: int = DEFAULT_CHUNK_SIZE, skip_invalid: bool = False,
+             on_chunk: typ.Optional[typ.Callable[[int], None]] = None, upsert: bool = False) -> LoadStats:
+    """Validate and load a usage info CSV file in one pass
+
+    :param file: opened CSV file (date,channel,country,os,impressions,clicks,installs,spend,revenue)
+    :param chunk_size: number of rows sent to the database at once
+    :param skip_invalid: skip invalid rows instead of failing
+    :param on_chunk: callback receiving the number of rows loaded so far
+    :param upsert: upsert the rows on the natural key (date, channel, country, os) instead of appending them
+    :return: load statistics
+    :raise ValidationError: if a row is not valid and skip_invalid is off
+    """
+    rejected = []
+    counts = Counter()
+    started = time.perf_counter()
+    loaded, chunks = load_rows(read_rows(file, skip_invalid, rejected), chunk_size, on_chunk, upsert, counts)
+    return LoadStats(
+        rows=loaded, rejected=len(rejected), chunks=chunks,
+        seconds=time.perf_counter() - started, **counts)
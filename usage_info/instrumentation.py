@@ -0,0 +1,297 @@
+"""
+Per-request instrumentation of the usage info endpoints (see InstrumentationMiddleware).
+
+The time of every phase of a request (validation of the params, response cache, query plan, SQL,
+pagination COUNT, serialization, rendering) is measured, the SQL run during a phase is counted to the SQL phases
+only, so the phases don't overlap. The phases are sent in the Server-Timing header, requests slower than
+USAGE_INFO_SLOW_REQUEST_MS are logged (usage_info.slow logger) as JSON with their query spec and SQL,
+and the histograms of all the requests of the process are served by UsageInfoMetricsView.
+A streamed response (the export) is recorded once its content is sent: the rows are read, serialized
+and rendered meanwhile, so its Server-Timing header only has the phases before the first byte.
+
+The async (asyncpg) path of asgi.py records its phases and queries with the same RequestMetrics and finish().
+The queries run by the worker threads of a batch request aren't instrumented.
+"""
+import re
+import json
+import time
+import logging
+import threading
+import contextlib
+import contextvars
+import typing as typ
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connections
+from django.http import HttpRequest, HttpResponse
+
+# upper bounds of the histogram buckets, milliseconds
+BUCKETS_MS = (1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+# order of the phases in the Server-Timing header
+PHASES = ('validate', 'cache', 'plan', 'count', 'sql', 'serialize', 'render')
+PATH_PREFIX = '/usage_info'
+MAX_LOGGED_QUERIES = 50
+COUNT_RE = re.compile(r'\s*SELECT\s+COUNT\(', re.IGNORECASE)
+_END = object()  # end of timed() iteration
+
+slow_logger = logging.getLogger('usage_info.slow')
+
+
+class RequestMetrics:
+    """Phase timings, SQL queries and rows of a request"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases: typ.Dict[str, float] = defaultdict(float)  # phase -> seconds
+        self.sql_seconds = 0.0
+        self.phase_seconds = 0.0  # summed over the phases (except the SQL ones)
+        self.queries: typ.List[dict] = []  # the first MAX_LOGGED_QUERIES ones
+        self.query_count = 0
+        self.rows: typ.Optional[int] = None
+        self.spec: typ.Optional[dict] = None
+
+    def execute(self, execute: typ.Callable, sql: str, params: typ.Any, many: bool, context: dict) -> typ.Any:
+        """Database execute wrapper timing the queries"""
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.record_query(sql, params, time.perf_counter() - started)
+
+    def record_query(self, sql: str, params: typ.Any, seconds: float) -> None:
+        """Count the query to the SQL (or the pagination COUNT) phase"""
+        self.sql_seconds += seconds
+        self.query_count += 1
+        self.phases['count' if COUNT_RE.match(sql) else 'sql'] += seconds
+        if len(self.queries) < MAX_LOGGED_QUERIES:
+            self.queries.append({'sql': sql, 'params': params, 'ms': round(seconds * 1000, 3)})
+
+    @contextlib.contextmanager
+    def phase(self, name: str) -> typ.Iterator[None]:
+        """Add the time of the block (except the SQL and the nested phases run meanwhile) to the phase"""
+        started, sql_seconds, phase_seconds = time.perf_counter(), self.sql_seconds, self.phase_seconds
+        try:
+            yield
+        finally:
+            seconds = (time.perf_counter() - started - (self.sql_seconds - sql_seconds)
+                       - (self.phase_seconds - phase_seconds))
+            self.phases[name] += seconds
+            self.phase_seconds += seconds
+
+    def server_timing(self, total: float) -> str:
+        metrics = []
+        for name in (*PHASES, *sorted(set(self.phases).difference(PHASES))):
+            if name in self.phases:
+                description = f';desc="{self.query_count} queries"' if name == 'sql' else ''
+                metrics.append(f'{name};dur={self.phases[name] * 1000:.3f}{description}')
+        metrics.append(f'total;dur={total * 1000:.3f}')
+        return ', '.join(metrics)
+
+
+_current: contextvars.ContextVar[typ.Optional[RequestMetrics]] = contextvars.ContextVar(
+    'usage_info_request_metrics', default=None)
+
+
+def current() -> typ.Optional[RequestMetrics]:
+    """Get the metrics of the request being handled (None outside of an instrumented request)"""
+    return _current.get()
+
+
+@contextlib.contextmanager
+def activate(metrics: RequestMetrics) -> typ.Iterator[None]:
+    """Make the metrics the ones of the request being handled in the block (see current())"""
+    token = _current.set(metrics)
+    try:
+        yield
+    finally:
+        _current.reset(token)
+
+
+@contextlib.contextmanager
+def track_queries(metrics: RequestMetrics) -> typ.Iterator[None]:
+    """Time the queries run on the Django connections of the thread in the block"""
+    with contextlib.ExitStack() as stack:
+        for connection in connections.all():
+            stack.enter_context(connection.execute_wrapper(metrics.execute))
+        yield
+
+
+@contextlib.contextmanager
+def phase(name: str) -> typ.Iterator[None]:
+    """Time a phase of the current request (does nothing outside of an instrumented request)"""
+    metrics = current()
+    if metrics is None:
+        yield
+    else:
+        with metrics.phase(name):
+            yield
+
+
+def timed(name: str, iterable: typ.Iterable) -> typ.Iterator:
+    """Iterate, adding the time of every step to the phase of the current request (see phase())"""
+    iterator = iter(iterable)
+    while True:
+        with phase(name):
+            item = next(iterator, _END)
+        if item is _END:
+            return
+        yield item
+
+
+class Histogram:
+    """Cumulative bucket counts, count and sum of the observed values (milliseconds)"""
+
+    def __init__(self, buckets: typ.Sequence[float] = BUCKETS_MS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # the last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.count += 1
+        self.sum += value
+
+    def as_dict(self) -> dict:
+        cumulative, total = [], 0
+        for bound, count in zip((*self.buckets, '+Inf'), self.counts):
+            total += count
+            cumulative.append([bound, total])
+        return {'buckets': cumulative, 'count': self.count, 'sum': round(self.sum, 3)}
+
+
+class MetricsRegistry:
+    """Thread safe aggregates of the instrumented requests per endpoint (per process)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            self.endpoints: typ.Dict[str, dict] = {}
+
+    def record(self, endpoint: str, metrics: RequestMetrics, total: float, slow: bool) -> None:
+        with self._lock:
+            if endpoint not in self.endpoints:
+                self.endpoints[endpoint] = {
+                    'requests': 0, 'slow_requests': 0, 'queries': Histogram((0, 1, 2, 3, 5, 10, 25, 50, 100)),
+                    'rows': Histogram((0, 1, 10, 100, 1000, 10000, 100000)), 'phases': defaultdict(Histogram),
+                }
+            aggregates = self.endpoints[endpoint]
+            aggregates['requests'] += 1
+            aggregates['slow_requests'] += slow
+            aggregates['queries'].observe(metrics.query_count)
+            if metrics.rows is not None:
+                aggregates['rows'].observe(metrics.rows)
+            for name, seconds in metrics.phases.items():
+                aggregates['phases'][name].observe(seconds * 1000)
+            aggregates['phases']['total'].observe(total * 1000)
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            return {
+                endpoint: {
+                    'requests': aggregates['requests'],
+                    'slow_requests': aggregates['slow_requests'],
+                    'queries': aggregates['queries'].as_dict(),
+                    'rows': aggregates['rows'].as_dict(),
+                    'duration_ms': {name: histogram.as_dict() for name, histogram in aggregates['phases'].items()},
+                }
+                for endpoint, aggregates in self.endpoints.items()
+            }
+
+
+registry = MetricsRegistry()
+
+
+def finish(request: HttpRequest, status: int, endpoint: str, metrics: RequestMetrics) -> str:
+    """
+    Record the finished request: log it if it's slow, add it to the registry
+
+    :param request: request
+    :param status: response status code
+    :param endpoint: url name of the endpoint
+    :param metrics: metrics of the request
+    :return: Server-Timing header of the response
+    """
+    total = time.perf_counter() - metrics.started
+    slow = total * 1000 >= settings.USAGE_INFO_SLOW_REQUEST_MS
+    if slow:
+        log_slow_request(request, status, metrics, total)
+    registry.record(endpoint, metrics, total, slow)
+    return metrics.server_timing(total)
+
+
+def stream(request: HttpRequest, status: int, endpoint: str, metrics: RequestMetrics,
+           content: typ.Iterable[bytes]) -> typ.Iterator[bytes]:
+    """
+    Send the content of a streamed response as a part of the request: its queries and phases are recorded,
+    the request is finished (see finish()) once the content is sent or the response is closed
+    """
+    try:
+        with activate(metrics), track_queries(metrics):
+            yield from content
+    finally:
+        finish(request, status, endpoint, metrics)
+
+
+def log_slow_request(request: HttpRequest, status: int, metrics: RequestMetrics, total: float) -> None:
+    record = {
+        'method': request.method,
+        'path': request.path,
+        'query_string': request.META.get('QUERY_STRING', ''),
+        'status': status,
+        'duration_ms': round(total * 1000, 3),
+        'phases_ms': {name: round(seconds * 1000, 3) for name, seconds in metrics.phases.items()},
+        'query_count': metrics.query_count,
+        'rows': metrics.rows,
+        'spec': metrics.spec,
+        'queries': metrics.queries,
+    }
+    slow_logger.warning(json.dumps(record, cls=DjangoJSONEncoder), extra={'usage_info': record})
+
+
+class InstrumentationMiddleware:
+    """Instrument the requests of the usage info endpoints (except the metrics one)"""
+
+    def __init__(self, get_response: typ.Callable[[HttpRequest], HttpResponse]):
+        self.get_response = get_response
+
+    def __call__(self, request: HttpRequest) -> HttpResponse:
+        if not request.path.startswith(PATH_PREFIX):
+            return self.get_response(request)
+
+        metrics = RequestMetrics()
+        with activate(metrics), track_queries(metrics):
+            response = self.get_response(request)
+
+        endpoint = request.resolver_match.url_name if request.resolver_match else None
+        if endpoint == 'usage-info-metrics':
+            return response
+        if response.streaming:
+            # the headers are sent before the content is read: they only have the phases done so far
+            response['Server-Timing'] = metrics.server_timing(time.perf_counter() - metrics.started)
+            response.streaming_content = stream(
+                request, response.status_code, endpoint or request.path, metrics, response.streaming_content)
+            return response
+        response['Server-Timing'] = finish(request, response.status_code, endpoint or request.path, metrics)
+        return response
+
+    def process_template_response(self, request: HttpRequest, response: HttpResponse) -> HttpResponse:
+        """Time the rendering of the DRF responses (rendered after the view returns)"""
+        metrics = current()
+        if metrics is not None:
+            started = time.perf_counter()
+
+            def rendered(response: HttpResponse) -> None:
+                metrics.phases['render'] += time.perf_counter() - started
+            response.add_post_render_callback(rendered)
+        return response
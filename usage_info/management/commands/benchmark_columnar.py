@@ -0,0 +1,71 @@
+import time
+import typing as typ
+import statistics
+
+from django.core.management.base import BaseCommand, CommandError
+from django.http import QueryDict
+from django.test import override_settings
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+
+from usage_info import cache, columnar
+from usage_info.views import UsageInfoView
+
+QUERIES = (
+    'date_from=2017-06-01&date_to=2017-06-15&sort_by=-revenue',
+    'date_to=2017-06-01&group_by=channel,country&sort_by=-clicks',
+    'date_from=2017-05-01&date_to=2017-05-31&os=ios&group_by=date&sort_by=date',
+    'cpi=1&countries=CA&group_by=channel&sort_by=-cpi',
+    'group_by=date,channel,country,os&cpi=1',
+)
+
+
+class Command(BaseCommand):
+    help = 'Compare the latency of the database and the columnar (NumPy) UsageInfoView engines on the loaded data'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--query', action='append',
+            help='UsageInfoView query params, may be repeated (default: the README examples and a full group_by)')
+        parser.add_argument('--repeat', type=int, default=20, help='Number of runs per query (default: %(default)s)')
+
+    def handle(self, *args, **options):
+        if columnar.np is None:
+            raise CommandError('The columnar engine requires NumPy')
+
+        version = cache.current_version()
+        started = time.perf_counter()
+        snapshot = columnar.get_snapshot(version)
+        self.stdout.write(f'Snapshot of {len(snapshot)} rows loaded in {(time.perf_counter() - started) * 1000:.2f} ms')
+        if not len(snapshot):
+            raise CommandError('No rows, load some data with the load_usage_info command first')
+
+        self.stdout.write(f'{"engine":<10} {"p50 ms":>10} {"p95 ms":>10} {"rows":>8}  query')
+        for query_params in options['query'] or QUERIES:
+            medians = {}
+            for engine in ('orm', 'columnar'):
+                with override_settings(USAGE_INFO_ENGINE=engine):
+                    timings, size = self.measure(query_params, options['repeat'])
+                medians[engine] = statistics.median(timings)
+                self.stdout.write(
+                    f'{engine:<10} {medians[engine] * 1000:10.2f} '
+                    f'{self.percentile(timings, 95) * 1000:10.2f} {size:8}  {query_params}')
+            self.stdout.write(self.style.SUCCESS(f'Speedup: {medians["orm"] / medians["columnar"]:.1f}x'))
+
+    @staticmethod
+    def measure(query_params: str, repeat: int) -> typ.Tuple[typ.List[float], int]:
+        """Time getting and serializing all the rows of the query (the response cache is bypassed)"""
+        timings, size = [], 0
+        for _ in range(max(repeat, 1)):
+            view = UsageInfoView(
+                request=Request(APIRequestFactory().get('/usage_info', QueryDict(query_params))), format_kwarg=None)
+            started = time.perf_counter()
+            plan = view.get_plan()
+            size = len(plan.serializer.serialize(view.get_rows(plan)))
+            timings.append(time.perf_counter() - started)
+        return timings, size
+
+    @staticmethod
+    def percentile(timings: typ.List[float], percent: int) -> float:
+        ordered = sorted(timings)
+        return ordered[min(len(ordered) - 1, len(ordered) * percent // 100)]
@@ -0,0 +1,146 @@
+import os
+import csv
+import json
+import time
+import tempfile
+import threading
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connection, connections
+
+from usage_info import cache, pipeline, rollups, synthetic
+from usage_info.ingest import COLUMNS
+from usage_info.models import UsageInfo, UsageInfoLoadedChunk, UsageInfoRollupDelta
+
+# the sessions of the database waiting for a row or a table lock
+LOCK_WAITS_SQL = '''
+    SELECT count(*) FROM pg_stat_activity
+    WHERE datname = current_database() AND wait_event_type = 'Lock' AND pid <> pg_backend_pid()
+'''
+
+
+def process_counts(value: str) -> list:
+    counts = [int(count) for count in value.split(',')]
+    if min(counts) < 1:
+        raise ValueError(value)
+    return counts
+
+
+class LockWaits:
+    """
+    Sample the sessions waiting for a lock (PostgreSQL) in a thread while the load runs: the chunk transactions
+    serialized by a shared row wait for each other, the ones running in parallel don't
+    """
+    interval = 0.01
+
+    def __init__(self):
+        self.seconds = 0.0  # summed over the waiting sessions
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def __enter__(self) -> 'LockWaits':
+        if connection.vendor == 'postgresql':
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def _sample(self) -> None:
+        # the thread has its own connection
+        sampling = connections[DEFAULT_DB_ALIAS]
+        try:
+            with sampling.cursor() as cursor:
+                last = time.perf_counter()
+                while not self._stop.wait(self.interval):
+                    cursor.execute(LOCK_WAITS_SQL)
+                    waiting, = cursor.fetchone()
+                    now = time.perf_counter()
+                    self.seconds += waiting * (now - last)
+                    last = now
+        finally:
+            sampling.close()
+
+
+class Command(BaseCommand):
+    help = ('Benchmark the parallel load (load_usage_info --processes) of a generated CSV file with different numbers '
+            'of processes. Requires an empty usage info table, the loaded rows are deleted after every run.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--rows', type=int, default=1000000, help='Number of generated rows (default: %(default)s)')
+        parser.add_argument(
+            '--file', help='Load this CSV file instead of a generated one')
+        parser.add_argument(
+            '--processes', type=process_counts, default=sorted({1, 2, 4, os.cpu_count() or 1}),
+            help='Comma separated numbers of processes (default: 1,2,4 and the number of CPUs)')
+        parser.add_argument(
+            '--connections', type=int,
+            help='Maximum number of chunks written at once (default: the number of processes)')
+        parser.add_argument(
+            '--chunk-mb', type=int, default=4, help='Size of the chunks, megabytes (default: %(default)s)')
+        parser.add_argument('--output', help='Write the JSON report to the file')
+
+    def handle(self, *args, **options):
+        if UsageInfo.objects.exists():
+            raise CommandError('The usage info table must be empty, the loaded rows are deleted after every run')
+        if min(options['rows'], options['chunk_mb'], options['connections'] or 1) < 1:
+            raise CommandError('--rows, --connections and --chunk-mb must be positive numbers')
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = options['file']
+            if path is None:
+                path = os.path.join(directory, 'usage_info.csv')
+                try:
+                    rows = synthetic.generate_rows(synthetic.Options(rows=options['rows']))
+                    with open(path, 'wt', newline='') as csvf:
+                        writer = csv.writer(csvf)
+                        writer.writerow(COLUMNS)
+                        writer.writerows(rows)
+                except ValueError as err:
+                    raise CommandError(err)
+            size = os.path.getsize(path)
+
+            results = []
+            self.stdout.write(
+                f'{"processes":>9} {"seconds":>10} {"rows/sec":>12} {"speedup":>8} {"lock wait, s":>13}')
+            for processes in options['processes']:
+                try:
+                    with LockWaits() as lock_waits:
+                        stats = pipeline.load_file(
+                            path, processes, options['connections'], options['chunk_mb'] * 2 ** 20, restart=True)
+                finally:
+                    self.clear()
+                results.append({
+                    'processes': processes, 'rows': stats.rows, 'chunks': stats.chunks,
+                    'seconds': round(stats.seconds, 3), 'rows_per_second': round(stats.rows_per_second),
+                    'speedup': round(results[0]['seconds'] / stats.seconds, 2) if results else 1.0,
+                    'lock_wait_seconds': round(lock_waits.seconds, 3),
+                })
+                self.stdout.write(
+                    f'{processes:9} {stats.seconds:10.2f} {stats.rows_per_second:12.0f} {results[-1]["speedup"]:7.2f}x '
+                    f'{lock_waits.seconds:13.2f}')
+
+        if options['output']:
+            report = {'database': connection.vendor, 'cpus': os.cpu_count(), 'file_bytes': size, 'results': results}
+            try:
+                with open(options['output'], 'wt') as file:
+                    json.dump(report, file, indent=2)
+            except OSError as err:
+                raise CommandError(err)
+
+    @staticmethod
+    def clear() -> None:
+        """Delete the loaded rows (without the per row signals of the ORM delete)"""
+        quote = connection.ops.quote_name
+        tables = [model._meta.db_table
+                  for model in (UsageInfo, *rollups.ROLLUPS, UsageInfoLoadedChunk, UsageInfoRollupDelta)]
+        with connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                cursor.execute(f'TRUNCATE {", ".join(map(quote, tables))}')
+            else:
+                for table in tables:
+                    cursor.execute(f'DELETE FROM {quote(table)}')
+        cache.bump_version()
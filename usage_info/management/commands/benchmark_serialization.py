@@ -0,0 +1,58 @@
+import time
+import typing as typ
+
+from django.core.management.base import BaseCommand, CommandError
+from django.http import QueryDict
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+
+from usage_info.views import UsageInfoView
+
+
+class Command(BaseCommand):
+    help = 'Compare UsageInfoSerializer with the values_list() fast path (serialization + JSON rendering)'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--query', default='group_by=date,channel,country,os&cpi=1',
+            help='UsageInfoView query params (default: %(default)s)')
+        parser.add_argument('--limit', type=int, default=10000, help='Number of rows (default: %(default)s)')
+        parser.add_argument('--repeat', type=int, default=5, help='Number of runs, the best one is reported')
+
+    def handle(self, *args, **options):
+        request = Request(APIRequestFactory().get('/usage_info', QueryDict(options['query'])))
+        view = UsageInfoView(request=request, format_kwarg=None)
+        plan = view.get_plan()
+        queryset, values_list, fast_serializer = plan.queryset.all(), plan.values_list.all(), plan.serializer
+
+        rows = list(queryset[:options['limit']])
+        tuples = list(values_list[:options['limit']])
+        if not rows:
+            raise CommandError('No rows, load some data with the load_usage_info command first')
+
+        renderer = JSONRenderer()
+        serializer_class = view.get_serializer_class()
+        results = {
+            'UsageInfoSerializer': self.best_time(
+                lambda: renderer.render(serializer_class(rows, many=True).data), options['repeat']),
+            'FastUsageInfoSerializer': self.best_time(
+                lambda: renderer.render(fast_serializer.serialize(tuples)), options['repeat']),
+        }
+        if serializer_class(rows, many=True).data != fast_serializer.serialize(tuples):
+            raise CommandError('The serializers gave different results')
+
+        self.stdout.write(f'{len(rows)} rows, query: {options["query"]}')
+        for name, seconds in results.items():
+            self.stdout.write(f'{name:<25} {seconds * 1000:10.2f} ms {len(rows) / seconds:12.0f} rows/sec')
+        self.stdout.write(self.style.SUCCESS(
+            f'Speedup: {results["UsageInfoSerializer"] / results["FastUsageInfoSerializer"]:.1f}x'))
+
+    @staticmethod
+    def best_time(func: typ.Callable[[], typ.Any], repeat: int) -> float:
+        timings = []
+        for _ in range(max(repeat, 1)):
+            started = time.perf_counter()
+            func()
+            timings.append(time.perf_counter() - started)
+        return min(timings)
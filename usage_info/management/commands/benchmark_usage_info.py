@@ -0,0 +1,187 @@
+import json
+import time
+import resource
+import platform
+import itertools
+import tracemalloc
+import typing as typ
+
+import django
+from django.conf import settings
+from django.core.cache import caches
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIRequestFactory
+
+from usage_info import cache
+from usage_info.models import UsageInfo
+from usage_info.views import UsageInfoView
+
+# the README examples
+QUERIES = (
+    'date_to=2017-06-01&group_by=channel,country&sort_by=-clicks',
+    'date_from=2017-05-01&date_to=2017-05-31&os=ios&group_by=date&sort_by=date',
+    'date_from=2017-06-01&date_to=2017-06-01&countries=US&group_by=os&sort_by=-revenue',
+    'cpi=1&countries=CA&group_by=channel&sort_by=-cpi',
+)
+FILTERS = (
+    '',
+    'date_from=2017-06-01&date_to=2017-06-15',
+    'countries=US,GB,DE',
+    'os=ios',
+    'date_from=2017-01-01&channels=facebook,google',
+)
+GROUP_BYS = (
+    '', 'date', 'channel', 'channel,country', 'date,os', 'date,channel,country,os', 'date:month', 'date:week,channel',
+)
+LIMITS = (10, 1000)
+
+
+def query_matrix() -> typ.List[str]:
+    """Filter, group_by, sort_by, cpi and limit combinations"""
+    queries = []
+    for filters, group_by, cpi, limit in itertools.product(FILTERS, GROUP_BYS, (False, True), LIMITS):
+        for sort_by in ('-cpi' if cpi else '-clicks', group_by.split(',')[0].split(':')[0] or 'date'):
+            params = [
+                filters,
+                f'group_by={group_by}' if group_by else '',
+                f'sort_by={sort_by}',
+                'cpi=1' if cpi else '',
+                f'limit={limit}',
+            ]
+            queries.append('&'.join(param for param in params if param))
+    return queries
+
+
+class Command(BaseCommand):
+    help = ('Benchmark UsageInfoView on the loaded data (e.g. generated by generate_usage_info) with the README '
+            'queries and a matrix of filter/group_by/sort_by/cpi/limit combinations. Reports the latency '
+            'percentiles, the number of SQL queries and the peak memory of every query as JSON.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--query', action='append',
+            help='UsageInfoView query params, may be repeated (default: the README examples and the matrix)')
+        parser.add_argument('--no-matrix', action='store_true', help='Run the README examples only')
+        parser.add_argument('--match', help='Run only the queries containing the text')
+        parser.add_argument('--repeat', type=int, default=10, help='Number of runs per query (default: %(default)s)')
+        parser.add_argument('--output', help='Write the JSON report to the file instead of stdout')
+        parser.add_argument('--baseline', help='JSON report of a previous run to compare the p50 latencies with')
+        parser.add_argument(
+            '--max-regression', type=float,
+            help='Fail if the p50 latency of a query is more than this times the baseline one (e.g. 1.2)')
+
+    def handle(self, *args, **options):
+        if options['repeat'] < 1:
+            raise CommandError('--repeat must be a positive number')
+        if options['max_regression'] is not None and not options['baseline']:
+            raise CommandError('--max-regression requires --baseline')
+        queries = options['query'] or [*QUERIES, *([] if options['no_matrix'] else query_matrix())]
+        if options['match']:
+            queries = [query_params for query_params in queries if options['match'] in query_params]
+        baseline = self.read_baseline(options['baseline']) if options['baseline'] else {}
+
+        report = {
+            'meta': {
+                'started_at': timezone.now().isoformat(),
+                'database': connection.vendor,
+                'engine': getattr(settings, 'USAGE_INFO_ENGINE', 'orm'),
+                'rows': UsageInfo.objects.count(),
+                'repeat': options['repeat'],
+                'python': platform.python_version(),
+                'django': django.get_version(),
+            },
+            'results': [],
+        }
+        for i, query_params in enumerate(queries, 1):
+            result = self.measure(query_params, options['repeat'])
+            if query_params in baseline:
+                result['baseline_p50_ms'] = baseline[query_params]
+                result['p50_ratio'] = round(result['p50_ms'] / baseline[query_params], 3) \
+                    if baseline[query_params] else None
+            report['results'].append(result)
+            if options['verbosity'] > 1:
+                self.stderr.write(f'[{i}/{len(queries)}] {result["p50_ms"]:10.2f} ms  {query_params}')
+        # kilobytes on Linux
+        report['meta']['max_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        content = json.dumps(report, indent=2)
+        if options['output']:
+            try:
+                with open(options['output'], 'wt') as file:
+                    file.write(content + '\n')
+            except OSError as err:
+                raise CommandError(err)
+        else:
+            self.stdout.write(content)
+
+        if options['max_regression'] is not None:
+            regressions = [result['query'] for result in report['results']
+                           if (result.get('p50_ratio') or 0) > options['max_regression']]
+            if regressions:
+                raise CommandError(
+                    f'p50 latency regressed more than {options["max_regression"]}x: {", ".join(regressions)}')
+
+    @staticmethod
+    def read_baseline(path: str) -> typ.Dict[str, float]:
+        """Get query params -> p50 latency of a JSON report"""
+        try:
+            with open(path) as file:
+                return {result['query']: result['p50_ms'] for result in json.load(file)['results']}
+        except (OSError, ValueError, KeyError, TypeError) as err:
+            raise CommandError(f'Not a benchmark report: {path} ({err})')
+
+    def measure(self, query_params: str, repeat: int) -> dict:
+        """
+        Time the whole request (parsing, SQL, serialization and JSON rendering) without the response cache.
+        A warm-up run comes first (the query plan and the dimension names are cached like on a live server),
+        the SQL queries and the peak memory are taken from an extra run.
+        """
+        caches[cache.CACHE_ALIAS].clear()
+        status, rows = self.request(query_params)
+        timings = []
+        for _ in range(repeat):
+            caches[cache.CACHE_ALIAS].clear()
+            started = time.perf_counter()
+            self.request(query_params)
+            timings.append(time.perf_counter() - started)
+
+        caches[cache.CACHE_ALIAS].clear()
+        tracemalloc.start()
+        try:
+            with CaptureQueriesContext(connection) as queries:
+                self.request(query_params)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        timings.sort()
+        return {
+            'query': query_params,
+            'status': status,
+            'rows': rows,
+            'p50_ms': round(self.percentile(timings, 50) * 1000, 3),
+            'p95_ms': round(self.percentile(timings, 95) * 1000, 3),
+            'p99_ms': round(self.percentile(timings, 99) * 1000, 3),
+            'mean_ms': round(sum(timings) / len(timings) * 1000, 3),
+            'queries': len(queries),
+            'peak_memory_kb': peak // 1024,
+        }
+
+    @staticmethod
+    def request(query_params: str) -> typ.Tuple[int, int]:
+        """Get and render the UsageInfoView response, return the status and the number of rows"""
+        request = APIRequestFactory().get(f'/usage_info?{query_params}', HTTP_ACCEPT='application/json')
+        response = UsageInfoView.as_view()(request)
+        response.render()
+        data = response.data
+        if isinstance(data, dict):
+            data = data.get('results', ())
+        return response.status_code, len(data)
+
+    @staticmethod
+    def percentile(timings: typ.List[float], percent: int) -> float:
+        """Nearest rank percentile of the sorted timings"""
+        return timings[min(len(timings) - 1, len(timings) * percent // 100)]
@@ -0,0 +1,76 @@
+import csv
+import time
+import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import IntegrityError
+
+from usage_info import synthetic
+from usage_info.ingest import COLUMNS, DEFAULT_CHUNK_SIZE, load_rows
+
+
+class Command(BaseCommand):
+    help = ('Generate reproducible synthetic usage info rows (skewed channel, country, os and date distributions) '
+            'and load them into the database or write them to a CSV file')
+
+    def add_arguments(self, parser):
+        defaults = synthetic.Options()
+        parser.add_argument('--rows', type=int, default=defaults.rows, help='Number of rows (default: %(default)s)')
+        parser.add_argument(
+            '--days', type=int, default=defaults.days, help='Number of dates (default: %(default)s)')
+        parser.add_argument(
+            '--date-to', type=datetime.date.fromisoformat, default=defaults.date_to,
+            help='The last date, YYYY-MM-DD (default: %(default)s)')
+        parser.add_argument(
+            '--channels', type=int, default=defaults.channels, help='Number of channels (default: %(default)s)')
+        parser.add_argument(
+            '--countries', type=int, default=defaults.countries, help='Number of countries (default: %(default)s)')
+        parser.add_argument(
+            '--os', type=int, default=defaults.operating_systems,
+            help='Number of operating systems (default: %(default)s)')
+        parser.add_argument(
+            '--growth', type=float, default=defaults.growth,
+            help='The last date has e^growth times the rows of the first one (default: %(default)s)')
+        parser.add_argument('--seed', type=int, default=defaults.seed, help='Random seed (default: %(default)s)')
+        parser.add_argument(
+            '--output', help='Write a CSV file (for load_usage_info) instead of loading the rows')
+        parser.add_argument(
+            '--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+            help=f'Number of rows sent to the database at once (default: {DEFAULT_CHUNK_SIZE})')
+
+    def handle(self, *args, **options):
+        generator_options = synthetic.Options(
+            rows=options['rows'], days=options['days'], date_to=options['date_to'], channels=options['channels'],
+            countries=options['countries'], operating_systems=options['os'], growth=options['growth'],
+            seed=options['seed'])
+        if min(generator_options.rows, generator_options.days, generator_options.channels,
+               generator_options.countries, generator_options.operating_systems, options['chunk_size']) < 1:
+            raise CommandError('--rows, --days, --channels, --countries, --os and --chunk-size must be positive')
+        try:
+            # fail before anything is written
+            synthetic.rows_per_date(generator_options)
+            synthetic.dimension_names(generator_options)
+        except ValueError as err:
+            raise CommandError(err)
+
+        started = time.perf_counter()
+        rows = synthetic.generate_rows(generator_options)
+        if options['output']:
+            try:
+                with open(options['output'], 'wt', newline='') as csvf:
+                    writer = csv.writer(csvf)
+                    writer.writerow(COLUMNS)
+                    writer.writerows(rows)
+            except OSError as err:
+                raise CommandError(err)
+        else:
+            def report(loaded: int) -> None:
+                if options['verbosity'] > 1:
+                    self.stdout.write(f'Loaded {loaded} records ...')
+
+            try:
+                load_rows(rows, options['chunk_size'], on_chunk=report)
+            except IntegrityError as err:
+                raise CommandError(f'{err}\nThe database has rows of the generated dates, use an empty database')
+        self.stdout.write(self.style.SUCCESS(
+            f'Done. Generated {generator_options.rows} records in {time.perf_counter() - started:.2f}s'))
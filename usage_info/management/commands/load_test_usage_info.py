@@ -0,0 +1,80 @@
+import time
+import random
+import typing as typ
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand, CommandError
+
+QUERIES = (
+    'date_from=2017-06-01&date_to=2017-06-15&sort_by=-revenue',
+    'date_to=2017-06-01&group_by=channel,country&sort_by=-clicks',
+    'date_from=2017-05-01&date_to=2017-05-31&os=ios&group_by=date&sort_by=date',
+    'cpi=1&countries=CA&group_by=channel&sort_by=-cpi',
+    'group_by=date,channel,country,os&cpi=1&limit=1000',
+)
+
+
+class Command(BaseCommand):
+    help = ('Send concurrent usage info requests to a running server and report the throughput and latency '
+            'per concurrency level, e.g. to compare a WSGI (gunicorn feed.wsgi) and an ASGI '
+            '(uvicorn feed.asgi:application) worker')
+
+    def add_arguments(self, parser):
+        parser.add_argument('url', help='Usage info endpoint, e.g. http://127.0.0.1:8000/usage_info')
+        parser.add_argument(
+            '--concurrency', type=int, action='append',
+            help='Number of the concurrent clients, may be repeated (default: 1, 8, 32)')
+        parser.add_argument(
+            '--requests', type=int, default=200,
+            help='Number of the requests per concurrency level (default: %(default)s)')
+        parser.add_argument(
+            '--query', action='append', help='Query params, may be repeated (default: the README examples)')
+        parser.add_argument(
+            '--unique', action='store_true',
+            help='Make every request unique (a random offset), so the response cache is not hit')
+        parser.add_argument('--timeout', type=float, default=30, help='Request timeout, seconds (default: %(default)s)')
+
+    def handle(self, *args, **options):
+        concurrency_levels = options['concurrency'] or [1, 8, 32]
+        if min(concurrency_levels) < 1 or options['requests'] < 1:
+            raise CommandError('--concurrency and --requests must be positive')
+        urls = [f'{options["url"]}?{query_params}' for query_params in options['query'] or QUERIES]
+
+        self.stdout.write(f'{"clients":>8} {"req/s":>9} {"p50 ms":>9} {"p95 ms":>9} {"p99 ms":>9} {"errors":>7}')
+        for concurrency in concurrency_levels:
+            requests = [self.request_url(urls[i % len(urls)], options['unique']) for i in range(options['requests'])]
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                results = list(executor.map(lambda url: self.send(url, options['timeout']), requests))
+            elapsed = time.perf_counter() - started
+
+            timings = sorted(seconds for seconds, ok in results if ok)
+            errors = len(results) - len(timings)
+            if not timings:
+                raise CommandError(f'All the requests to {options["url"]} failed')
+            self.stdout.write(
+                f'{concurrency:8} {len(results) / elapsed:9.1f} {self.percentile(timings, 50) * 1000:9.1f} '
+                f'{self.percentile(timings, 95) * 1000:9.1f} {self.percentile(timings, 99) * 1000:9.1f} {errors:7}')
+
+    @staticmethod
+    def request_url(url: str, unique: bool) -> str:
+        return f'{url}&offset={random.randrange(1000)}' if unique else url
+
+    @staticmethod
+    def send(url: str, timeout: float) -> typ.Tuple[float, bool]:
+        """Get the url, return the latency and whether the response was successful"""
+        started = time.perf_counter()
+        try:
+            with urllib.request.urlopen(url, timeout=timeout) as response:
+                response.read()
+                ok = response.status == 200
+        except (urllib.error.URLError, OSError):
+            ok = False
+        return time.perf_counter() - started, ok
+
+    @staticmethod
+    def percentile(timings: typ.List[float], percent: int) -> float:
+        """Nearest rank percentile of the sorted timings"""
+        return timings[min(len(timings) - 1, len(timings) * percent // 100)]
@@ -0,0 +1,73 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import IntegrityError
+
+from usage_info import pipeline
+from usage_info.ingest import DEFAULT_CHUNK_SIZE, load_csv
+from usage_info.validator import ValidationError
+
+
+class Command(BaseCommand):
+    help = 'Load a usage info CSV file (COPY FROM STDIN on PostgreSQL, batched INSERTs elsewhere)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='CSV file with the header date,channel,country,os,impressions,...')
+        parser.add_argument(
+            '--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+            help=f'Number of rows sent to the database at once, without --processes (default: {DEFAULT_CHUNK_SIZE})')
+        parser.add_argument(
+            '--skip-invalid', action='store_true',
+            help='Skip invalid rows instead of aborting the load')
+        parser.add_argument(
+            '--upsert', action='store_true',
+            help='Replace the rows of the same date, channel, country and os instead of adding them '
+                 '(e.g. to reload a re-delivered or corrected file)')
+        parser.add_argument(
+            '--processes', type=int,
+            help='Parse and load the file by chunks in this many processes, every chunk is committed separately '
+                 'and an interrupted load of the file continues from the loaded chunks (1 loads the chunks '
+                 'in this process, default: load the file in one transaction)')
+        parser.add_argument(
+            '--connections', type=int,
+            help='Maximum number of chunks written to the database at once with --processes '
+                 '(default: the number of processes on PostgreSQL, 1 elsewhere)')
+        parser.add_argument(
+            '--chunk-mb', type=int, default=pipeline.DEFAULT_CHUNK_BYTES // 2 ** 20,
+            help='Size of the chunks with --processes, megabytes (default: %(default)s)')
+        parser.add_argument(
+            '--restart', action='store_true',
+            help='Load the whole file with --processes, ignoring the chunks loaded by the previous runs')
+
+    def handle(self, *args, **options):
+        if min(options['chunk_size'], options['processes'] or 1, options['connections'] or 1,
+               options['chunk_mb']) < 1:
+            raise CommandError('--chunk-size, --processes, --connections and --chunk-mb must be positive numbers')
+
+        def report(loaded: int) -> None:
+            if options['verbosity'] > 1:
+                self.stdout.write(f'Loaded {loaded} records ...')
+
+        try:
+            if options['processes']:
+                stats = pipeline.load_file(
+                    options['path'], options['processes'], options['connections'], options['chunk_mb'] * 2 ** 20,
+                    pipeline.ChunkOptions(options['skip_invalid'], options['upsert']),
+                    restart=options['restart'], on_chunk=report)
+            else:
+                with open(options['path'], 'rt', newline='') as csvf:
+                    stats = load_csv(csvf, options['chunk_size'], options['skip_invalid'], on_chunk=report,
+                                     upsert=options['upsert'])
+        except (OSError, ValidationError) as err:
+            raise CommandError(err)
+        except IntegrityError as err:
+            raise CommandError(f'{err}\nThe file has rows already loaded, reload it with --upsert')
+
+        if stats.skipped_chunks:
+            self.stdout.write(f'Skipped {stats.skipped_chunks} chunks loaded by a previous run')
+        if stats.rejected:
+            self.stderr.write(f'Skipped {stats.rejected} invalid records')
+        self.stdout.write(self.style.SUCCESS(
+            f'Done. Loaded {stats.rows} records in {stats.seconds:.2f}s '
+            f'({stats.rows_per_second:.0f} rows/sec)'))
+        if options['upsert']:
+            self.stdout.write(
+                f'Inserted {stats.inserted}, updated {stats.updated}, unchanged {stats.unchanged} records')
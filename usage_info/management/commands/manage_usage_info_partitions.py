@@ -0,0 +1,64 @@
+import datetime
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from usage_info import cache, partitions, rollups
+from usage_info.ingest import COLUMNS
+
+
+class Command(BaseCommand):
+    help = 'Create the future monthly partitions of the usage info table, detach (and archive) the old ones'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--ahead', type=int, default=3,
+            help='Number of the months after the current one to create the partitions for (default: %(default)s)')
+        parser.add_argument(
+            '--detach-before', type=datetime.date.fromisoformat, metavar='YYYY-MM-DD',
+            help='Detach the partitions of the months before the month of the date')
+        parser.add_argument(
+            '--archive-dir', type=Path,
+            help='Write the detached partitions to <dir>/<partition>.csv (load_usage_info format) and drop them')
+
+    def handle(self, *args, **options):
+        if options['ahead'] < 0:
+            raise CommandError('--ahead must not be negative')
+        if options['archive_dir'] and not options['detach_before']:
+            raise CommandError('--archive-dir requires --detach-before')
+        if not partitions.is_partitioned():
+            raise CommandError('The usage info table is not partitioned (PostgreSQL only)')
+
+        current = partitions.month_start(datetime.date.today())
+        months = [partitions.add_months(current, months) for months in range(options['ahead'] + 1)]
+        for name in partitions.ensure_partitions(months):
+            self.stdout.write(f'Created {name}')
+
+        if options['detach_before']:
+            try:
+                self.detach(partitions.month_start(options['detach_before']), options['archive_dir'])
+            except OSError as err:
+                raise CommandError(err)
+        self.stdout.write(self.style.SUCCESS('Done'))
+
+    def detach(self, before: datetime.date, archive_dir: Path = None) -> None:
+        old = sorted(month for month in partitions.list_partitions() if month < before)
+        if not old:
+            return
+
+        with transaction.atomic():
+            for month in old:
+                name = partitions.detach_partition(month)
+                if archive_dir:
+                    archive_dir.mkdir(parents=True, exist_ok=True)
+                    path = archive_dir / f'{name}.csv'
+                    with open(path, 'wt', newline='') as file:
+                        partitions.archive_table(name, file, COLUMNS)
+                    partitions.drop_table(name)
+                    self.stdout.write(f'Archived {name} to {path}')
+                else:
+                    self.stdout.write(f'Detached {name}')
+            # the detached rows are not usage info anymore
+            rollups.rebuild()
+            cache.bump_version()
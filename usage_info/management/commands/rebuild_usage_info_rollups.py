@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from usage_info import cache, rollups
+
+
+class Command(BaseCommand):
+    help = 'Recompute the pre-aggregated usage info rollup tables from the UsageInfo table'
+
+    def handle(self, *args, **options):
+        rollups.rebuild()
+        cache.bump_version()
+        for rollup in rollups.ROLLUPS:
+            self.stdout.write(f'{rollup.__name__}: {rollup.objects.count()} rows')
+        self.stdout.write(self.style.SUCCESS('Done'))
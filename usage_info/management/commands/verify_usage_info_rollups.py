@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from usage_info import cache, rollups
+
+
+class Command(BaseCommand):
+    help = ('Check the pre-aggregated usage info rollup tables (with the pending deltas of the parallel ingestion) '
+            'against the UsageInfo table, e.g. after writes bypassing the loader and the model signals')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rebuild', action='store_true', help='Rebuild the rollups if any of them is stale')
+        parser.add_argument(
+            '--show', type=int, default=10, help='Number of the stale rows listed per rollup (default: %(default)s)')
+
+    def handle(self, *args, **options):
+        drifts = rollups.verify()
+        for rollup in rollups.ROLLUPS:
+            stale = [drift for drift in drifts if drift.rollup is rollup]
+            self.stdout.write(f'{rollup.__name__}: {len(stale)} stale rows')
+            for drift in stale[:options['show']]:
+                self.stdout.write(f'  {drift.key}: stored {drift.stored}, expected {drift.expected}')
+        if not drifts:
+            self.stdout.write(self.style.SUCCESS('The rollups are up to date'))
+            return
+        if not options['rebuild']:
+            raise CommandError(f'{len(drifts)} stale rollup rows, run with --rebuild (or rebuild_usage_info_rollups)')
+
+        rollups.rebuild()
+        cache.bump_version()
+        self.stdout.write(self.style.SUCCESS('Rebuilt the rollups'))
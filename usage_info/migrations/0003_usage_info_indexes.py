@@ -0,0 +1,45 @@
+from django.db import migrations
+
+# Indexes tuned to UsageInfoView filters (date range, channels, countries, os) and group_by fields.
+# On PostgreSQL the composite indexes INCLUDE the rest of the columns, so grouped queries
+# can be answered with index-only scans; other databases get plain composite indexes.
+METRICS = ('impressions', 'clicks', 'installs', 'spend', 'revenue')
+
+INDEXES = (
+    # name, key columns, included columns
+    ('usage_info_channel_cov_idx', ('channel', 'country', 'os', 'date'), METRICS),
+    ('usage_info_country_cov_idx', ('country', 'os', 'date'), ('channel', *METRICS)),
+    ('usage_info_os_cov_idx', ('os', 'date'), ('channel', 'country', *METRICS)),
+)
+DATE_INDEX = 'usage_info_date_brin_idx'
+TABLE = 'usage_info_usageinfo'
+
+
+def create_indexes(apps, schema_editor):
+    postgresql = schema_editor.connection.vendor == 'postgresql'
+    if postgresql:
+        schema_editor.execute(f'CREATE INDEX {DATE_INDEX} ON {TABLE} USING brin (date)')
+    else:
+        schema_editor.execute(f'CREATE INDEX {DATE_INDEX} ON {TABLE} (date)')
+
+    for name, columns, include in INDEXES:
+        sql = f'CREATE INDEX {name} ON {TABLE} ({", ".join(columns)})'
+        if postgresql:
+            sql += f' INCLUDE ({", ".join(include)})'
+        schema_editor.execute(sql)
+
+
+def drop_indexes(apps, schema_editor):
+    for name in (DATE_INDEX, *(name for name, _, _ in INDEXES)):
+        schema_editor.execute(f'DROP INDEX {name}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('usage_info', '0002_auto_20191206_2354'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_indexes, drop_indexes),
+    ]
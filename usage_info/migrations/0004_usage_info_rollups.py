@@ -0,0 +1,121 @@
+# Generated by Django 3.0 on 2026-10-18 19:19
+
+from django.db import migrations, models
+
+
+ROLLUPS = (
+    ('usage_info_usageinfobydate', ('date',)),
+    ('usage_info_usageinfobychannelcountryos', ('channel', 'country', 'os')),
+    ('usage_info_usageinfobydatechannel', ('date', 'channel')),
+    ('usage_info_usageinfobydatecountryos', ('date', 'country', 'os')),
+    ('usage_info_usageinfobydatechannelcountry', ('date', 'channel', 'country')),
+)
+METRICS = ('impressions', 'clicks', 'installs', 'spend', 'revenue')
+
+
+def populate_rollups(apps, schema_editor):
+    metrics = ', '.join(METRICS)
+    sums = ', '.join(f'SUM({field})' for field in METRICS)
+    for table, dimensions in ROLLUPS:
+        dimensions = ', '.join(dimensions)
+        schema_editor.execute(
+            f'INSERT INTO {table} ({dimensions}, {metrics}, record_count) '
+            f'SELECT {dimensions}, {sums}, COUNT(*) FROM usage_info_usageinfo GROUP BY {dimensions}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('usage_info', '0003_usage_info_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UsageInfoByDate',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('impressions', models.BigIntegerField(default=0)),
+                ('clicks', models.BigIntegerField(default=0)),
+                ('installs', models.BigIntegerField(default=0)),
+                ('spend', models.FloatField(default=0)),
+                ('revenue', models.FloatField(default=0)),
+                ('record_count', models.BigIntegerField(default=0)),
+                ('date', models.DateField(unique=True)),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='UsageInfoByDateCountryOs',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('impressions', models.BigIntegerField(default=0)),
+                ('clicks', models.BigIntegerField(default=0)),
+                ('installs', models.BigIntegerField(default=0)),
+                ('spend', models.FloatField(default=0)),
+                ('revenue', models.FloatField(default=0)),
+                ('record_count', models.BigIntegerField(default=0)),
+                ('date', models.DateField()),
+                ('country', models.CharField(max_length=3)),
+                ('os', models.CharField(max_length=60)),
+            ],
+            options={
+                'unique_together': {('date', 'country', 'os')},
+            },
+        ),
+        migrations.CreateModel(
+            name='UsageInfoByDateChannelCountry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('impressions', models.BigIntegerField(default=0)),
+                ('clicks', models.BigIntegerField(default=0)),
+                ('installs', models.BigIntegerField(default=0)),
+                ('spend', models.FloatField(default=0)),
+                ('revenue', models.FloatField(default=0)),
+                ('record_count', models.BigIntegerField(default=0)),
+                ('date', models.DateField()),
+                ('channel', models.CharField(max_length=256)),
+                ('country', models.CharField(max_length=3)),
+            ],
+            options={
+                'unique_together': {('date', 'channel', 'country')},
+            },
+        ),
+        migrations.CreateModel(
+            name='UsageInfoByDateChannel',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('impressions', models.BigIntegerField(default=0)),
+                ('clicks', models.BigIntegerField(default=0)),
+                ('installs', models.BigIntegerField(default=0)),
+                ('spend', models.FloatField(default=0)),
+                ('revenue', models.FloatField(default=0)),
+                ('record_count', models.BigIntegerField(default=0)),
+                ('date', models.DateField()),
+                ('channel', models.CharField(max_length=256)),
+            ],
+            options={
+                'unique_together': {('date', 'channel')},
+            },
+        ),
+        migrations.CreateModel(
+            name='UsageInfoByChannelCountryOs',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('impressions', models.BigIntegerField(default=0)),
+                ('clicks', models.BigIntegerField(default=0)),
+                ('installs', models.BigIntegerField(default=0)),
+                ('spend', models.FloatField(default=0)),
+                ('revenue', models.FloatField(default=0)),
+                ('record_count', models.BigIntegerField(default=0)),
+                ('channel', models.CharField(max_length=256)),
+                ('country', models.CharField(max_length=3)),
+                ('os', models.CharField(max_length=60)),
+            ],
+            options={
+                'unique_together': {('channel', 'country', 'os')},
+            },
+        ),
+        migrations.RunPython(populate_rollups, migrations.RunPython.noop),
+    ]
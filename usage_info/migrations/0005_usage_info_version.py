@@ -0,0 +1,27 @@
+# Generated by Django 3.0 on 2026-10-18 19:21
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+def create_version(apps, schema_editor):
+    apps.get_model('usage_info', 'UsageInfoVersion').objects.create()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('usage_info', '0004_usage_info_rollups'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UsageInfoVersion',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('generation', models.BigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.RunPython(create_version, migrations.RunPython.noop),
+    ]
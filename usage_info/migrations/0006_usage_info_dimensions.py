@@ -0,0 +1,190 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+# channel, country and os move to the dimension tables, the facts and the rollups keep small integer keys
+DIMENSIONS = (
+    # field, dimension model, max length of the name
+    ('channel', 'Channel', 256),
+    ('country', 'Country', 3),
+    ('os', 'OperatingSystem', 60),
+)
+METRICS = ('impressions', 'clicks', 'installs', 'spend', 'revenue')
+TABLE = 'usage_info_usageinfo'
+
+# the indexes of 0003_usage_info_indexes (restored by the reverse migration)
+OLD_INDEXES = (
+    # name, key columns, included columns
+    ('usage_info_channel_cov_idx', ('channel', 'country', 'os', 'date'), METRICS),
+    ('usage_info_country_cov_idx', ('country', 'os', 'date'), ('channel', *METRICS)),
+    ('usage_info_os_cov_idx', ('os', 'date'), ('channel', 'country', *METRICS)),
+)
+# rebuilt on the dimension keys
+INDEXES = (
+    # name, key columns, included columns
+    ('usage_info_channel_cov_idx', ('channel_id', 'country_id', 'os_id', 'date'), METRICS),
+    ('usage_info_country_cov_idx', ('country_id', 'os_id', 'date'), ('channel_id', *METRICS)),
+    ('usage_info_os_cov_idx', ('os_id', 'date'), ('channel_id', 'country_id', *METRICS)),
+)
+DATE_INDEX = 'usage_info_date_brin_idx'
+
+ROLLUPS = (
+    # model, dimensions
+    ('UsageInfoByChannelCountryOs', ('channel', 'country', 'os')),
+    ('UsageInfoByDateChannel', ('date', 'channel')),
+    ('UsageInfoByDateCountryOs', ('date', 'country', 'os')),
+    ('UsageInfoByDateChannelCountry', ('date', 'channel', 'country')),
+)
+
+
+def dimension_tables(apps):
+    return [(field, apps.get_model('usage_info', model_name)._meta.db_table) for field, model_name, _ in DIMENSIONS]
+
+
+def drop_indexes(apps, schema_editor):
+    # the string columns go away (SQLite also rebuilds the table without the custom indexes)
+    for name in (DATE_INDEX, *(name for name, _, _ in INDEXES)):
+        schema_editor.execute(f'DROP INDEX IF EXISTS {name}')
+
+
+def restore_indexes(apps, schema_editor):
+    """Reverse of drop_indexes: the indexes of 0003 and the rollups of 0004 (on the string columns)"""
+    create_indexes(schema_editor, OLD_INDEXES)
+    populate_rollups(apps, schema_editor, lambda field: field)
+
+
+def update_columns(schema_editor, tables, column, value, join):
+    """
+    Set the columns of all the usage info rows in one UPDATE: UPDATE ... FROM <the dimension tables> on PostgreSQL,
+    correlated subqueries (by the unique name or the primary key of a dimension) on the other databases
+
+    :param tables: (field, dimension table) pairs, the dimension tables are aliased as their fields
+    :param column: function of the field -> usage info column to set
+    :param value: column of the dimension table to set it to
+    :param join: function of the field -> condition joining the dimension table
+    """
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(
+            f'UPDATE {TABLE} SET {", ".join(f"{column(field)} = {field}.{value}" for field, _ in tables)} '
+            f'FROM {", ".join(f"{table} {field}" for field, table in tables)} '
+            f'WHERE {" AND ".join(join(field) for field, _ in tables)}')
+    else:
+        columns = ', '.join(f'{column(field)} = (SELECT {field}.{value} FROM {table} {field} WHERE {join(field)})'
+                            for field, table in tables)
+        schema_editor.execute(f'UPDATE {TABLE} SET {columns}')
+
+
+def encode_dimensions(apps, schema_editor):
+    tables = dimension_tables(apps)
+    for field, table in tables:
+        schema_editor.execute(
+            f'INSERT INTO {table} (name) SELECT DISTINCT {field}_name FROM {TABLE} ORDER BY {field}_name')
+    update_columns(
+        schema_editor, tables, lambda field: f'{field}_id', 'id', lambda field: f'{field}.name = {TABLE}.{field}_name')
+
+    if schema_editor.connection.vendor == 'postgresql':
+        # check the deferred foreign keys now, so the table can be altered in the same transaction
+        schema_editor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+
+
+def decode_dimensions(apps, schema_editor):
+    """Reverse of encode_dimensions: the names back to the string columns (the dimension tables are dropped)"""
+    update_columns(
+        schema_editor, dimension_tables(apps),
+        lambda field: f'{field}_name', 'name', lambda field: f'{field}.id = {TABLE}.{field}_id')
+
+
+def populate_rollups(apps, schema_editor, column=lambda field: field if field == 'date' else f'{field}_id'):
+    metrics = ', '.join(METRICS)
+    sums = ', '.join(f'SUM({field})' for field in METRICS)
+    for model_name, dimensions in ROLLUPS:
+        table = apps.get_model('usage_info', model_name)._meta.db_table
+        columns = ', '.join(map(column, dimensions))
+        schema_editor.execute(
+            f'INSERT INTO {table} ({columns}, {metrics}, record_count) '
+            f'SELECT {columns}, {sums}, COUNT(*) FROM {TABLE} GROUP BY {columns}')
+
+
+def create_indexes(schema_editor, indexes=INDEXES):
+    postgresql = schema_editor.connection.vendor == 'postgresql'
+    if postgresql:
+        schema_editor.execute(f'CREATE INDEX {DATE_INDEX} ON {TABLE} USING brin (date)')
+    else:
+        schema_editor.execute(f'CREATE INDEX {DATE_INDEX} ON {TABLE} (date)')
+
+    for name, columns, include in indexes:
+        sql = f'CREATE INDEX {name} ON {TABLE} ({", ".join(columns)})'
+        if postgresql:
+            sql += f' INCLUDE ({", ".join(include)})'
+        schema_editor.execute(sql)
+
+
+def create_new_indexes(apps, schema_editor):
+    create_indexes(schema_editor)
+
+
+def dimension_model(name, max_length, options=None):
+    return migrations.CreateModel(
+        name=name,
+        fields=[
+            ('id', models.SmallAutoField(primary_key=True, serialize=False)),
+            ('name', models.CharField(max_length=max_length, unique=True)),
+        ],
+        options={'abstract': False, **(options or {})},
+    )
+
+
+def dimension_key(model_name, null=False):
+    return models.ForeignKey(
+        null=null, db_index=False, on_delete=django.db.models.deletion.PROTECT,
+        related_name='+', to=f'usage_info.{model_name}')
+
+
+def rollup_model(name, dimensions):
+    dimension_models = {field: model_name for field, model_name, _ in DIMENSIONS}
+    return migrations.CreateModel(
+        name=name,
+        fields=[
+            ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+            ('impressions', models.BigIntegerField(default=0)),
+            ('clicks', models.BigIntegerField(default=0)),
+            ('installs', models.BigIntegerField(default=0)),
+            ('spend', models.FloatField(default=0)),
+            ('revenue', models.FloatField(default=0)),
+            ('record_count', models.BigIntegerField(default=0)),
+            *((field, models.DateField() if field == 'date' else dimension_key(dimension_models[field]))
+              for field in dimensions),
+        ],
+        options={
+            'unique_together': {dimensions},
+        },
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('usage_info', '0005_usage_info_version'),
+    ]
+
+    operations = [
+        migrations.RunPython(drop_indexes, restore_indexes),
+        dimension_model('Channel', 256),
+        dimension_model('Country', 3, {'verbose_name_plural': 'countries'}),
+        dimension_model('OperatingSystem', 60),
+
+        *(migrations.RenameField('UsageInfo', field, f'{field}_name') for field, _, _ in DIMENSIONS),
+        # nullable while the reverse migration fills them
+        *(migrations.AlterField('UsageInfo', f'{field}_name', models.CharField(max_length=max_length, null=True))
+          for field, _, max_length in DIMENSIONS),
+        *(migrations.AddField('UsageInfo', field, dimension_key(model_name, null=True))
+          for field, model_name, _ in DIMENSIONS),
+        migrations.RunPython(encode_dimensions, decode_dimensions),
+        *(migrations.RemoveField('UsageInfo', f'{field}_name') for field, _, _ in DIMENSIONS),
+        *(migrations.AlterField('UsageInfo', field, dimension_key(model_name)) for field, model_name, _ in DIMENSIONS),
+
+        *(migrations.DeleteModel(name) for name, _ in ROLLUPS),
+        *(rollup_model(name, dimensions) for name, dimensions in ROLLUPS),
+        # the reverse migration drops the tables
+        migrations.RunPython(populate_rollups, migrations.RunPython.noop),
+        migrations.RunPython(create_new_indexes, drop_indexes),
+    ]
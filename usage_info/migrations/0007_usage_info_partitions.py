@@ -0,0 +1,94 @@
+from django.db import migrations
+
+# PostgreSQL only: usage_info_usageinfo becomes a table partitioned by month of the date
+# with a usage_info_usageinfo_YYYY_MM partition per month having data and a default partition.
+# The primary key of a partitioned table has to include the partition key: (id, date).
+# New partitions are created by the loader and the manage_usage_info_partitions command.
+TABLE = 'usage_info_usageinfo'
+OLD_TABLE = f'{TABLE}_unpartitioned'
+DEFAULT_PARTITION = f'{TABLE}_default'
+METRICS = ('impressions', 'clicks', 'installs', 'spend', 'revenue')
+
+INDEXES = (
+    # name, key columns, included columns
+    ('usage_info_channel_cov_idx', ('channel_id', 'country_id', 'os_id', 'date'), METRICS),
+    ('usage_info_country_cov_idx', ('country_id', 'os_id', 'date'), ('channel_id', *METRICS)),
+    ('usage_info_os_cov_idx', ('os_id', 'date'), ('channel_id', 'country_id', *METRICS)),
+)
+DATE_INDEX = 'usage_info_date_brin_idx'
+FOREIGN_KEYS = (
+    # column, referenced table
+    ('channel_id', 'usage_info_channel'),
+    ('country_id', 'usage_info_country'),
+    ('os_id', 'usage_info_operatingsystem'),
+)
+
+
+def drop_indexes(schema_editor):
+    for name in (DATE_INDEX, *(name for name, _, _ in INDEXES)):
+        schema_editor.execute(f'DROP INDEX IF EXISTS {name}')
+
+
+def create_indexes(schema_editor):
+    # indexes of a partitioned table are created on every partition
+    schema_editor.execute(f'CREATE INDEX {DATE_INDEX} ON {TABLE} USING brin (date)')
+    for name, columns, include in INDEXES:
+        schema_editor.execute(
+            f'CREATE INDEX {name} ON {TABLE} ({", ".join(columns)}) INCLUDE ({", ".join(include)})')
+
+
+def add_foreign_keys(schema_editor):
+    for column, table in FOREIGN_KEYS:
+        schema_editor.execute(
+            f'ALTER TABLE {TABLE} ADD CONSTRAINT {TABLE}_{column}_fk FOREIGN KEY ({column}) '
+            f'REFERENCES {table} (id) DEFERRABLE INITIALLY DEFERRED')
+
+
+def replace_table(schema_editor, partitioned):
+    drop_indexes(schema_editor)
+    schema_editor.execute(f'ALTER TABLE {TABLE} RENAME TO {OLD_TABLE}')
+    schema_editor.execute(
+        f'CREATE TABLE {TABLE} (LIKE {OLD_TABLE} INCLUDING DEFAULTS)'
+        + (' PARTITION BY RANGE (date)' if partitioned else ''))
+    # keep the id sequence when the old table is dropped
+    schema_editor.execute(f'ALTER SEQUENCE {TABLE}_id_seq OWNED BY {TABLE}.id')
+
+    if partitioned:
+        schema_editor.execute(f'CREATE TABLE {DEFAULT_PARTITION} PARTITION OF {TABLE} DEFAULT')
+        with schema_editor.connection.cursor() as cursor:
+            cursor.execute(
+                f"SELECT DISTINCT to_char(date, 'YYYY_MM'), date_trunc('month', date)::date, "
+                f"(date_trunc('month', date) + interval '1 month')::date FROM {OLD_TABLE}")
+            months = cursor.fetchall()
+        for suffix, start, end in months:
+            schema_editor.execute(
+                f"CREATE TABLE {TABLE}_{suffix} PARTITION OF {TABLE} FOR VALUES FROM ('{start}') TO ('{end}')")
+
+    schema_editor.execute(f'INSERT INTO {TABLE} SELECT * FROM {OLD_TABLE}')
+    schema_editor.execute(f'DROP TABLE {OLD_TABLE}')
+
+    # the constraints and indexes are built once the data is copied (and their names are free again)
+    schema_editor.execute(f'ALTER TABLE {TABLE} ADD PRIMARY KEY ({"id, date" if partitioned else "id"})')
+    add_foreign_keys(schema_editor)
+    create_indexes(schema_editor)
+
+
+def partition_table(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        replace_table(schema_editor, partitioned=True)
+
+
+def unpartition_table(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        replace_table(schema_editor, partitioned=False)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('usage_info', '0006_usage_info_dimensions'),
+    ]
+
+    operations = [
+        migrations.RunPython(partition_table, unpartition_table),
+    ]
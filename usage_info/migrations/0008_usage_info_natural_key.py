@@ -0,0 +1,64 @@
+from django.db import IntegrityError, migrations
+
+# The natural key of a usage info row is (date, channel, country, os): the covering index on these columns
+# becomes unique, so re-delivered feed files can be upserted (INSERT ... ON CONFLICT, see ingest.upsert_rows).
+# The rows loaded more than once before stop the migration: which of them are right (the last delivery,
+# the sum of partial ones) is up to the operator, so their keys are listed and no data is changed.
+TABLE = 'usage_info_usageinfo'
+METRICS = ('impressions', 'clicks', 'installs', 'spend', 'revenue')
+INDEX = 'usage_info_channel_cov_idx'
+KEY = ('channel_id', 'country_id', 'os_id', 'date')
+MAX_LISTED_KEYS = 50
+
+
+def check_duplicates(apps, schema_editor):
+    tables = {field: apps.get_model('usage_info', model_name)._meta.db_table
+              for field, model_name in (('channel', 'Channel'), ('country', 'Country'), ('os', 'OperatingSystem'))}
+    key = ', '.join(('u.date', *(f'{field}.name' for field in tables)))
+    joins = ' '.join(f'JOIN {table} {field} ON {field}.id = u.{field}_id' for field, table in tables.items())
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(
+            f'SELECT {key}, COUNT(*), MIN(u.id), MAX(u.id) FROM {TABLE} u {joins} '
+            f'GROUP BY {key} HAVING COUNT(*) > 1 ORDER BY {key}')
+        duplicates = cursor.fetchall()
+    if not duplicates:
+        return
+
+    lines = [f'  {date} {channel} {country} {os}: {count} rows (ids {first_id}..{last_id})'
+             for date, channel, country, os, count, first_id, last_id in duplicates[:MAX_LISTED_KEYS]]
+    if len(duplicates) > MAX_LISTED_KEYS:
+        lines.append(f'  ... and {len(duplicates) - MAX_LISTED_KEYS} more')
+    raise IntegrityError(
+        f'{len(duplicates)} natural keys (date, channel, country, os) of {TABLE} have more than one row, '
+        f'the key cannot be made unique. Delete or merge the rows (e.g. keep the last loaded one, the largest id), '
+        f'run the migrations again and rebuild the rollups (manage.py rebuild_usage_info_rollups):\n'
+        + '\n'.join(lines))
+
+
+def create_index(schema_editor, unique):
+    sql = f'CREATE {"UNIQUE " if unique else ""}INDEX {INDEX} ON {TABLE} ({", ".join(KEY)})'
+    if schema_editor.connection.vendor == 'postgresql':
+        sql += f' INCLUDE ({", ".join(METRICS)})'
+    schema_editor.execute(f'DROP INDEX {INDEX}')
+    schema_editor.execute(sql)
+
+
+def make_unique(apps, schema_editor):
+    create_index(schema_editor, unique=True)
+
+
+def make_not_unique(apps, schema_editor):
+    create_index(schema_editor, unique=False)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('usage_info', '0007_usage_info_partitions'),
+    ]
+
+    operations = [
+        # the check doesn't change the data: nothing to undo
+        migrations.RunPython(check_duplicates, migrations.RunPython.noop),
+        migrations.RunPython(make_unique, make_not_unique),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 3.0 on 2026-10-18 20:35
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('usage_info', '0008_usage_info_natural_key'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UsageInfoLoadedChunk',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source', models.CharField(max_length=40)),
+                ('path', models.TextField()),
+                ('start', models.BigIntegerField()),
+                ('end', models.BigIntegerField()),
+                ('rows', models.IntegerField()),
+                ('rejected', models.IntegerField(default=0)),
+                ('loaded_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+            options={
+                'unique_together': {('source', 'start')},
+            },
+        ),
+    ]
@@ -0,0 +1,58 @@
+# Generated by Django 3.0 on 2026-10-18 21:10
+
+from django.db import migrations, models
+
+# the derived metrics of the rollup rows (see usage_info/derived.py): numerator, denominator, scale
+DERIVED_METRICS = {
+    'cpi': ('spend', 'installs', 1),
+    'ctr': ('clicks', 'impressions', 1),
+    'ipm': ('installs', 'impressions', 1000),
+    'roas': ('revenue', 'spend', 1),
+}
+ROLLUPS = (
+    ('UsageInfoByDate', 'usage_info_usageinfobydate'),
+    ('UsageInfoByChannelCountryOs', 'usage_info_usageinfobychannelcountryos'),
+    ('UsageInfoByDateChannel', 'usage_info_usageinfobydatechannel'),
+    ('UsageInfoByDateCountryOs', 'usage_info_usageinfobydatecountryos'),
+    ('UsageInfoByDateChannelCountry', 'usage_info_usageinfobydatechannelcountry'),
+)
+
+
+def derived_sql(numerator, denominator, scale):
+    numerator = f'CAST({numerator} AS DOUBLE PRECISION)'
+    if scale != 1:
+        numerator = f'{numerator} * {scale}'
+    return f'{numerator} / NULLIF({denominator}, 0)'
+
+
+def populate_derived_metrics(apps, schema_editor):
+    updates = ', '.join(f'{name} = {derived_sql(*metric)}' for name, metric in DERIVED_METRICS.items())
+    for _, table in ROLLUPS:
+        schema_editor.execute(f'UPDATE {table} SET {updates}')
+
+
+def create_indexes(apps, schema_editor):
+    # sort_by=<derived metric> of the groups read row by row from a rollup (see query.build_queryset)
+    for _, table in ROLLUPS:
+        for name in DERIVED_METRICS:
+            schema_editor.execute(f'CREATE INDEX {table}_{name}_idx ON {table} ({name})')
+
+
+def drop_indexes(apps, schema_editor):
+    for _, table in ROLLUPS:
+        for name in DERIVED_METRICS:
+            schema_editor.execute(f'DROP INDEX {table}_{name}_idx')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('usage_info', '0009_usage_info_loaded_chunks'),
+    ]
+
+    operations = [
+        *(migrations.AddField(model_name=model_name, name=name, field=models.FloatField(null=True))
+          for model_name, _ in ROLLUPS for name in DERIVED_METRICS),
+        migrations.RunPython(populate_derived_metrics, migrations.RunPython.noop),
+        migrations.RunPython(create_indexes, drop_indexes),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 3.0 on 2026-10-18 21:16
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def dimension_key(model_name):
+    return models.ForeignKey(
+        null=True, db_index=False, on_delete=django.db.models.deletion.PROTECT,
+        related_name='+', to=f'usage_info.{model_name}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('usage_info', '0010_usage_info_derived_metrics'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UsageInfoRollupDelta',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('rollup', models.CharField(max_length=64)),
+                ('date', models.DateField(null=True)),
+                ('channel', dimension_key('Channel')),
+                ('country', dimension_key('Country')),
+                ('os', dimension_key('OperatingSystem')),
+                ('impressions', models.BigIntegerField(default=0)),
+                ('clicks', models.BigIntegerField(default=0)),
+                ('installs', models.BigIntegerField(default=0)),
+                ('spend', models.FloatField(default=0)),
+                ('revenue', models.FloatField(default=0)),
+                ('record_count', models.BigIntegerField(default=0)),
+            ],
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 3.0 on 2026-10-18 23:05
+
+from django.db import migrations
+
+DERIVED_METRICS = ('cpi', 'ctr', 'ipm', 'roas')
+ROLLUP_TABLES = (
+    'usage_info_usageinfobydate',
+    'usage_info_usageinfobychannelcountryos',
+    'usage_info_usageinfobydatechannel',
+    'usage_info_usageinfobydatecountryos',
+    'usage_info_usageinfobydatechannelcountry',
+)
+
+
+def create_indexes(apps, schema_editor):
+    # sort_by=-<derived metric> has the NULLs last (see query.order_by_expression), a backward scan of the
+    # ascending index of 0010 has them first on PostgreSQL
+    if schema_editor.connection.vendor == 'postgresql':
+        for table in ROLLUP_TABLES:
+            for name in DERIVED_METRICS:
+                schema_editor.execute(f'CREATE INDEX {table}_{name}_desc_idx ON {table} ({name} DESC NULLS LAST)')
+
+
+def drop_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        for table in ROLLUP_TABLES:
+            for name in DERIVED_METRICS:
+                schema_editor.execute(f'DROP INDEX {table}_{name}_desc_idx')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('usage_info', '0011_usage_info_rollup_deltas'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_indexes, drop_indexes),
+    ]
@@ -1,11 +1,39 @@
 from django.db import models
+from django.utils import timezone
+
+
+class Dimension(models.Model):
+    """Dictionary of the values of a usage info dimension, the facts keep small integer keys (see dimensions.py)"""
+    id = models.SmallAutoField(primary_key=True)
+
+    class Meta:
+        abstract = True
+
+    def __str__(self):
+        return self.name
+
+
+class Channel(Dimension):
+    name = models.CharField(max_length=256, unique=True)
+
+
+class Country(Dimension):
+    name = models.CharField(max_length=3, unique=True)
+
+    class Meta:
+        verbose_name_plural = 'countries'
+
+
+class OperatingSystem(Dimension):
+    name = models.CharField(max_length=60, unique=True)
 
 
 class UsageInfo(models.Model):
     date = models.DateField(blank=False)
-    channel = models.CharField(max_length=256, blank=False)
-    country = models.CharField(max_length=3, blank=False)
-    os = models.CharField(max_length=60, blank=False)
+    # the composite indexes (see migrations) cover the dimension keys
+    channel = models.ForeignKey(Channel, on_delete=models.PROTECT, db_index=False, related_name='+')
+    country = models.ForeignKey(Country, on_delete=models.PROTECT, db_index=False, related_name='+')
+    os = models.ForeignKey(OperatingSystem, on_delete=models.PROTECT, db_index=False, related_name='+')
     impressions = models.PositiveIntegerField(blank=False)
     clicks = models.PositiveIntegerField(blank=False)
     installs = models.PositiveIntegerField(blank=False)
@@ -14,3 +42,123 @@ class UsageInfo(models.Model):
 
     def __str__(self):
         return f'{self.date} {self.channel} {self.os} {self.country}'
+
+
+class UsageInfoRollup(models.Model):
+    """Pre-aggregated usage info metrics for a subset of the dimensions (see rollups.py)"""
+    dimensions: tuple = ()
+
+    impressions = models.BigIntegerField(default=0)
+    clicks = models.BigIntegerField(default=0)
+    installs = models.BigIntegerField(default=0)
+    spend = models.FloatField(default=0)
+    revenue = models.FloatField(default=0)
+    record_count = models.BigIntegerField(default=0)  # number of aggregated UsageInfo rows
+    # derived metrics of the sums (see derived.py), indexed for sort_by (see migrations)
+    cpi = models.FloatField(null=True)
+    ctr = models.FloatField(null=True)
+    ipm = models.FloatField(null=True)
+    roas = models.FloatField(null=True)
+
+    class Meta:
+        abstract = True
+
+    def __str__(self):
+        return ' '.join(str(getattr(self, field)) for field in self.dimensions)
+
+
+class UsageInfoByDate(UsageInfoRollup):
+    dimensions = ('date',)
+
+    date = models.DateField(unique=True)
+
+
+class UsageInfoByChannelCountryOs(UsageInfoRollup):
+    dimensions = ('channel', 'country', 'os')
+
+    channel = models.ForeignKey(Channel, on_delete=models.PROTECT, db_index=False, related_name='+')
+    country = models.ForeignKey(Country, on_delete=models.PROTECT, db_index=False, related_name='+')
+    os = models.ForeignKey(OperatingSystem, on_delete=models.PROTECT, db_index=False, related_name='+')
+
+    class Meta:
+        unique_together = ('channel', 'country', 'os')
+
+
+class UsageInfoByDateChannel(UsageInfoRollup):
+    dimensions = ('date', 'channel')
+
+    date = models.DateField()
+    channel = models.ForeignKey(Channel, on_delete=models.PROTECT, db_index=False, related_name='+')
+
+    class Meta:
+        unique_together = ('date', 'channel')
+
+
+class UsageInfoByDateCountryOs(UsageInfoRollup):
+    dimensions = ('date', 'country', 'os')
+
+    date = models.DateField()
+    country = models.ForeignKey(Country, on_delete=models.PROTECT, db_index=False, related_name='+')
+    os = models.ForeignKey(OperatingSystem, on_delete=models.PROTECT, db_index=False, related_name='+')
+
+    class Meta:
+        unique_together = ('date', 'country', 'os')
+
+
+class UsageInfoByDateChannelCountry(UsageInfoRollup):
+    dimensions = ('date', 'channel', 'country')
+
+    date = models.DateField()
+    channel = models.ForeignKey(Channel, on_delete=models.PROTECT, db_index=False, related_name='+')
+    country = models.ForeignKey(Country, on_delete=models.PROTECT, db_index=False, related_name='+')
+
+    class Meta:
+        unique_together = ('date', 'channel', 'country')
+
+
+class UsageInfoVersion(models.Model):
+    """Data generation of the UsageInfo table (single row), bumped by every change (see cache.py)"""
+    generation = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return f'{self.generation} ({self.updated_at})'
+
+
+class UsageInfoLoadedChunk(models.Model):
+    """Byte range of a CSV file loaded by the parallel ingestion (see pipeline.py), committed with its rows"""
+    source = models.CharField(max_length=40)  # fingerprint of the file
+    path = models.TextField()
+    start = models.BigIntegerField()
+    end = models.BigIntegerField()
+    rows = models.IntegerField()
+    rejected = models.IntegerField(default=0)
+    loaded_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        unique_together = ('source', 'start')
+
+    def __str__(self):
+        return f'{self.path} [{self.start}, {self.end})'
+
+
+class UsageInfoRollupDelta(models.Model):
+    """
+    Change of a rollup row committed by a chunk of the parallel ingestion along with its rows,
+    added to the rollup once the chunks are loaded (see rollups.apply_pending)
+    """
+    rollup = models.CharField(max_length=64)  # db table of the rollup
+    # the dimensions of the rollup, the other ones are NULL
+    date = models.DateField(null=True)
+    channel = models.ForeignKey(Channel, null=True, on_delete=models.PROTECT, db_index=False, related_name='+')
+    country = models.ForeignKey(Country, null=True, on_delete=models.PROTECT, db_index=False, related_name='+')
+    os = models.ForeignKey(OperatingSystem, null=True, on_delete=models.PROTECT, db_index=False, related_name='+')
+    impressions = models.BigIntegerField(default=0)
+    clicks = models.BigIntegerField(default=0)
+    installs = models.BigIntegerField(default=0)
+    spend = models.FloatField(default=0)
+    revenue = models.FloatField(default=0)
+    record_count = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return f'{self.rollup} {self.date} {self.channel_id} {self.country_id} {self.os_id}'
@@ -0,0 +1,153 @@
+import json
+import base64
+import typing as typ
+from collections import OrderedDict
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import F, Q, query
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import LimitOffsetPagination
+from rest_framework.request import Request
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param, remove_query_param
+
+from .models import UsageInfoRollup
+from .query import ordering_fields
+
+Ordering = typ.List[typ.Tuple[str, bool]]  # (field, descending)
+
+
+class UsageInfoPagination(LimitOffsetPagination):
+    """
+    LimitOffsetPagination with an opt-in keyset (cursor) mode, turned on with 'pagination=cursor'.
+
+    In the cursor mode the page is found by seeking right after (or before) the values of the ordering
+    fields of the last (first) row of the previous page, so there is neither COUNT(*) nor OFFSET scan.
+    The ordering is completed with a tiebreaker (primary key for not grouped rows, the grouped fields are
+    already in the ordering for grouped ones and for the rows of a rollup) and NULLs (e.g. CPI with no installs)
+    are always sorted last.
+    """
+    mode_query_param = 'pagination'
+    cursor_query_param = 'cursor'
+    invalid_cursor_message = 'Invalid cursor'
+
+    keyset = False
+
+    def paginate_queryset(self, queryset: query.QuerySet, request: Request, view=None) -> typ.Optional[list]:
+        self.keyset = request.query_params.get(self.mode_query_param) == 'cursor'
+        if not self.keyset:
+            return super().paginate_queryset(queryset, request, view)
+
+        self.limit = self.get_limit(request)
+        if self.limit is None:
+            return None
+        self.request = request
+        self.display_page_controls = False
+
+        ordering = self.get_ordering(queryset)
+        position, reverse = self.decode_cursor(request, len(ordering))
+        if position is not None:
+            queryset = queryset.filter(self.seek(ordering, position, reverse))
+        queryset = queryset.order_by(*(
+            F(field).asc(nulls_first=True) if descending else F(field).desc(nulls_first=True)
+            for field, descending in ordering
+        ) if reverse else (
+            F(field).desc(nulls_last=True) if descending else F(field).asc(nulls_last=True)
+            for field, descending in ordering
+        ))
+
+        rows = list(queryset[:self.limit + 1])
+        has_more = len(rows) > self.limit
+        rows = rows[:self.limit]
+        if reverse:
+            rows.reverse()
+
+        self.next_position = self.get_position(rows[-1], ordering) \
+            if rows and (has_more or reverse) else None
+        self.previous_position = self.get_position(rows[0], ordering) \
+            if rows and (position is not None and not reverse or reverse and has_more) else None
+        return rows
+
+    def get_paginated_response(self, data) -> Response:
+        if not self.keyset:
+            return super().get_paginated_response(data)
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('results', data),
+        ]))
+
+    def get_next_link(self) -> typ.Optional[str]:
+        if not self.keyset:
+            return super().get_next_link()
+        return self.encode_cursor(self.next_position, reverse=False)
+
+    def get_previous_link(self) -> typ.Optional[str]:
+        if not self.keyset:
+            return super().get_previous_link()
+        return self.encode_cursor(self.previous_position, reverse=True)
+
+    @staticmethod
+    def get_ordering(queryset: query.QuerySet) -> Ordering:
+        """Get the ordering fields of the queryset completed with a unique tiebreaker"""
+        ordering = [(field.lstrip('-'), field.startswith('-')) for field in ordering_fields(queryset)]
+        grouped = queryset.query.group_by is not None or issubclass(queryset.model, UsageInfoRollup)
+        if not grouped and not any(field in ('pk', 'id') for field, _ in ordering):
+            ordering.append(('id', False))
+        return ordering
+
+    @staticmethod
+    def get_position(row: typ.Union[dict, typ.Any], ordering: Ordering) -> list:
+        return [row[field] if isinstance(row, dict) else getattr(row, field) for field, _ in ordering]
+
+    @staticmethod
+    def seek(ordering: Ordering, position: list, reverse: bool) -> Q:
+        """Build a condition selecting the rows after (before if reverse) the position
+
+        :param ordering: ordering fields
+        :param position: values of the ordering fields
+        :param reverse: select the rows before the position
+        :return: condition
+        """
+        condition, equal = Q(), Q()
+        for (field, descending), value in zip(ordering, position):
+            if value is None:
+                # NULLs are the last ones: nothing is after them, all the values are before
+                if reverse:
+                    condition |= equal & Q(**{f'{field}__isnull': False})
+                equal &= Q(**{f'{field}__isnull': True})
+                continue
+
+            after = Q(**{f'{field}__{"lt" if descending else "gt"}': value})
+            before = Q(**{f'{field}__{"gt" if descending else "lt"}': value})
+            condition |= equal & (before if reverse else after | Q(**{f'{field}__isnull': True}))
+            equal &= Q(**{field: value})
+        return condition
+
+    def encode_cursor(self, position: typ.Optional[list], reverse: bool) -> typ.Optional[str]:
+        if position is None:
+            return None
+        cursor = base64.urlsafe_b64encode(
+            json.dumps({'p': position, 'r': reverse}, cls=DjangoJSONEncoder).encode()).decode()
+        url = remove_query_param(self.request.build_absolute_uri(), self.offset_query_param)
+        return replace_query_param(url, self.cursor_query_param, cursor)
+
+    def decode_cursor(self, request: Request, size: int) -> typ.Tuple[typ.Optional[list], bool]:
+        """Decode the cursor from the request
+
+        :param request: request
+        :param size: number of the ordering fields
+        :return: position (None for the first page) and the reverse flag
+        :raise NotFound: if the cursor is not valid
+        """
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None, False
+        try:
+            cursor = json.loads(base64.urlsafe_b64decode(encoded.encode()).decode())
+            position, reverse = cursor['p'], bool(cursor['r'])
+        except (TypeError, ValueError, KeyError, UnicodeError):
+            raise NotFound(self.invalid_cursor_message)
+        if not isinstance(position, list) or len(position) != size:
+            raise NotFound(self.invalid_cursor_message)
+        return position, reverse
@@ -0,0 +1,151 @@
+import re
+import datetime
+import typing as typ
+
+from django.db import connection, transaction
+
+from .dimensions import DIMENSION_MODELS
+from .models import UsageInfo
+
+# On PostgreSQL the usage info table is partitioned by month of the date (see migration 0007):
+# usage_info_usageinfo_YYYY_MM partitions and a default one catching the dates of the missing months.
+TABLE = UsageInfo._meta.db_table
+DEFAULT_PARTITION = f'{TABLE}_default'
+PARTITION_NAME_RE = re.compile(rf'^{TABLE}_(\d{{4}})_(\d{{2}})$')
+
+
+def is_partitioned() -> bool:
+    """Check if the usage info table is a partitioned (PostgreSQL) table"""
+    if connection.vendor != 'postgresql':
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)', [TABLE])
+        row = cursor.fetchone()
+    return row is not None and row[0] == 'p'
+
+
+def month_start(date: datetime.date) -> datetime.date:
+    return date.replace(day=1)
+
+
+def add_months(month: datetime.date, months: int) -> datetime.date:
+    year, month_index = divmod(month.year * 12 + month.month - 1 + months, 12)
+    return datetime.date(year, month_index + 1, 1)
+
+
+def partition_name(month: datetime.date) -> str:
+    return f'{TABLE}_{month:%Y_%m}'
+
+
+def list_partitions() -> typ.Dict[datetime.date, str]:
+    """
+    Get the monthly partitions attached to the usage info table
+
+    :return: first day of the month -> partition table name (the default partition is not included)
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT child.relname FROM pg_inherits '
+            'JOIN pg_class parent ON parent.oid = pg_inherits.inhparent '
+            'JOIN pg_class child ON child.oid = pg_inherits.inhrelid '
+            'WHERE parent.oid = to_regclass(%s)', [TABLE])
+        names = [name for name, in cursor.fetchall()]
+
+    partitions = {}
+    for name in names:
+        match = PARTITION_NAME_RE.match(name)
+        if match:
+            partitions[datetime.date(int(match.group(1)), int(match.group(2)), 1)] = name
+    return partitions
+
+
+def create_partition(month: datetime.date) -> str:
+    """
+    Create the partition of the month, the rows of the month are moved there from the default partition
+
+    :param month: any day of the month
+    :return: partition table name
+    """
+    month = month_start(month)
+    name = partition_name(month)
+    quote = connection.ops.quote_name
+    bounds = [month.isoformat(), add_months(month, 1).isoformat()]
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(f'CREATE TABLE {quote(name)} (LIKE {quote(TABLE)} INCLUDING DEFAULTS)')
+        # the check constraint lets ATTACH skip the validation scan of the new partition
+        cursor.execute(
+            f'ALTER TABLE {quote(name)} ADD CONSTRAINT {quote(f"{name}_date_check")} '
+            f'CHECK (date >= %s AND date < %s)', bounds)
+        cursor.execute(
+            f'WITH moved AS (DELETE FROM {quote(DEFAULT_PARTITION)} WHERE date >= %s AND date < %s RETURNING *) '
+            f'INSERT INTO {quote(name)} SELECT * FROM moved', bounds)
+        cursor.execute(
+            f'ALTER TABLE {quote(TABLE)} ATTACH PARTITION {quote(name)} FOR VALUES FROM (%s) TO (%s)', bounds)
+        cursor.execute(f'ALTER TABLE {quote(name)} DROP CONSTRAINT {quote(f"{name}_date_check")}')
+    return name
+
+
+def ensure_partitions(dates: typ.Iterable[datetime.date],
+                      existing: typ.Optional[typ.Set[datetime.date]] = None) -> typ.List[str]:
+    """
+    Create the missing partitions of the months of the dates
+
+    :param dates: dates (or ISO date strings)
+    :param existing: months known to have a partition (updated with the created ones)
+    :return: names of the created partitions
+    """
+    if existing is None:
+        existing = set(list_partitions())
+    months = {month_start(datetime.date.fromisoformat(date) if isinstance(date, str) else date) for date in dates}
+    created = []
+    for month in sorted(months.difference(existing)):
+        created.append(create_partition(month))
+        existing.add(month)
+    return created
+
+
+def detach_partition(month: datetime.date) -> str:
+    """
+    Detach the partition of the month, it stays as a standalone table
+
+    :param month: first day of the month
+    :return: partition table name
+    """
+    name = partition_name(month)
+    quote = connection.ops.quote_name
+    with connection.cursor() as cursor:
+        cursor.execute(f'ALTER TABLE {quote(TABLE)} DETACH PARTITION {quote(name)}')
+    return name
+
+
+def archive_table(name: str, file: typ.TextIO, fields: typ.Sequence[str]) -> None:
+    """
+    Write the rows of a (detached) partition to a CSV file with a header line,
+    the dimensions are written by their names
+
+    :param name: partition table name
+    :param file: opened text file
+    :param fields: usage info fields in the order of the CSV columns
+    """
+    quote = connection.ops.quote_name
+    columns, joins = [], []
+    for field in fields:
+        if field in DIMENSION_MODELS:
+            table = DIMENSION_MODELS[field]._meta.db_table
+            column = UsageInfo._meta.get_field(field).column
+            joins.append(f'JOIN {quote(table)} ON {quote(table)}.id = {quote(name)}.{quote(column)}')
+            columns.append(f'{quote(table)}.name')
+        else:
+            columns.append(f'{quote(name)}.{quote(field)}')
+    file.write(','.join(fields) + '\n')
+    with connection.cursor() as cursor:
+        cursor.copy_expert(
+            f'COPY (SELECT {", ".join(columns)} FROM {quote(name)} {" ".join(joins)} '
+            f'ORDER BY {quote(name)}.id) TO STDOUT WITH (FORMAT csv)', file)
+
+
+def drop_table(name: str) -> None:
+    with connection.cursor() as cursor:
+        # the deferred foreign key checks of the rows written in the same transaction block DROP TABLE
+        cursor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+        cursor.execute(f'DROP TABLE {connection.ops.quote_name(name)}')
@@ -0,0 +1,273 @@
+"""
+Parallel, resumable loading of big usage info CSV files.
+
+The file is split into byte ranges ending at line ends (chunks). Every chunk is read, parsed and validated
+by a process of a pool, then loaded by the same process in its own transaction (see ingest.load_rows),
+so the CPU work scales with the processes. At most `connections` chunks are written at once (the other
+processes keep parsing), a process closes its database connection after its chunk.
+
+The chunk transactions don't update the rows shared by all the chunks, so they don't wait for each other:
+the new dimension names are committed before the chunk, the changes of the rollups are inserted as pending deltas
+(see rollups.store_delta) and the data version isn't bumped. The deltas are added to the rollups and the version
+is bumped once, in a short transaction after the chunks (see apply_pending). Until then the grouped queries
+answered by the rollups and the cached responses don't have the loaded chunks yet.
+
+The chunk transaction records the chunk in UsageInfoLoadedChunk, so an interrupted load (a crash, an invalid
+row, a database error) continues where it stopped: the loaded chunks of the file (recognized by its size and
+its first and last megabyte) are skipped and the rest of the file is split again. A changed file is loaded
+from the start, use upsert to reload it over the loaded rows. The pending deltas of the loaded chunks are applied
+when the load stops, the ones left by a killed load are applied by the next one.
+
+The records must not have quoted line breaks (the feed files don't).
+"""
+import io
+import os
+import csv
+import time
+import hashlib
+import contextlib
+import multiprocessing
+import typing as typ
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import django
+from django.apps import apps
+from django.db import DatabaseError, connection, connections, transaction
+
+from . import cache, partitions, rollups
+from .dimensions import DIMENSION_MODELS, DimensionEncoder
+from .ingest import COLUMNS, LoadStats, Row, check_header, load_rows, read_rows
+from .models import UsageInfoLoadedChunk, UsageInfoRollupDelta
+from .validator import ValidationError
+
+DEFAULT_CHUNK_BYTES = 16 * 1024 * 1024
+# bytes of the start and of the end of a file hashed to recognize it
+FINGERPRINT_BYTES = 1024 * 1024
+
+ByteRange = typ.Tuple[int, int]
+# the LoadStats fields summed over the chunks
+SUMMED_STATS = ('rows', 'rejected', 'chunks', 'inserted', 'updated', 'unchanged')
+
+
+class ChunkOptions(typ.NamedTuple):
+    skip_invalid: bool = False
+    upsert: bool = False
+
+
+# limits the processes writing to the database at once (set in the pool processes)
+_connection_slots = None
+
+
+def fingerprint(file: typ.BinaryIO) -> str:
+    """Hash the size, the first and the last megabyte of the file"""
+    size = file.seek(0, os.SEEK_END)
+    digest = hashlib.sha1(str(size).encode())
+    for offset in (0, max(size - FINGERPRINT_BYTES, 0)):
+        file.seek(offset)
+        digest.update(file.read(FINGERPRINT_BYTES))
+    return digest.hexdigest()
+
+
+def split_ranges(file: typ.BinaryIO, start: int, end: int, chunk_bytes: int) -> typ.List[ByteRange]:
+    """
+    Split the part of the file into chunks of about chunk_bytes ending at line ends
+
+    :param file: file opened in binary mode
+    :param start: offset of a line start
+    :param end: offset of a line end (or of the end of the file)
+    :param chunk_bytes: chunk size, bytes
+    :return: [start, end) byte ranges
+    """
+    ranges = []
+    while start < end:
+        boundary = start + chunk_bytes
+        if boundary < end:
+            file.seek(boundary)
+            file.readline()
+            boundary = file.tell()
+        boundary = min(boundary, end)
+        ranges.append((start, boundary))
+        start = boundary
+    return ranges
+
+
+def pending_ranges(file: typ.BinaryIO, loaded: typ.Iterable[ByteRange], chunk_bytes: int) -> typ.List[ByteRange]:
+    """
+    Split the records of a CSV file not loaded yet into chunks
+
+    :param file: file opened in binary mode
+    :param loaded: byte ranges loaded already
+    :param chunk_bytes: chunk size, bytes
+    :return: byte ranges to load
+    :raise ValidationError: if the header is not correct
+    """
+    file.seek(0)
+    check_header(next(csv.reader([file.readline().decode()]), None))
+    position = file.tell()
+    size = file.seek(0, os.SEEK_END)
+    ranges = []
+    for start, end in sorted(loaded):
+        ranges.extend(split_ranges(file, position, start, chunk_bytes))
+        position = max(position, end)
+    ranges.extend(split_ranges(file, position, size, chunk_bytes))
+    return ranges
+
+
+def parse_range(path: str, byte_range: ByteRange, skip_invalid: bool = False) -> typ.Tuple[typ.List[Row], int]:
+    """
+    Read and validate the records of a chunk of a CSV file
+
+    :param path: CSV file path
+    :param byte_range: chunk
+    :param skip_invalid: skip (and count) invalid rows instead of failing
+    :return: converted rows and the number of the skipped ones
+    :raise ValidationError: if a row is not valid and skip_invalid is off
+    """
+    start, end = byte_range
+    with open(path, 'rb') as file:
+        file.seek(start)
+        content = file.read(end - start).decode()
+    rejected = []
+    try:
+        rows = list(read_rows(io.StringIO(content, newline=''), skip_invalid, rejected, header=False))
+    except ValidationError as err:
+        raise ValidationError(f'Chunk at byte {start}: {err}')
+    return rows, len(rejected)
+
+
+def load_range(path: str, source: str, byte_range: ByteRange, options: ChunkOptions) -> LoadStats:
+    """
+    Parse a chunk of a CSV file and load it along with its UsageInfoLoadedChunk and its pending rollup deltas
+    in one transaction
+
+    :param path: CSV file path
+    :param source: fingerprint of the file
+    :param byte_range: chunk
+    :param options: load options
+    :return: load statistics of the chunk
+    """
+    started = time.perf_counter()
+    rows, rejected = parse_range(path, byte_range, options.skip_invalid)
+    counts = Counter()
+    with _connection_slots if _connection_slots is not None else contextlib.nullcontext():
+        try:
+            if partitions.is_partitioned():
+                ensure_partitions({row[0] for row in rows})
+            add_dimension_names(rows)
+            with transaction.atomic():
+                loaded, _ = load_rows(rows, upsert=options.upsert, counts=counts, deferred=True)
+                UsageInfoLoadedChunk.objects.create(
+                    source=source, path=path, start=byte_range[0], end=byte_range[1], rows=loaded, rejected=rejected)
+        finally:
+            if _connection_slots is not None:
+                connection.close()
+    return LoadStats(rows=loaded, rejected=rejected, chunks=1, seconds=time.perf_counter() - started, **counts)
+
+
+def ensure_partitions(dates: typ.Set[str]) -> None:
+    """Create the missing monthly partitions before the chunk transaction (visible to the other processes)"""
+    try:
+        partitions.ensure_partitions(dates)
+    except DatabaseError:
+        # another process has created one of them meanwhile
+        partitions.ensure_partitions(dates)
+
+
+def add_dimension_names(rows: typ.Sequence[Row]) -> None:
+    """
+    Insert the new channels, countries and operating systems of the chunk in their own short transaction
+    (the chunk transactions inserting the same new names would wait for each other until the commit)
+    """
+    encoder = DimensionEncoder()
+    with transaction.atomic():
+        for field in DIMENSION_MODELS:
+            position = COLUMNS.index(field)
+            encoder.get_ids(field, {row[position] for row in rows})
+
+
+def apply_pending() -> None:
+    """Add the pending rollup deltas of the loaded chunks to the rollups and bump the data version, at once"""
+    with transaction.atomic():
+        if UsageInfoRollupDelta.objects.exists():
+            # the version row stays locked until the commit: the loads finishing at once apply the deltas one by one
+            cache.bump_version()
+            rollups.apply_pending()
+
+
+def _init_process(connection_slots: typ.Any) -> None:
+    global _connection_slots
+    if not apps.ready:
+        # the spawned (not forked) processes
+        django.setup()
+    _connection_slots = connection_slots
+
+
+def load_parallel(path: str, source: str, ranges: typ.Sequence[ByteRange], options: ChunkOptions, processes: int,
+                  max_connections: typ.Optional[int], add: typ.Callable[[LoadStats], None]) -> None:
+    """Load the chunks in a pool of processes, see load_file"""
+    if connection.in_atomic_block:
+        raise RuntimeError('The chunks are loaded by the other processes, the load can not run in a transaction')
+    if max_connections is None:
+        max_connections = processes if connection.vendor == 'postgresql' else 1
+    slots = multiprocessing.BoundedSemaphore(max_connections)
+    # the processes open their own connections
+    connections.close_all()
+    with ProcessPoolExecutor(processes, initializer=_init_process, initargs=(slots,)) as executor:
+        futures = [executor.submit(load_range, path, source, byte_range, options) for byte_range in ranges]
+        try:
+            for future in as_completed(futures):
+                add(future.result())
+        except BaseException:
+            # the running chunks are finished (and recorded), the next run loads the rest
+            for future in futures:
+                future.cancel()
+            raise
+
+
+def load_file(path: str, processes: typ.Optional[int] = None, max_connections: typ.Optional[int] = None,
+              chunk_bytes: int = DEFAULT_CHUNK_BYTES, options: ChunkOptions = ChunkOptions(), restart: bool = False,
+              on_chunk: typ.Optional[typ.Callable[[int], None]] = None) -> LoadStats:
+    """
+    Load a usage info CSV file by chunks in parallel, the chunks loaded by an interrupted run are skipped
+
+    :param path: CSV file (date,channel,country,os,impressions,clicks,installs,spend,revenue)
+    :param processes: number of processes parsing and loading the chunks (default: the number of CPUs),
+        1 loads the chunks one by one in the current process
+    :param max_connections: maximum number of chunks written to the database at once
+        (default: the number of processes on PostgreSQL, 1 elsewhere)
+    :param chunk_bytes: chunk size, bytes
+    :param options: load options of the chunks
+    :param restart: forget the chunks loaded by the previous runs and load the whole file
+    :param on_chunk: callback receiving the number of rows loaded so far
+    :return: load statistics
+    :raise ValidationError: if the header or a row (and skip_invalid is off) is not valid
+    """
+    started = time.perf_counter()
+    processes = processes or os.cpu_count() or 1
+    with open(path, 'rb') as file:
+        source = fingerprint(file)
+        loaded_chunks = UsageInfoLoadedChunk.objects.filter(source=source)
+        if restart:
+            loaded_chunks.delete()
+        loaded = list(loaded_chunks.values_list('start', 'end'))
+        ranges = pending_ranges(file, loaded, chunk_bytes)
+
+    totals = Counter()
+
+    def add(stats: LoadStats) -> None:
+        totals.update({field: getattr(stats, field) for field in SUMMED_STATS})
+        if on_chunk is not None:
+            on_chunk(totals['rows'])
+
+    try:
+        if processes == 1 or len(ranges) < 2:
+            for byte_range in ranges:
+                add(load_range(path, source, byte_range, options))
+        else:
+            load_parallel(path, source, ranges, options, processes, max_connections, add)
+    finally:
+        # the loaded chunks (and the ones of a killed run) reach the rollups and the caches
+        apply_pending()
+    return LoadStats(seconds=time.perf_counter() - started, skipped_chunks=len(loaded),
+                     **{field: totals[field] for field in SUMMED_STATS})
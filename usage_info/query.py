@@ -0,0 +1,415 @@
+import functools
+import typing as typ
+from urllib.parse import urlencode
+
+import trafaret as t
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db.backends.base.base import BaseDatabaseWrapper
+from django.db.models import F, Sum, query, FloatField
+from django.db.models.expressions import OrderBy
+from django.db.models.functions import Trunc
+from django.dispatch import receiver
+from django.http import QueryDict
+
+from . import derived, rollups
+from .dimensions import DIMENSION_MODELS, cache as dimension_cache
+from .models import UsageInfo
+from .serializers import UsageInfoSerializer, FastUsageInfoSerializer
+from .validator import ValidationError, date_validator, comma_separated_str
+
+
+GROUP_BY_FIELDS = ('date', 'channel', 'country', 'os')
+# group_by=date:<bucket> groups the dates by week (starting on Monday), month, quarter or year,
+# the rows have the first date of the bucket as the date
+DATE_BUCKETS = ('day', 'week', 'month', 'quarter', 'year')
+# grouped field (the truncated date) -> bucket
+BUCKET_FIELDS = {f'date_{bucket}': bucket for bucket in DATE_BUCKETS if bucket != 'day'}
+GROUPED_FIELDS = (*GROUP_BY_FIELDS, *BUCKET_FIELDS)
+METRIC_FIELDS = ('impressions', 'clicks', 'installs', 'spend', 'revenue')
+DERIVED_FIELDS = tuple(derived.DERIVED_METRICS)
+SORT_BY_FIELDS = (*GROUP_BY_FIELDS, *METRIC_FIELDS, *DERIVED_FIELDS)
+
+# filter url parameter -> filtered field
+FILTER_FIELDS = {'date_from': 'date', 'date_to': 'date', 'channels': 'channel', 'countries': 'country', 'os': 'os'}
+# url parameters filtering the dimensions stored as ids
+DIMENSION_FILTERS = ('channels', 'countries', 'os')
+
+DimensionIds = typ.Tuple[typ.Tuple[int, ...], ...]  # ids of the DIMENSION_FILTERS values
+
+# built once, checking a request only runs the validators
+SCHEMA = t.Dict({
+    t.Key('date_from', optional=True): date_validator,
+    t.Key('date_to', optional=True): date_validator,
+    t.Key('channels', optional=True): comma_separated_str(),
+    t.Key('countries', optional=True): comma_separated_str(),
+    t.Key('os', optional=True): comma_separated_str(),
+    t.Key('group_by', optional=True): comma_separated_str(
+        {*GROUP_BY_FIELDS, *(f'date:{bucket}' for bucket in DATE_BUCKETS)}),
+    t.Key('sort_by', optional=True): comma_separated_str(
+        {*SORT_BY_FIELDS, *(f'-{field}' for field in SORT_BY_FIELDS)}),
+    t.Key('metrics', optional=True): comma_separated_str(set(DERIVED_FIELDS)),
+    t.Key('top', optional=True): t.ToInt(gte=1),
+    t.Key('top_by', optional=True): t.Enum(*METRIC_FIELDS, *DERIVED_FIELDS),
+    t.Key('partition_by', optional=True): comma_separated_str(set(GROUP_BY_FIELDS)),
+    t.Key('pagination', optional=True): t.Enum('offset', 'cursor'),
+}, allow_extra='*')
+
+
+# body of a batch request: the queries as url query strings or objects of the url parameters
+BATCH_MAX_QUERIES = 50
+BATCH_SCHEMA = t.Dict({
+    t.Key('queries'): t.List(
+        t.String(allow_blank=True) | t.Mapping(t.String, t.String(allow_blank=True) | t.Int),
+        min_length=1, max_length=BATCH_MAX_QUERIES),
+})
+
+
+class QuerySpec(typ.NamedTuple):
+    """Normalized (hashable) usage info query"""
+    date_from: typ.Optional[str] = None
+    date_to: typ.Optional[str] = None
+    channels: typ.Tuple[str, ...] = ()  # sorted, empty means no filter
+    countries: typ.Tuple[str, ...] = ()
+    os: typ.Tuple[str, ...] = ()
+    group_by: typ.Tuple[str, ...] = ()  # GROUPED_FIELDS, date:<bucket> is the date_<bucket> field
+    sort_by: typ.Tuple[str, ...] = ()  # date is the date_<bucket> field if the dates are grouped by a bucket
+    metrics: typ.Tuple[str, ...] = ()  # derived metrics, in the DERIVED_FIELDS order
+    totals: bool = False  # the grouped rows and the grand total
+    rollup: bool = False  # the grouped rows, the subtotals of every prefix of the grouped fields and the grand total
+    top: int = 0  # the grouped rows with the largest top_by metric of every partition (see top.py), 0 is all the rows
+    top_by: str = ''
+    partition_by: typ.Tuple[str, ...] = ()  # grouped fields, no fields is a single partition
+
+    @property
+    def has_totals(self) -> bool:
+        return self.totals or self.rollup
+
+    @property
+    def filters(self) -> 'QuerySpec':
+        """Get the spec of the filters only (e.g. the queries with the same filters are grouped by one scan)"""
+        return QuerySpec(**{param: getattr(self, param) for param in FILTER_FIELDS})
+
+    @property
+    def filtered_fields(self) -> typ.Set[str]:
+        return {field for param, field in FILTER_FIELDS.items() if getattr(self, param)}
+
+
+class QueryPlan(typ.NamedTuple):
+    """Querysets built for a QuerySpec (clone them with .all() before use)"""
+    queryset: query.QuerySet  # model instances or grouped values
+    values_list: query.QuerySet  # the same rows as values_list() tuples, with the ordering fields as well
+    serializer: FastUsageInfoSerializer  # serializer of the values_list() rows
+    fields: typ.Tuple[str, ...]  # fields of the values_list() rows
+    spec: QuerySpec
+    dimension_ids: DimensionIds  # ids of the filtered dimension values
+
+
+def _split(raw_str: str) -> typ.Tuple[str, ...]:
+    """Split comma separated values, strip them and drop duplicates keeping the order"""
+    return tuple(dict.fromkeys(map(str.strip, raw_str.split(','))))
+
+
+def source_field(field: str) -> str:
+    """Get the field of the table a grouped field is computed from (date for the date buckets)"""
+    return 'date' if field in BUCKET_FIELDS else field
+
+
+def param_field(field: str) -> str:
+    """Get the group_by url parameter value of a grouped field (date:<bucket> for the date buckets)"""
+    return f'date:{BUCKET_FIELDS[field]}' if field in BUCKET_FIELDS else field
+
+
+def bucket_expression(field: str) -> Trunc:
+    """Get the expression of a date bucket field: the date truncated to the first date of the bucket"""
+    return Trunc('date', BUCKET_FIELDS[field])
+
+
+def _parse_group_by(raw_str: str) -> typ.Tuple[str, ...]:
+    """
+    Split the group_by fields, date:<bucket> is the date_<bucket> field (date:day is the date)
+
+    :raise ValidationError: if the dates are grouped more than once
+    """
+    group_by = tuple(dict.fromkeys(
+        'date' if field == 'date:day' else field.replace(':', '_') for field in _split(raw_str)))
+    if sum(source_field(field) == 'date' for field in group_by) > 1:
+        raise ValidationError(f'The dates can be grouped once: {raw_str!r}')
+    return group_by
+
+
+def _parse_sort_by(raw_str: str, group_by: typ.Tuple[str, ...]) -> typ.Tuple[str, ...]:
+    """Split the sort_by (or partition_by) fields, the date is the date bucket the rows are grouped by (if any)"""
+    bucket = next((field for field in group_by if field in BUCKET_FIELDS), None)
+    sort_by = _split(raw_str)
+    if bucket is None:
+        return sort_by
+    return tuple(dict.fromkeys(
+        field.replace('date', bucket) if field.lstrip('-') == 'date' else field for field in sort_by))
+
+
+def _parse_metrics(raw_str: str, cpi: bool = False) -> typ.Tuple[str, ...]:
+    """Split the derived metrics (cpi=1 adds CPI) and put them in the DERIVED_FIELDS order"""
+    names = {*(_split(raw_str) if raw_str else ()), *(('cpi',) if cpi else ())}
+    return tuple(name for name in DERIVED_FIELDS if name in names)
+
+
+def parse_query_params(query_params: QueryDict) -> QuerySpec:
+    """
+    Validate the query params and normalize them to a query spec
+
+    :param query_params: query params from the request
+    :return: query spec
+    :raise ValidationError: if query parameter is not valid
+    """
+    try:
+        params = SCHEMA.check({key: query_params[key] for key in query_params})
+    except t.DataError as err:
+        raise ValidationError(err)
+
+    group_by = _parse_group_by(params['group_by']) if 'group_by' in params else ()
+    partition_by = _parse_sort_by(params['partition_by'], group_by) if 'partition_by' in params else ()
+    sort_by = _parse_sort_by(params['sort_by'], group_by) if 'sort_by' in params else ()
+    if 'top' in params and 'top_by' in params and not sort_by:
+        # the top rows of a partition follow each other, the first one is the top one
+        sort_by = (*partition_by, f'-{params.get("top_by")}')
+    spec = QuerySpec(
+        date_from=params.get('date_from'),
+        date_to=params.get('date_to'),
+        channels=tuple(sorted(_split(params['channels']))) if 'channels' in params else (),
+        countries=tuple(sorted(_split(params['countries']))) if 'countries' in params else (),
+        os=tuple(sorted(_split(params['os']))) if 'os' in params else (),
+        group_by=group_by,
+        sort_by=sort_by,
+        metrics=_parse_metrics(params.get('metrics', ''), cpi=query_params.get('cpi') == '1'),
+        totals=query_params.get('totals') == '1',
+        rollup=query_params.get('rollup') == '1',
+        top=params.get('top', 0),
+        top_by=params.get('top_by', ''),
+        partition_by=partition_by,
+    )
+    for name in DERIVED_FIELDS:
+        if name not in spec.metrics and any(field.lstrip('-') == name for field in (*spec.sort_by, spec.top_by)):
+            raise ValidationError(
+                f'Can not sort by {name.upper()}. Please turn {name.upper()} on by adding metrics={name}')
+    if spec.has_totals and not spec.group_by:
+        raise ValidationError('Totals and subtotals require group_by')
+    if spec.has_totals and params.get('pagination') == 'cursor':
+        raise ValidationError('Totals and subtotals are not supported by the cursor pagination')
+    if spec.top or spec.top_by or spec.partition_by:
+        if not (spec.top and spec.top_by and spec.group_by):
+            raise ValidationError('Top rows require top, top_by and group_by')
+        if not set(spec.partition_by) <= set(spec.group_by):
+            raise ValidationError(f'The partition_by fields must be grouped: {params["partition_by"]!r}')
+        if spec.has_totals:
+            raise ValidationError('Top rows can not have totals and subtotals')
+        if params.get('pagination') == 'cursor':
+            raise ValidationError('Top rows are not supported by the cursor pagination')
+    return spec
+
+
+def parse_batch(data: typ.Any) -> typ.List[str]:
+    """
+    Validate the body of a batch request
+
+    :param data: parsed request body
+    :return: query strings of the queries
+    :raise ValidationError: if the body is not valid
+    """
+    try:
+        queries = BATCH_SCHEMA.check(data)['queries']
+    except t.DataError as err:
+        raise ValidationError(err)
+    return [query if isinstance(query, str) else urlencode(query) for query in queries]
+
+
+def order_field(field: str) -> str:
+    """Dimensions are sorted by their names, not by the ids"""
+    name = field.lstrip('-')
+    return f'{field}__name' if name in DIMENSION_MODELS else field
+
+
+def grouped_fields(spec: QuerySpec) -> typ.Tuple[str, ...]:
+    """Fields the rows are grouped by: the group_by ones and (like the SQL GROUP BY of Django) the sorted dimensions"""
+    if not spec.group_by:
+        return ()
+    return tuple(dict.fromkeys([
+        *spec.group_by, *(field.lstrip('-') for field in spec.sort_by if field.lstrip('-') in GROUPED_FIELDS)]))
+
+
+def get_ordering(spec: QuerySpec) -> typ.List[str]:
+    """
+    Get the ordering fields of the query: the sort_by ones (the dimensions by the names)
+    followed by the grouped fields (or the primary key) breaking the ties, so the order is stable
+    whichever table answers the query and the pages don't overlap
+    """
+    if not (spec.sort_by or spec.group_by):
+        return []
+    return [*map(order_field, spec.sort_by), *(
+        field for field in spec.group_by or ['id'] if field not in spec.sort_by and f'-{field}' not in spec.sort_by)]
+
+
+def order_by_expression(field: str) -> typ.Union[str, OrderBy]:
+    """The derived metrics have their NULLs (nothing to divide by) last in both directions, on every database"""
+    name = field.lstrip('-')
+    if name not in DERIVED_FIELDS:
+        return field
+    return F(name).desc(nulls_last=True) if field.startswith('-') else F(name).asc(nulls_last=True)
+
+
+def ordering_fields(queryset: query.QuerySet) -> typ.List[str]:
+    """Get the ordering fields of the queryset ('-' for the descending ones), also of the order_by_expression ones"""
+    return [
+        field if isinstance(field, str) else f'{"-" if field.descending else ""}{field.expression.name}'
+        for field in queryset.query.order_by
+    ]
+
+
+def get_levels(spec: QuerySpec) -> typ.List[typ.Tuple[str, ...]]:
+    """
+    Get the grouping levels of the query: the grouped fields, then (rollup=1) every shorter prefix of them,
+    then (totals=1 or rollup=1) no fields, the grand total
+    """
+    fields = grouped_fields(spec)
+    if spec.rollup:
+        return [fields[:size] for size in range(len(fields), -1, -1)]
+    if spec.totals:
+        return [fields, ()]
+    return [fields]
+
+
+def filter_queryset(queryset: query.QuerySet, spec: QuerySpec, dimension_ids: DimensionIds) -> query.QuerySet:
+    """Apply the date and dimension filters of the query spec"""
+    if spec.date_from:
+        queryset = queryset.filter(date__gte=spec.date_from)
+    if spec.date_to:
+        queryset = queryset.filter(date__lte=spec.date_to)
+    for param, ids in zip(DIMENSION_FILTERS, dimension_ids):
+        if getattr(spec, param):
+            # no ids (only unknown values) match nothing
+            queryset = queryset.filter(**{f'{FILTER_FIELDS[param]}__in': ids})
+    return queryset
+
+
+def build_queryset(spec: QuerySpec, dimension_ids: DimensionIds) -> query.QuerySet:
+    """
+    Build the usage info queryset for the query spec
+
+    :param spec: query spec
+    :param dimension_ids: ids of the filtered dimension values (see get_dimension_ids)
+    :return: queryset
+    """
+    queryset = UsageInfo.objects.all()
+    metrics = {name: derived.expression(name) for name in spec.metrics}
+    if spec.group_by:
+        # the smallest rollup having all the grouped, filtered and sorted dimensions answers the query
+        model = rollups.route({*map(source_field, grouped_fields(spec)), *spec.filtered_fields})
+        if model is not UsageInfo and set(grouped_fields(spec)) == set(model.dimensions):
+            # a group is a row of the rollup: its stored (and indexed) derived metrics are read and sorted by
+            queryset = model.objects.values(*spec.group_by, *METRIC_FIELDS, *spec.metrics)
+            metrics = {}
+        else:
+            # dimensions are grouped by the ids, the date buckets by the truncated dates
+            buckets = {field: bucket_expression(field) for field in spec.group_by if field in BUCKET_FIELDS}
+            queryset = model.objects.annotate(**buckets).values(*spec.group_by).annotate(
+                impressions=Sum('impressions'),
+                clicks=Sum('clicks'),
+                installs=Sum('installs', output_field=FloatField()),
+                spend=Sum('spend', output_field=FloatField()),
+                revenue=Sum('revenue')
+            )
+
+    if metrics:
+        queryset = queryset.annotate(**metrics)
+
+    ordering = get_ordering(spec)
+    if ordering:
+        queryset = queryset.order_by(*map(order_by_expression, ordering))
+    return filter_queryset(queryset, spec, dimension_ids)
+
+
+def build_values_list(
+        queryset: query.QuerySet) -> typ.Tuple[FastUsageInfoSerializer, query.QuerySet, typ.Tuple[str, ...]]:
+    """
+    Turn the queryset into values_list() rows and build a fast serializer for them.
+    The rows have the ordering fields as well, so the keyset pagination can read its position.
+
+    :param queryset: usage info queryset (model instances or grouped values)
+    :return: serializer, the values_list() queryset and the fields of its rows
+    """
+    annotations = tuple(queryset.query.annotation_select)
+    # grouped values or rows of a rollup (a row per group)
+    grouped = queryset.query.group_by is not None or queryset.model is not UsageInfo
+    if grouped:
+        available = (*queryset.query.values_select, *annotations)
+    else:
+        available = (*(field.name for field in UsageInfo._meta.concrete_fields), *annotations)
+
+    fields = [
+        field for field in UsageInfoSerializer.Meta.fields if field not in DERIVED_FIELDS or field in available]
+    # a date bucket is serialized as the date
+    sources = {source_field(field): field for field in available}
+    columns = [sources[field] for field in fields if field in sources]
+    ordering = [field.lstrip('-') for field in ordering_fields(queryset)]
+    if not grouped:
+        ordering.append('id')
+    extra = [field for field in dict.fromkeys(ordering) if field not in columns]
+    row_fields = (*columns, *extra)
+    serializer = FastUsageInfoSerializer([source_field(field) for field in columns], fields)
+    return serializer, queryset.values_list(*row_fields, named=True), row_fields
+
+
+def compile_values_list(
+        queryset: query.QuerySet,
+        connection: BaseDatabaseWrapper) -> typ.Tuple[str, tuple, typ.List[str], typ.Callable[[list], list]]:
+    """
+    Compile the values_list() queryset to SQL (to run it with a cursor or another driver)
+
+    :param queryset: values_list() queryset
+    :param connection: database connection
+    :return: SQL, params, the selected columns (in the SQL order)
+        and the function converting the fetched rows to the values_list() tuples
+    :raise EmptyResultSet: if the queryset matches nothing (e.g. filtered by unknown names only)
+    """
+    compiler = queryset.query.get_compiler(connection=connection)
+    sql, params = compiler.as_sql()
+    converters = compiler.get_converters([select[0] for select in compiler.select[:compiler.col_count]])
+
+    # the columns are selected as extra, values, annotations (see ValuesListIterable)
+    names = [*queryset.query.extra_select, *queryset.query.values_select, *queryset.query.annotation_select]
+    fields = list(queryset._fields) or names
+    index = [names.index(field) for field in fields] if fields != names else None
+
+    def convert(records: list) -> list:
+        rows = [tuple(record) for record in records]
+        if converters:
+            rows = [tuple(row) for row in compiler.apply_converters(rows, converters)]
+        if index is not None:
+            rows = [tuple(row[i] for i in index) for row in rows]
+        return rows
+
+    return sql, params, names, convert
+
+
+def get_dimension_ids(spec: QuerySpec) -> DimensionIds:
+    """Translate the filtered dimension values to ids (see dimensions.DimensionCache)"""
+    return tuple(dimension_cache.get_ids(FILTER_FIELDS[param], getattr(spec, param)) for param in DIMENSION_FILTERS)
+
+
+@functools.lru_cache(maxsize=getattr(settings, 'USAGE_INFO_PLAN_CACHE_SIZE', 256))
+def compile_plan(spec: QuerySpec, dimension_ids: DimensionIds) -> QueryPlan:
+    """Build (once per spec and dimension ids, least recently used plans are dropped) the querysets"""
+    queryset = build_queryset(spec, dimension_ids)
+    serializer, values_list, fields = build_values_list(queryset)
+    return QueryPlan(queryset, values_list, serializer, fields, spec, dimension_ids)
+
+
+def get_plan(spec: QuerySpec) -> QueryPlan:
+    """Get the query plan for the query spec (the dimension cache should be refreshed beforehand)"""
+    return compile_plan(spec, get_dimension_ids(spec))
+
+
+@receiver(setting_changed)
+def on_setting_changed(setting: str, **kwargs) -> None:
+    if setting.startswith('USAGE_INFO_'):
+        compile_plan.cache_clear()
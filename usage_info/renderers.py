@@ -0,0 +1,194 @@
+import io
+import csv
+import json
+import typing as typ
+
+from django.core.serializers.json import DjangoJSONEncoder
+from rest_framework import renderers
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # pragma: no cover
+    pa = pq = None
+
+# rows sent to the client at once by the streaming renderers
+STREAM_CHUNK_SIZE = 1000
+
+# Arrow types of the usage info fields, the other fields (e.g. an error detail) are inferred
+ARROW_TYPES = {
+    'date': 'date32', 'channel': 'string', 'country': 'string', 'os': 'string', 'impressions': 'int64',
+    'clicks': 'int64', 'installs': 'int64', 'spend': 'float64', 'revenue': 'float64', 'cpi': 'float64',
+    'ctr': 'float64', 'ipm': 'float64', 'roas': 'float64', 'grouping': 'string',
+}
+
+
+def _chunked(lines: typ.Iterable[str], size: int = STREAM_CHUNK_SIZE) -> typ.Iterator[str]:
+    chunk = []
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) >= size:
+            yield ''.join(chunk)
+            chunk = []
+    if chunk:
+        yield ''.join(chunk)
+
+
+class NDJSONRenderer(renderers.BaseRenderer):
+    """Newline delimited JSON: one JSON object per row"""
+    media_type = 'application/x-ndjson'
+    format = 'ndjson'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None) -> bytes:
+        rows = data if isinstance(data, list) else [data]
+        return ''.join(self.stream(rows)).encode(self.charset)
+
+    @staticmethod
+    def stream(rows: typ.Iterable[dict], fields: typ.Sequence[str] = ()) -> typ.Iterator[str]:
+        encoder = DjangoJSONEncoder()
+        return _chunked(encoder.encode(row) + '\n' for row in rows)
+
+
+class CSVRenderer(renderers.BaseRenderer):
+    """CSV with a header line"""
+    media_type = 'text/csv'
+    format = 'csv'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None) -> bytes:
+        rows = data if isinstance(data, list) else [data]
+        return ''.join(self.stream(rows, list(rows[0]) if rows else ())).encode(self.charset)
+
+    @staticmethod
+    def stream(rows: typ.Iterable[dict], fields: typ.Sequence[str] = ()) -> typ.Iterator[str]:
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fields, extrasaction='ignore')
+
+        def lines() -> typ.Iterator[str]:
+            writer.writeheader()
+            for number, row in enumerate(rows, 1):
+                writer.writerow(row)
+                if number % STREAM_CHUNK_SIZE == 0:
+                    yield buffer.getvalue()
+                    buffer.seek(0)
+                    buffer.truncate()
+            yield buffer.getvalue()
+
+        return lines()
+
+
+class PrometheusRenderer(renderers.BaseRenderer):
+    """Prometheus text exposition format of the request metrics (see UsageInfoMetricsView)"""
+    media_type = 'text/plain'
+    format = 'prometheus'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None) -> bytes:
+        families = {}  # metric name -> (type, samples)
+
+        def add(name: str, kind: str, sample: str, labels: dict, value: typ.Any) -> None:
+            label_text = ','.join(f'{key}="{label}"' for key, label in labels.items())
+            families.setdefault(name, (kind, []))[1].append(
+                f'{sample}{{{label_text}}} {value}' if labels else f'{sample} {value}')
+
+        def add_histogram(name: str, labels: dict, histogram: dict, scale: float = 1) -> None:
+            for bound, count in histogram['buckets']:
+                add(name, 'histogram', f'{name}_bucket',
+                    {**labels, 'le': bound if bound == '+Inf' else bound / scale}, count)
+            add(name, 'histogram', f'{name}_sum', labels, histogram['sum'] / scale)
+            add(name, 'histogram', f'{name}_count', labels, histogram['count'])
+
+        for endpoint, aggregates in data.get('endpoints', {}).items():
+            labels = {'endpoint': endpoint}
+            add('usage_info_requests_total', 'counter', 'usage_info_requests_total', labels, aggregates['requests'])
+            add('usage_info_slow_requests_total', 'counter', 'usage_info_slow_requests_total', labels,
+                aggregates['slow_requests'])
+            add_histogram('usage_info_request_queries', labels, aggregates['queries'])
+            add_histogram('usage_info_request_rows', labels, aggregates['rows'])
+            for phase, histogram in aggregates['duration_ms'].items():
+                add_histogram('usage_info_request_duration_seconds', {**labels, 'phase': phase}, histogram, 1000)
+        for name, value in data.get('response_cache', {}).items():
+            add(f'usage_info_response_cache_{name}_total', 'counter', f'usage_info_response_cache_{name}_total', {},
+                value)
+        coalescing = data.get('coalescing')
+        if coalescing:
+            add('usage_info_coalescing_queries_total', 'counter', 'usage_info_coalescing_queries_total', {},
+                coalescing['queries'])
+            for source, count in (('process', 'coalesced_in_process'), ('worker', 'coalesced_across_workers')):
+                add('usage_info_coalesced_requests_total', 'counter', 'usage_info_coalesced_requests_total',
+                    {'source': source}, coalescing[count])
+        for alias, replica in data.get('replicas', {}).items():
+            labels = {'alias': alias}
+            add('usage_info_replica_healthy', 'gauge', 'usage_info_replica_healthy', labels, int(replica['healthy']))
+            if replica['lag'] is not None:
+                add('usage_info_replica_lag_seconds', 'gauge', 'usage_info_replica_lag_seconds', labels, replica['lag'])
+            add('usage_info_replica_reads_total', 'counter', 'usage_info_replica_reads_total', labels, replica['reads'])
+
+        lines = []
+        for name, (kind, samples) in families.items():
+            lines.append(f'# TYPE {name} {kind}')
+            lines.extend(samples)
+        return ('\n'.join(lines) + '\n').encode(self.charset)
+
+
+class ColumnarRenderer(renderers.BaseRenderer):
+    """
+    Base of the binary column oriented formats (require pyarrow, optional dependency).
+    UsageInfoView gives them the rows column-wise (field -> values, see FastUsageInfoSerializer.serialize_columns),
+    the pagination fields (count, next, previous) go to the schema metadata.
+    The formats serialize the table with write(table) -> bytes.
+    """
+    charset = None
+    render_style = 'binary'
+    columnar = True
+
+    def render(self, data, accepted_media_type=None, renderer_context=None) -> bytes:
+        return self.write(self.to_table(data))
+
+    @staticmethod
+    def to_table(data: typ.Any) -> 'pa.Table':
+        """
+        Build an Arrow table of the columns (field -> values), the paginated columns ({'results': columns, ...})
+        or any other data (e.g. an error) as a single row
+        """
+        metadata = {}
+        if isinstance(data, dict) and 'results' in data:
+            metadata = {
+                key: json.dumps(value, cls=DjangoJSONEncoder) for key, value in data.items() if key != 'results'}
+            data = data['results']
+        if not isinstance(data, dict) or not all(isinstance(values, list) for values in data.values()):
+            data = {key: [value] for key, value in data.items()} if isinstance(data, dict) else {'data': [data]}
+        arrays = [
+            pa.array(values, type=getattr(pa, ARROW_TYPES[field])() if field in ARROW_TYPES else None)
+            for field, values in data.items()
+        ]
+        return pa.Table.from_arrays(arrays, names=list(data)).replace_schema_metadata(metadata or None)
+
+
+class ArrowRenderer(ColumnarRenderer):
+    """Arrow IPC stream, e.g. pyarrow.ipc.open_stream(content).read_pandas()"""
+    media_type = 'application/vnd.apache.arrow.stream'
+    format = 'arrow'
+
+    def write(self, table: 'pa.Table') -> bytes:
+        sink = pa.BufferOutputStream()
+        writer = pa.RecordBatchStreamWriter(sink, table.schema)
+        writer.write_table(table)
+        writer.close()
+        return sink.getvalue().to_pybytes()
+
+
+class ParquetRenderer(ColumnarRenderer):
+    """Parquet file, e.g. pandas.read_parquet(io.BytesIO(content))"""
+    media_type = 'application/vnd.apache.parquet'
+    format = 'parquet'
+
+    def write(self, table: 'pa.Table') -> bytes:
+        sink = pa.BufferOutputStream()
+        pq.write_table(table, sink)
+        return sink.getvalue().to_pybytes()
+
+
+# offered by UsageInfoView if pyarrow is installed
+COLUMNAR_RENDERERS = (ArrowRenderer, ParquetRenderer) if pa is not None else ()
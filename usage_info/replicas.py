@@ -0,0 +1,203 @@
+"""
+Routing of the usage info API reads to the read replicas (USAGE_INFO_REPLICAS aliases of DATABASES).
+
+The views of the read path run in a reads() block: it picks a healthy replica (round robin) and ReplicaRouter
+sends the reads of the usage_info models there until the block ends, so all the queries of a request (data version,
+COUNT, page) see the same data. Everything else (ingestion, admin, signals, management commands) reads and writes
+the default (primary) database, the replicas are never written to or migrated.
+
+A replica is checked at most every USAGE_INFO_REPLICA_CHECK_INTERVAL seconds (by the request which needs it):
+it has to answer and to lag behind the primary at most USAGE_INFO_REPLICA_MAX_LAG seconds. A replica failing
+a query is skipped until the next check. Without a healthy replica the reads go to the primary.
+"""
+import time
+import itertools
+import threading
+import contextlib
+import contextvars
+import typing as typ
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+from django.db.backends.base.base import BaseDatabaseWrapper
+from django.db.models import Model
+
+APP_LABEL = 'usage_info'
+# seconds the standby replays behind the primary, 0 if it has replayed everything it has received
+# (the last replay time stays old while the primary isn't written to) or if it isn't a standby
+LAG_SQL = '''
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+    END
+'''
+
+
+def replication_lag(connection: BaseDatabaseWrapper) -> typ.Optional[float]:
+    """
+    Measure the replication lag of a database
+
+    :param connection: replica connection
+    :return: lag, seconds (0 on the databases without replication, e.g. SQLite), None if unknown
+    :raise DatabaseError: if the database doesn't answer
+    """
+    with connection.cursor() as cursor:
+        if connection.vendor != 'postgresql':
+            cursor.execute('SELECT 1')
+            return 0.0
+        cursor.execute(LAG_SQL)
+        lag, = cursor.fetchone()
+    return None if lag is None else max(float(lag), 0.0)
+
+
+class ReplicaState:
+    """Result of the last health check of a replica"""
+
+    def __init__(self):
+        self.healthy = False
+        self.lag: typ.Optional[float] = None
+        self.error = ''
+        self.checked_at: typ.Optional[float] = None  # time.monotonic()
+        self.reads = 0  # number of the reads() blocks routed to the replica
+
+    def as_dict(self) -> dict:
+        return {'healthy': self.healthy, 'lag': self.lag, 'error': self.error, 'reads': self.reads}
+
+
+class ReplicaMonitor:
+    """Thread safe health of the replicas and the round robin choice of a healthy one (per process)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._states: typ.Dict[str, ReplicaState] = {}
+        self._checking: typ.Set[str] = set()
+        self._counter = itertools.count()
+
+    def choose(self) -> str:
+        """Get the next healthy replica, the primary if there is none"""
+        healthy = [alias for alias in settings.USAGE_INFO_REPLICAS if self.is_healthy(alias)]
+        if not healthy:
+            return DEFAULT_DB_ALIAS
+        alias = healthy[next(self._counter) % len(healthy)]
+        with self._lock:
+            self._states[alias].reads += 1
+        return alias
+
+    def is_healthy(self, alias: str) -> bool:
+        """Check the replica if its last check is too old (one thread checks it, the rest get the last result)"""
+        with self._lock:
+            state = self._states.setdefault(alias, ReplicaState())
+            due = alias not in self._checking and (
+                state.checked_at is None
+                or time.monotonic() - state.checked_at >= settings.USAGE_INFO_REPLICA_CHECK_INTERVAL)
+            if due:
+                self._checking.add(alias)
+        if due:
+            try:
+                self.check(alias)
+            finally:
+                with self._lock:
+                    self._checking.discard(alias)
+        return state.healthy
+
+    def check(self, alias: str) -> None:
+        """Measure the lag of the replica, it's healthy if it answers and the lag is small enough"""
+        try:
+            lag, error = replication_lag(connections[alias]), ''
+        except DatabaseError as err:
+            # reconnect next time
+            connections[alias].close()
+            lag, error = None, str(err)
+        with self._lock:
+            state = self._states.setdefault(alias, ReplicaState())
+            state.lag, state.error, state.checked_at = lag, error, time.monotonic()
+            state.healthy = lag is not None and lag <= settings.USAGE_INFO_REPLICA_MAX_LAG
+
+    def mark_failed(self, alias: str, error: Exception) -> None:
+        """Skip the replica until its next check"""
+        with self._lock:
+            state = self._states.setdefault(alias, ReplicaState())
+            state.healthy, state.error, state.checked_at = False, str(error), time.monotonic()
+
+    def reset(self) -> None:
+        with self._lock:
+            self._states = {}
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            return {alias: state.as_dict() for alias, state in self._states.items()}
+
+
+monitor = ReplicaMonitor()
+
+_alias: contextvars.ContextVar[typ.Optional[str]] = contextvars.ContextVar('usage_info_read_alias', default=None)
+
+
+def current() -> str:
+    """Get the database the usage info reads go to"""
+    return _alias.get() or DEFAULT_DB_ALIAS
+
+
+@contextlib.contextmanager
+def using(alias: str) -> typ.Iterator[None]:
+    """Route the usage info reads of the block to the database (e.g. in the threads of a reads() block)"""
+    token = _alias.set(alias)
+    try:
+        yield
+    finally:
+        _alias.reset(token)
+
+
+def choose() -> str:
+    """Get the database of a reads() block: the one of the enclosing block or a healthy replica or the primary"""
+    return _alias.get() or monitor.choose()
+
+
+@contextlib.contextmanager
+def reads() -> typ.Iterator[str]:
+    """
+    Route the usage info reads of the block to a healthy replica or to the primary
+    (the nested blocks keep the database of the outer one)
+
+    :return: database alias
+    """
+    alias = choose()
+    with using(alias):
+        try:
+            yield alias
+        except DatabaseError as err:
+            if alias != DEFAULT_DB_ALIAS:
+                monitor.mark_failed(alias, err)
+            raise
+
+
+class ReplicaRouter:
+    """
+    Send the reads of the usage_info models in a reads() block to its database and their writes to the primary,
+    the replicas are not migrated (they copy the primary)
+    """
+
+    @staticmethod
+    def db_for_read(model: typ.Type[Model], **hints) -> typ.Optional[str]:
+        if model._meta.app_label == APP_LABEL:
+            return current()
+        return None
+
+    @staticmethod
+    def db_for_write(model: typ.Type[Model], **hints) -> typ.Optional[str]:
+        if model._meta.app_label == APP_LABEL:
+            return DEFAULT_DB_ALIAS
+        return None
+
+    @staticmethod
+    def allow_relation(obj1: Model, obj2: Model, **hints) -> typ.Optional[bool]:
+        databases = {DEFAULT_DB_ALIAS, *settings.USAGE_INFO_REPLICAS}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    @staticmethod
+    def allow_migrate(db: str, app_label: str, **hints) -> typ.Optional[bool]:
+        if db in settings.USAGE_INFO_REPLICAS:
+            return False
+        return None
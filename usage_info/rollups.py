@@ -0,0 +1,319 @@
+"""
+Pre-aggregated usage info rollups, maintained incrementally by the writes of the UsageInfo table.
+
+All the writes have to go through the paths which maintain them: the ingestion (ingest.load_rows, load_csv and
+the parallel pipeline.py, see signals.usage_info_loaded) and the model save() and delete() (the ORM
+QuerySet.delete() too, it sends post_delete per row). QuerySet.update(), bulk_create() and raw SQL bypass them
+and leave the rollups (and the response cache) stale: verify() finds the stale rollup rows
+(verify_usage_info_rollups command), rebuild() recomputes the rollups (rebuild_usage_info_rollups command).
+"""
+import typing as typ
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import connection, models, transaction
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.dispatch import receiver
+
+from .derived import DERIVED_METRICS, compute, sql as derived_sql
+from .ingest import COLUMNS, DIMENSIONS, METRICS, Row
+from .models import (
+    UsageInfo, UsageInfoRollup, UsageInfoByDate, UsageInfoByChannelCountryOs,
+    UsageInfoByDateChannel, UsageInfoByDateCountryOs, UsageInfoByDateChannelCountry, UsageInfoRollupDelta,
+)
+from .signals import usage_info_loaded
+
+
+# Ordered from the smallest to the biggest expected table (there are hundreds of dates,
+# tens of channels and countries and a few operating systems), so the first rollup
+# covering all the requested fields is the cheapest one to scan.
+ROLLUPS: typ.Tuple[typ.Type[UsageInfoRollup], ...] = (
+    UsageInfoByDate,
+    UsageInfoByChannelCountryOs,
+    UsageInfoByDateChannel,
+    UsageInfoByDateCountryOs,
+    UsageInfoByDateChannelCountry,
+)
+# the summed columns of the rollups
+AGGREGATED = (*METRICS, 'record_count')
+# the float sums of a rollup row and of its UsageInfo rows differ by rounding, relative to the sum
+FLOAT_TOLERANCE = 1e-6
+
+
+class Drift(typ.NamedTuple):
+    """Rollup row which doesn't match the UsageInfo rows (see verify)"""
+    rollup: typ.Type[UsageInfoRollup]
+    key: typ.Dict[str, typ.Any]  # dimension -> value (id)
+    stored: typ.Dict[str, typ.Any]  # sums of the rollup row and its pending deltas
+    expected: typ.Dict[str, typ.Any]  # sums of the UsageInfo rows
+
+
+def route(fields: typ.Iterable[str]) -> typ.Type[models.Model]:
+    """Choose the smallest table which is able to answer an aggregated query
+
+    :param fields: dimensions used by the query (group_by and filter fields)
+    :return: rollup model or UsageInfo if no rollup has all the fields
+    """
+    fields = set(fields)
+    if getattr(settings, 'USAGE_INFO_ROLLUPS', True):
+        for rollup in ROLLUPS:
+            if fields.issubset(rollup.dimensions):
+                return rollup
+    return UsageInfo
+
+
+def aggregate_rows(rollup: typ.Type[UsageInfoRollup], rows: typ.Iterable[Row],
+                   sign: int = 1) -> typ.Dict[tuple, list]:
+    """Sum metrics of UsageInfo rows by the rollup dimensions
+
+    :param rollup: rollup model
+    :param rows: rows in the ingest.COLUMNS order (with the dimension ids)
+    :param sign: 1 to add the rows, -1 to subtract them
+    :return: rollup key -> [*metric sums, record count]
+    """
+    positions = [DIMENSIONS.index(field) for field in rollup.dimensions]
+    totals = defaultdict(lambda: [0] * (len(METRICS) + 1))
+    for row in rows:
+        total = totals[tuple(row[position] for position in positions)]
+        for i, value in enumerate(row[len(DIMENSIONS):]):
+            total[i] += sign * value
+        total[-1] += sign
+    return totals
+
+
+def apply_rows(rows: typ.Sequence[Row], sign: int = 1) -> None:
+    """Add (or subtract) UsageInfo rows to all the rollups
+
+    :param rows: rows in the ingest.COLUMNS order (with the dimension ids)
+    :param sign: 1 to add the rows, -1 to subtract them
+    """
+    if sign < 0:
+        apply_delta((), rows)
+    else:
+        apply_delta(rows)
+
+
+def rollup_deltas(rollup: typ.Type[UsageInfoRollup], added: typ.Sequence[Row],
+                  removed: typ.Sequence[Row] = ()) -> typ.List[tuple]:
+    """Sum the changes of the rollup rows
+
+    :param rollup: rollup model
+    :param added: rows in the ingest.COLUMNS order (with the dimension ids)
+    :param removed: rows in the ingest.COLUMNS order (with the dimension ids)
+    :return: sorted (*rollup key, *metric deltas, record count delta), without the rows the changes cancel out in
+    """
+    totals = aggregate_rows(rollup, added)
+    for key, total in aggregate_rows(rollup, removed, sign=-1).items():
+        totals[key] = [value + delta for value, delta in zip(totals[key], total)]
+    # sorted by the key, so the concurrent loads lock the rows in the same order
+    return sorted((*key, *total) for key, total in totals.items() if any(total))
+
+
+def insert_values(cursor: typ.Any, table: str, columns: typ.Sequence[str], values: typ.Sequence[tuple],
+                  suffix: str = '') -> None:
+    """Insert the rows with the multi-row INSERTs of the maximum size of the database
+
+    :param cursor: database cursor
+    :param table: quoted table name
+    :param columns: column names
+    :param values: rows
+    :param suffix: SQL appended to every INSERT, e.g. ON CONFLICT ...
+    """
+    quote = connection.ops.quote_name
+    batch_size = connection.ops.bulk_batch_size(columns, values)
+    for start in range(0, len(values), batch_size):
+        batch = values[start:start + batch_size]
+        placeholders = ', '.join([f'({", ".join(["%s"] * len(columns))})'] * len(batch))
+        cursor.execute(
+            f'INSERT INTO {table} ({", ".join(map(quote, columns))}) VALUES {placeholders} {suffix}',
+            [value for row in batch for value in row])
+
+
+def upsert_sql(rollup: typ.Type[UsageInfoRollup]) -> str:
+    """Build the ON CONFLICT clause adding the inserted deltas to the existing rollup rows"""
+    quote = connection.ops.quote_name
+    table = quote(rollup._meta.db_table)
+    keys = [rollup._meta.get_field(field).column for field in rollup.dimensions]
+    updates = ', '.join([
+        *(f'{quote(field)} = {table}.{quote(field)} + EXCLUDED.{quote(field)}' for field in AGGREGATED),
+        # the derived metrics of the new sums
+        *(f'{quote(name)} = ' + derived_sql(name, lambda field: f'{table}.{quote(field)} + EXCLUDED.{quote(field)}')
+          for name in DERIVED_METRICS),
+    ])
+    return f'ON CONFLICT ({", ".join(map(quote, keys))}) DO UPDATE SET {updates}'
+
+
+def apply_delta(added: typ.Sequence[Row], removed: typ.Sequence[Row] = ()) -> None:
+    """Add the new rows and subtract the removed ones (e.g. the previous values of the updated rows)
+    with one write per changed rollup row, the rollup rows the changes cancel out in are not touched
+
+    :param added: rows in the ingest.COLUMNS order (with the dimension ids)
+    :param removed: rows in the ingest.COLUMNS order (with the dimension ids)
+    """
+    if not added and not removed:
+        return
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        for rollup in ROLLUPS:
+            keys = [rollup._meta.get_field(field).column for field in rollup.dimensions]
+            values = [
+                (*delta, *(compute(name, dict(zip(METRICS, delta[len(keys):]))) for name in DERIVED_METRICS))
+                for delta in rollup_deltas(rollup, added, removed)]
+            if not values:
+                continue
+            insert_values(
+                cursor, connection.ops.quote_name(rollup._meta.db_table), (*keys, *AGGREGATED, *DERIVED_METRICS),
+                values, upsert_sql(rollup))
+            if removed:
+                rollup.objects.filter(record_count__lte=0).delete()
+
+
+def store_delta(added: typ.Sequence[Row], removed: typ.Sequence[Row] = ()) -> None:
+    """Keep the changes of the rollups as pending deltas (see UsageInfoRollupDelta) instead of applying them:
+    the deltas are only inserted, so the concurrent chunk transactions of the parallel ingestion
+    don't wait for each other on the shared rollup rows
+
+    :param added: rows in the ingest.COLUMNS order (with the dimension ids)
+    :param removed: rows in the ingest.COLUMNS order (with the dimension ids)
+    """
+    if not added and not removed:
+        return
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        for rollup in ROLLUPS:
+            keys = [UsageInfoRollupDelta._meta.get_field(field).column for field in rollup.dimensions]
+            values = [(rollup._meta.db_table, *delta) for delta in rollup_deltas(rollup, added, removed)]
+            if values:
+                insert_values(
+                    cursor, connection.ops.quote_name(UsageInfoRollupDelta._meta.db_table),
+                    ('rollup', *keys, *AGGREGATED), values)
+
+
+def apply_pending() -> int:
+    """Add the pending deltas to the rollups (one write per changed rollup row) and delete them.
+    The concurrent calls have to be serialized by the caller (see pipeline.apply_pending).
+
+    :return: number of the applied deltas
+    """
+    quote = connection.ops.quote_name
+    deltas = UsageInfoRollupDelta.objects.all()
+    with transaction.atomic(), connection.cursor() as cursor:
+        # the deltas committed meanwhile are applied next time
+        last = deltas.aggregate(last=models.Max('id'))['last']
+        if last is None:
+            return 0
+        pending = deltas.filter(id__lte=last)
+        for rollup in ROLLUPS:
+            keys = ', '.join(quote(rollup._meta.get_field(field).column) for field in rollup.dimensions)
+            columns = ', '.join(map(quote, (*AGGREGATED, *DERIVED_METRICS)))
+            sums = ', '.join([
+                *(f'SUM({quote(field)})' for field in AGGREGATED),
+                *(derived_sql(name, lambda field: f'SUM({quote(field)})') for name in DERIVED_METRICS),
+            ])
+            # sorted by the key like apply_delta (the same lock order)
+            cursor.execute(
+                f'INSERT INTO {quote(rollup._meta.db_table)} ({keys}, {columns}) '
+                f'SELECT {keys}, {sums} FROM {quote(UsageInfoRollupDelta._meta.db_table)} '
+                f'WHERE {quote("rollup")} = %s AND {quote("id")} <= %s GROUP BY {keys} ORDER BY {keys} '
+                f'{upsert_sql(rollup)}',
+                [rollup._meta.db_table, last])
+            rollup.objects.filter(record_count__lte=0).delete()
+        count, _ = pending.delete()
+    return count
+
+
+def rebuild() -> None:
+    """Recompute all the rollups from the UsageInfo table (the pending deltas are in it already)"""
+    quote = connection.ops.quote_name
+    with transaction.atomic(), connection.cursor() as cursor:
+        UsageInfoRollupDelta.objects.all().delete()
+        for rollup in ROLLUPS:
+            dimensions = ', '.join(quote(rollup._meta.get_field(field).column) for field in rollup.dimensions)
+            metrics = ', '.join(map(quote, (*AGGREGATED, *DERIVED_METRICS)))
+            sums = ', '.join([
+                *(f'SUM({quote(field)})' for field in METRICS), 'COUNT(*)',
+                *(derived_sql(name, lambda field: f'SUM({quote(field)})') for name in DERIVED_METRICS),
+            ])
+            rollup.objects.all().delete()
+            cursor.execute(
+                f'INSERT INTO {quote(rollup._meta.db_table)} ({dimensions}, {metrics}) '
+                f'SELECT {dimensions}, {sums} FROM {quote(UsageInfo._meta.db_table)} '
+                f'GROUP BY {dimensions}')
+
+
+def verify(tolerance: float = FLOAT_TOLERANCE) -> typ.List[Drift]:
+    """Compare the rollups with the UsageInfo table (one scan of it per rollup), the pending deltas
+    (see UsageInfoRollupDelta) are counted to their rollup rows: a rollup is stale if it missed a write
+
+    :param tolerance: relative tolerance of the float sums
+    :return: rollup rows (or missing ones) with the sums different from the UsageInfo rows, ordered by the key
+    """
+    quote = connection.ops.quote_name
+    floats = {field for field in METRICS if isinstance(UsageInfo._meta.get_field(field), models.FloatField)}
+    drifts = []
+    with connection.cursor() as cursor:
+        for rollup in ROLLUPS:
+            keys = ', '.join(quote(rollup._meta.get_field(field).column) for field in rollup.dimensions)
+            stored = ', '.join(f'{quote(field)} AS {quote(f"stored_{field}")}' for field in AGGREGATED)
+            expected = ', '.join(f'0 AS {quote(f"expected_{field}")}' for field in AGGREGATED)
+            deltas = ', '.join([*map(quote, AGGREGATED), *['0'] * len(AGGREGATED)])
+            rows = ', '.join([*['0'] * len(AGGREGATED), *map(quote, METRICS), '1'])
+            sums = ', '.join(
+                f'SUM({quote(f"{kind}_{field}")})' for kind in ('stored', 'expected') for field in AGGREGATED)
+            differences = ' OR '.join(
+                f'ABS(SUM({quote(f"stored_{field}")}) - SUM({quote(f"expected_{field}")})) '
+                f'> {tolerance!r} * (1 + ABS(SUM({quote(f"expected_{field}")})))' if field in floats else
+                f'SUM({quote(f"stored_{field}")}) <> SUM({quote(f"expected_{field}")})'
+                for field in AGGREGATED)
+            cursor.execute(
+                f'SELECT {keys}, {sums} FROM ('
+                f'SELECT {keys}, {stored}, {expected} FROM {quote(rollup._meta.db_table)} '
+                f'UNION ALL SELECT {keys}, {deltas} FROM {quote(UsageInfoRollupDelta._meta.db_table)} '
+                f'WHERE {quote("rollup")} = %s '
+                f'UNION ALL SELECT {keys}, {rows} FROM {quote(UsageInfo._meta.db_table)}'
+                f') {quote("rows")} GROUP BY {keys} HAVING {differences} ORDER BY {keys}',
+                [rollup._meta.db_table])
+            size = len(rollup.dimensions)
+            for row in cursor.fetchall():
+                drifts.append(Drift(
+                    rollup, dict(zip(rollup.dimensions, row[:size])),
+                    dict(zip(AGGREGATED, row[size:size + len(AGGREGATED)])),
+                    dict(zip(AGGREGATED, row[size + len(AGGREGATED):]))))
+    return drifts
+
+
+def _as_row(usage_info: typ.Union[UsageInfo, dict]) -> Row:
+    fields = [UsageInfo._meta.get_field(field) for field in COLUMNS]
+    if isinstance(usage_info, dict):
+        values = [usage_info.get(field.name) for field in fields]  # values() rows have the dimension ids
+    else:
+        values = [getattr(usage_info, field.attname) for field in fields]
+    # saved instances may still hold the raw (e.g. string) values they were created with
+    return tuple(field.target_field.to_python(value) if field.is_relation else field.to_python(value)
+                 for field, value in zip(fields, values))
+
+
+@receiver(usage_info_loaded)
+def on_usage_info_loaded(sender, rows: typ.Sequence[Row], removed: typ.Sequence[Row] = (), deferred: bool = False,
+                         **kwargs) -> None:
+    if deferred:
+        store_delta(rows, removed)
+    else:
+        apply_delta(rows, removed)
+
+
+@receiver(pre_save, sender=UsageInfo)
+def on_usage_info_pre_save(sender, instance: UsageInfo, **kwargs) -> None:
+    instance._rollup_previous = (
+        UsageInfo.objects.filter(pk=instance.pk).values(*COLUMNS).first() if instance.pk else None)
+
+
+@receiver(post_save, sender=UsageInfo)
+def on_usage_info_saved(sender, instance: UsageInfo, **kwargs) -> None:
+    previous = getattr(instance, '_rollup_previous', None)
+    apply_delta([_as_row(instance)], [_as_row(previous)] if previous is not None else ())
+
+
+@receiver(post_delete, sender=UsageInfo)
+def on_usage_info_deleted(sender, instance: UsageInfo, **kwargs) -> None:
+    apply_rows([_as_row(instance)], sign=-1)
@@ -1,7 +1,9 @@
 import typing as typ
+import functools
 
 from rest_framework import serializers
 
+from .dimensions import DIMENSION_MODELS, cache as dimension_cache
 from .models import UsageInfo
 
 
@@ -11,12 +13,15 @@ class UsageInfoSerializer(serializers.HyperlinkedModelSerializer):
     country = serializers.SerializerMethodField(required=False, allow_null=True)
     os = serializers.SerializerMethodField(required=False, allow_null=True)
     cpi = serializers.FloatField(required=False)
+    ctr = serializers.FloatField(required=False)
+    ipm = serializers.FloatField(required=False)
+    roas = serializers.FloatField(required=False)
 
     class Meta:
         model = UsageInfo
         fields = (
             'date', 'channel', 'country', 'os', 'impressions',
-            'clicks', 'installs', 'spend', 'revenue', 'cpi',
+            'clicks', 'installs', 'spend', 'revenue', 'cpi', 'ctr', 'ipm', 'roas',
         )
 
     @staticmethod
@@ -24,14 +29,71 @@ class UsageInfoSerializer(serializers.HyperlinkedModelSerializer):
         return getattr(obj, field) if hasattr(obj, field) else \
             obj.get(field) if isinstance(obj, dict) else None
 
+    @staticmethod
+    def _get_dimension(obj: typ.Union[dict, UsageInfo], field: str) -> typ.Optional[str]:
+        """Dimension name by the id of a model (<field>_id) or a grouped row (<field>)"""
+        id_ = obj.get(field) if isinstance(obj, dict) else getattr(obj, f'{field}_id', None)
+        return None if id_ is None else dimension_cache.get_name(field, id_)
+
     def get_date(self, obj: typ.Union[dict, UsageInfo]) -> typ.Any:
         return self._get_from_model(obj, 'date')
 
     def get_channel(self, obj: typ.Union[dict, UsageInfo]) -> typ.Any:
-        return self._get_from_model(obj, 'channel')
+        return self._get_dimension(obj, 'channel')
 
     def get_country(self, obj: typ.Union[dict, UsageInfo]) -> typ.Any:
-        return self._get_from_model(obj, 'country')
+        return self._get_dimension(obj, 'country')
 
     def get_os(self, obj: typ.Union[dict, UsageInfo]) -> typ.Any:
-        return self._get_from_model(obj, 'os')
+        return self._get_dimension(obj, 'os')
+
+
+class FastUsageInfoSerializer:
+    """
+    Serializer of values_list() rows giving the same output as UsageInfoSerializer.
+
+    The conversion of every field is planned once, so a row costs a tuple lookup
+    and (for metrics) an int()/float() call or (for dimensions) an id -> name dict lookup per field
+    instead of the DRF field machinery.
+    """
+    integer_fields = ('impressions', 'clicks', 'installs')
+    float_fields = ('spend', 'revenue', 'cpi', 'ctr', 'ipm', 'roas')
+
+    def __init__(self, columns: typ.Sequence[str], fields: typ.Sequence[str] = UsageInfoSerializer.Meta.fields):
+        """
+        :param columns: fields of the values_list() rows
+        :param fields: output fields (missing columns are serialized as None)
+        """
+        self.fields = tuple(fields)
+        self.plan = tuple(
+            (field,
+             columns.index(field) if field in columns else None,
+             int if field in self.integer_fields else float if field in self.float_fields else
+             functools.partial(dimension_cache.get_name, field) if field in DIMENSION_MODELS else None)
+            for field in self.fields
+        )
+
+    def to_representation(self, row: tuple) -> dict:
+        data = {}
+        for field, index, convert in self.plan:
+            value = None if index is None else row[index]
+            data[field] = value if value is None or convert is None else convert(value)
+        return data
+
+    def serialize(self, rows: typ.Iterable[tuple]) -> typ.List[dict]:
+        to_representation = self.to_representation
+        return [to_representation(row) for row in rows]
+
+    def serialize_columns(self, rows: typ.Iterable[tuple]) -> typ.Dict[str, list]:
+        """Serialize the rows column-wise: output field -> values (for the column oriented formats)"""
+        rows = list(rows)
+        columns = list(zip(*rows))
+        data = {}
+        for field, index, convert in self.plan:
+            if index is None or not rows:
+                data[field] = [None] * len(rows)
+            elif convert is None:
+                data[field] = list(columns[index])
+            else:
+                data[field] = [None if value is None else convert(value) for value in columns[index]]
+        return data
@@ -0,0 +1,9 @@
+from django.dispatch import Signal
+
+
+# Sent by the ingestion (inside its transaction) after a batch of rows has been written to UsageInfo.
+# Arguments: rows - sequence of (date, channel, country, os, impressions, clicks, installs, spend, revenue)
+#            removed - optional sequence of the rows replaced by the batch (the previous values of upserted rows)
+#            deferred - optional, True if the rollups and the data version are updated after the load
+#                       (the chunks of the parallel ingestion, see pipeline.py)
+usage_info_loaded = Signal()
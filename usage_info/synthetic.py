@@ -0,0 +1,147 @@
+"""
+Reproducible synthetic usage info data for benchmarks (see the generate_usage_info command).
+
+The dimension values follow skewed (Zipf like) shares: a few big channels and countries have most of the rows
+and the traffic, the long tail shows up on some dates only. The number of rows per date grows towards
+the last date (with a weekly seasonality), every (date, channel, country, os) key is generated once.
+The same options and seed give the same rows.
+"""
+import math
+import heapq
+import random
+import datetime
+import itertools
+import typing as typ
+
+from .ingest import Row
+
+CHANNELS = (
+    'facebook', 'google', 'unityads', 'chartboost', 'vungle', 'apple_search_ads', 'adcolony', 'applovin',
+    'ironsource', 'tiktok', 'snapchat', 'twitter', 'mintegral', 'liftoff', 'moloco', 'digital_turbine',
+)
+COUNTRIES = (
+    'US', 'GB', 'DE', 'CA', 'FR', 'JP', 'BR', 'IN', 'KR', 'AU', 'RU', 'IT', 'ES', 'MX', 'NL', 'TR', 'ID', 'SE',
+    'PL', 'CH', 'TW', 'BE', 'TH', 'AR', 'AT', 'NO', 'DK', 'SA', 'AE', 'SG', 'IL', 'FI', 'PH', 'VN', 'MY', 'ZA',
+    'IE', 'NZ', 'PT', 'CZ', 'RO', 'GR', 'HU', 'UA', 'CL', 'CO', 'PE', 'EG', 'NG', 'PK',
+)
+OPERATING_SYSTEMS = (
+    # name, share
+    ('android', 0.55), ('ios', 0.4), ('windows', 0.03), ('macos', 0.015), ('linux', 0.005),
+)
+DEFAULT_DATE_TO = datetime.date(2017, 6, 30)
+
+
+class Options(typ.NamedTuple):
+    rows: int = 1_000_000
+    days: int = 730
+    date_to: datetime.date = DEFAULT_DATE_TO
+    channels: int = 50
+    countries: int = 200
+    operating_systems: int = 5
+    growth: float = 2.0  # the last date has e^growth times the rows of the first one
+    seed: int = 0
+
+    @property
+    def capacity(self) -> int:
+        """The maximum number of rows (every key on every date)"""
+        return self.days * self.channels * self.countries * self.operating_systems
+
+
+def dimension_names(options: Options) -> typ.Tuple[typ.List[str], typ.List[str], typ.List[str]]:
+    """Channel, country and os names, the well-known ones first, padded with made up ones"""
+    channels = itertools.chain(CHANNELS, (f'network_{i:03}' for i in itertools.count(len(CHANNELS))))
+    # two-letter codes which are not in the list yet
+    codes = (''.join(letters) for letters in itertools.product('ABCDEFGHIJKLMNOPQRSTUVWXYZ', repeat=2))
+    countries = [*COUNTRIES, *(code for code in codes if code not in COUNTRIES)]
+    if options.countries > len(countries):
+        raise ValueError(f'Up to {len(countries)} countries can be generated')
+    operating_systems = itertools.chain(
+        (name for name, _ in OPERATING_SYSTEMS), (f'os_{i:02}' for i in itertools.count(len(OPERATING_SYSTEMS))))
+    return (list(itertools.islice(channels, options.channels)), countries[:options.countries],
+            list(itertools.islice(operating_systems, options.operating_systems)))
+
+
+def zipf_weights(size: int, exponent: float) -> typ.List[float]:
+    return [1 / (rank + 1) ** exponent for rank in range(size)]
+
+
+def rows_per_date(options: Options) -> typ.List[int]:
+    """
+    Split the rows between the dates: proportional to the growth and the weekday weights,
+    a date gets up to the number of the keys and the rest goes to the other dates
+
+    :param options: generator options
+    :return: number of rows of every date (the oldest one first)
+    :raise ValueError: if there are more rows than keys
+    """
+    if options.rows > options.capacity:
+        raise ValueError(
+            f'{options.rows} rows requested, {options.capacity} is the maximum for the dates and dimensions')
+    keys = options.capacity // options.days
+    date_from = options.date_to - datetime.timedelta(days=options.days - 1)
+    weights = {
+        day: math.exp(options.growth * day / max(options.days - 1, 1))
+        * (0.8 if (date_from + datetime.timedelta(days=day)).weekday() >= 5 else 1.0)
+        for day in range(options.days)
+    }
+
+    counts, remaining = [0] * options.days, options.rows
+    while remaining and weights:
+        total = sum(weights.values())
+        full = [day for day, weight in weights.items() if remaining * weight / total >= keys]
+        if not full:
+            # largest remainder rounding
+            shares = {day: remaining * weight / total for day, weight in weights.items()}
+            for day, share in shares.items():
+                counts[day] = int(share)
+            left = remaining - sum(counts[day] for day in shares)
+            for day in sorted(shares, key=lambda day: int(shares[day]) - shares[day])[:left]:
+                counts[day] += 1
+            break
+        for day in full:
+            counts[day] = keys
+            remaining -= keys
+            del weights[day]
+    return counts
+
+
+def generate_rows(options: Options) -> typ.Iterator[Row]:
+    """
+    Generate the rows date by date, the keys of a date are a weighted sample without replacement
+    (the big channels, countries and operating systems are the most likely ones)
+
+    :param options: generator options
+    :return: rows in the ingest.COLUMNS order with the dimension names
+    :raise ValueError: if there are more rows than keys
+    """
+    rng = random.Random(options.seed)
+    channels, countries, operating_systems = dimension_names(options)
+    os_shares = [share for _, share in OPERATING_SYSTEMS]
+    os_weights = [*os_shares, *[os_shares[-1]] * (len(operating_systems) - len(os_shares))][:len(operating_systems)]
+    keys = [
+        (channel, country, os, channel_weight * country_weight * os_weight)
+        for channel, channel_weight in zip(channels, zipf_weights(len(channels), 1.1))
+        for country, country_weight in zip(countries, zipf_weights(len(countries), 1.2))
+        for os, os_weight in zip(operating_systems, os_weights)
+    ]
+    top_weight = max(weight for *_, weight in keys)
+    inverse_weights = [1 / weight for *_, weight in keys]
+    uniform = rng.random
+
+    date_from = options.date_to - datetime.timedelta(days=options.days - 1)
+    for day, count in enumerate(rows_per_date(options)):
+        if not count:
+            continue
+        date = (date_from + datetime.timedelta(days=day)).isoformat()
+        # the keys with the smallest exponential variates (rate = weight) are a weighted sample
+        # without replacement (Efraimidis-Spirakis)
+        variates = [-math.log(1.0 - uniform()) * inverse_weight for inverse_weight in inverse_weights]
+        for index in heapq.nsmallest(count, range(len(keys)), key=variates.__getitem__):
+            channel, country, os, weight = keys[index]
+            impressions = max(1, int(50000 * (weight / top_weight) ** 0.3 * rng.lognormvariate(0, 0.6)))
+            clicks = max(1, round(impressions * rng.uniform(0.005, 0.04)))
+            # at least one install like in the sample dataset
+            installs = max(1, round(clicks * rng.uniform(0.05, 0.3)))
+            spend = round(installs * rng.uniform(0.3, 4.0), 2)
+            revenue = round(spend * rng.lognormvariate(0, 0.5), 2)
+            yield date, channel, country, os, impressions, clicks, installs, spend, revenue
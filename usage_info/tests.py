@@ -1,10 +1,81 @@
+import io
+import csv
+import asyncio
+import json
+import math
+import datetime
+import tempfile
+import contextlib
+import threading
+import time
+import unittest
+import importlib
+import multiprocessing
+from unittest import mock
+import typing as typ
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from urllib.parse import urlencode
+
+from django.apps import apps
+from django.conf import settings
+from django.contrib.sessions.models import Session
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, IntegrityError, connection, connections, transaction
+from django.core.asgi import get_asgi_application
+from django.core.cache import caches
+from django.http import QueryDict
 from django.urls import reverse
+from django.test import LiveServerTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db.migrations.executor import MigrationExecutor
 from rest_framework.views import status
-from rest_framework.test import APITestCase, APIClient
+from rest_framework.request import Request
+from rest_framework.test import APITestCase, APITransactionTestCase, APIClient, APIRequestFactory
 from django.db.models import Sum, F, FloatField, ExpressionWrapper
 
-from .models import UsageInfo
+from . import (
+    cache, coalescing, columnar, derived, instrumentation, partitions, pipeline, replicas, rollups, signals,
+    synthetic, top,
+)
+from .asgi import AsyncUsageInfoApp, asyncpg, compile_plan_sql, to_asyncpg_sql
+from .query import METRIC_FIELDS, QuerySpec, parse_query_params, compile_plan, compile_values_list, get_plan
+from .ingest import COLUMNS, load_csv
+from .dimensions import DIMENSION_MODELS, cache as dimension_cache
+from .models import (
+    UsageInfo, UsageInfoByDate, UsageInfoByChannelCountryOs, UsageInfoByDateChannel, UsageInfoByDateCountryOs,
+    UsageInfoLoadedChunk, UsageInfoRollupDelta, Channel, Country,
+)
+from .renderers import pa, pq
 from .serializers import UsageInfoSerializer
+from .validator import ValidationError
+from .views import UsageInfoView
+
+SAMPLE_DATASET = Path(__file__).parent / 'samples' / 'dataset.csv'
+
+
+def with_dimensions(fields: dict) -> dict:
+    """Replace the channel, country and os names by the rows of the dimension tables"""
+    return {field: DIMENSION_MODELS[field].objects.get_or_create(name=value)[0] if field in DIMENSION_MODELS else value
+            for field, value in fields.items()}
+
+
+def run_coalesced(barrier: typ.Any, queries: typ.Any, results: typ.Any) -> None:
+    """Run a slow query through the coalescer of a (forked) worker process"""
+    def query():
+        with queries.get_lock():
+            queries.value += 1
+        time.sleep(0.5)
+        caches['usage_info'].set('usage_info:key', 'rows')
+        return 'rows'
+
+    barrier.wait()
+    results.put(coalescing.Coalescer().run('usage_info:key', query))
+
+
+def dimension_ids(field: str, names: typ.Iterable[str]) -> list:
+    return list(DIMENSION_MODELS[field].objects.filter(name__in=names).values_list('id', flat=True))
 
 
 class BaseViewTest(APITestCase):
@@ -12,7 +83,7 @@ class BaseViewTest(APITestCase):
 
     @staticmethod
     def create_usage_info(**kwargs):
-        UsageInfo.objects.create(**kwargs)
+        UsageInfo.objects.create(**with_dimensions(kwargs))
 
     def setUp(self):
         self.create_usage_info(
@@ -125,7 +196,7 @@ class GetUsageInfoFilterChannels(BaseViewTest):
         response = self.client.get(
             reverse("usage-info"), {"channels": channel}
         )
-        expected = UsageInfo.objects.filter(channel__in=[channel])
+        expected = UsageInfo.objects.filter(channel__in=dimension_ids('channel', [channel]))
         serialized = UsageInfoSerializer(expected, many=True)
 
         self.assertEqual(response.status_code, status.HTTP_200_OK)
@@ -136,7 +207,7 @@ class GetUsageInfoFilterChannels(BaseViewTest):
         response = self.client.get(
             reverse("usage-info"), {"channels": channels}
         )
-        expected = UsageInfo.objects.filter(channel__in=channels.split(','))
+        expected = UsageInfo.objects.filter(channel__in=dimension_ids('channel', channels.split(',')))
         serialized = UsageInfoSerializer(expected, many=True)
 
         self.assertEqual(response.status_code, status.HTTP_200_OK)
@@ -164,7 +235,7 @@ class GetUsageInfoFilterCountries(BaseViewTest):
         response = self.client.get(
             reverse("usage-info"), {"countries": country}
         )
-        expected = UsageInfo.objects.filter(country__in=[country])
+        expected = UsageInfo.objects.filter(country__in=dimension_ids('country', [country]))
         serialized = UsageInfoSerializer(expected, many=True)
 
         self.assertEqual(response.status_code, status.HTTP_200_OK)
@@ -175,7 +246,7 @@ class GetUsageInfoFilterCountries(BaseViewTest):
         response = self.client.get(
             reverse("usage-info"), {"countries": countries}
         )
-        expected = UsageInfo.objects.filter(country__in=countries.split(','))
+        expected = UsageInfo.objects.filter(country__in=dimension_ids('country', countries.split(',')))
         serialized = UsageInfoSerializer(expected, many=True)
 
         self.assertEqual(response.status_code, status.HTTP_200_OK)
@@ -203,7 +274,7 @@ class GetUsageInfoFilterOS(BaseViewTest):
         response = self.client.get(
             reverse("usage-info"), {"os": os}
         )
-        expected = UsageInfo.objects.filter(os__in=[os])
+        expected = UsageInfo.objects.filter(os__in=dimension_ids('os', [os]))
         serialized = UsageInfoSerializer(expected, many=True)
 
         self.assertEqual(response.status_code, status.HTTP_200_OK)
@@ -214,7 +285,7 @@ class GetUsageInfoFilterOS(BaseViewTest):
         response = self.client.get(
             reverse("usage-info"), {"os": os}
         )
-        expected = UsageInfo.objects.filter(os__in=os.split(','))
+        expected = UsageInfo.objects.filter(os__in=dimension_ids('os', os.split(',')))
         serialized = UsageInfoSerializer(expected, many=True)
 
         self.assertEqual(response.status_code, status.HTTP_200_OK)
@@ -248,7 +319,7 @@ class UsageInfoGroupBy(BaseViewTest):
             installs=Sum('installs'),
             spend=Sum('spend'),
             revenue=Sum('revenue')
-        )
+        ).order_by(group_by)
         serialized = UsageInfoSerializer(expected, many=True)
 
         self.assertEqual(response.status_code, status.HTTP_200_OK)
@@ -266,7 +337,7 @@ class UsageInfoGroupBy(BaseViewTest):
             installs=Sum('installs'),
             spend=Sum('spend'),
             revenue=Sum('revenue')
-        )
+        ).order_by(*group_by)
         serialized = UsageInfoSerializer(expected, many=True)
 
         self.assertEqual(response.status_code, status.HTTP_200_OK)
@@ -363,3 +434,2168 @@ class UsageInfoCPI(BaseViewTest):
             reverse("usage-info"), {"cpi": cpi, "sort_by": 'cpi'}
         )
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class DerivedMetrics(APITestCase):
+    NAMES = tuple(derived.DERIVED_METRICS)
+
+    @classmethod
+    def setUpTestData(cls):
+        with open(SAMPLE_DATASET) as csvf:
+            load_csv(csvf)
+        # nothing to divide by
+        UsageInfo.objects.create(**with_dimensions(dict(
+            date='2017-05-17', channel='zero', country='US', os='ios',
+            impressions=0, clicks=0, installs=0, spend=0, revenue=1.5)))
+
+    def setUp(self):
+        caches['usage_info'].clear()
+        compile_plan.cache_clear()
+        columnar.clear()
+
+    def get_rows(self, query_params: dict) -> list:
+        caches['usage_info'].clear()
+        response = self.client.get(reverse("usage-info"), {'limit': 10000, **query_params})
+        self.assertEqual(response.status_code, status.HTTP_200_OK, response.data)
+        return response.data['results']
+
+    def assertDerived(self, row: dict, names: typ.Sequence[str] = NAMES):
+        for name in names:
+            expected = derived.compute(name, row)
+            if expected is None:
+                self.assertIsNone(row[name], name)
+            else:
+                self.assertAlmostEqual(row[name], expected, msg=name)
+
+    def test_parse(self):
+        spec = parse_query_params(QueryDict('metrics=roas,ctr,roas&cpi=1'))
+        self.assertEqual(spec.metrics, ('cpi', 'ctr', 'roas'))
+        self.assertEqual(spec, parse_query_params(QueryDict('metrics=cpi,ctr,roas')))
+        for query_params in ('metrics=cpm', 'group_by=channel&sort_by=-ctr', 'metrics=ipm&sort_by=roas'):
+            with self.subTest(query_params=query_params), self.assertRaises(ValidationError):
+                parse_query_params(QueryDict(query_params))
+
+    def test_only_requested_metrics(self):
+        row, = self.get_rows({'group_by': 'os', 'metrics': 'ipm', 'os': 'ios'})
+        self.assertIn('ipm', row)
+        self.assertFalse({'cpi', 'ctr', 'roas'} & row.keys())
+
+    def test_values(self):
+        for query_params in (
+                {'group_by': 'channel'},  # sums of a rollup
+                {'group_by': 'date,channel'},  # rows of a rollup
+                {'group_by': 'date:month,os'},
+                {'date_from': '2017-06-01'},  # usage info rows
+                {'group_by': 'country', 'totals': '1'}):
+            with self.subTest(**query_params):
+                rows = self.get_rows({**query_params, 'metrics': ','.join(self.NAMES)})
+                self.assertTrue(rows)
+                for row in rows:
+                    self.assertDerived(row)
+
+    def test_division_by_zero(self):
+        for engine in ('orm', 'columnar'):
+            for query_params in ({}, {'group_by': 'channel'}, {'group_by': 'date,channel'}, {'totals': '1'}):
+                with self.subTest(engine=engine, **query_params), override_settings(USAGE_INFO_ENGINE=engine):
+                    rows = self.get_rows(
+                        {'group_by': 'channel', **query_params, 'channels': 'zero', 'metrics': ','.join(self.NAMES)})
+                    self.assertTrue(rows)
+                    for row in rows:
+                        self.assertEqual([row[name] for name in self.NAMES], [None] * len(self.NAMES))
+
+    def test_nulls_sorted_last(self):
+        query_params = {'group_by': 'channel', 'metrics': 'roas', 'date_from': '2017-05-17', 'date_to': '2017-05-17'}
+        top = self.get_rows({**query_params, 'top': '100', 'top_by': 'roas'})
+        for sort_by in ('-roas', 'roas'):
+            with self.subTest(sort_by=sort_by):
+                rows = self.get_rows({**query_params, 'sort_by': sort_by})
+                self.assertEqual((rows[-1]['channel'], rows[-1]['roas']), ('zero', None))
+                self.assertTrue(all(row['roas'] is not None for row in rows[:-1]))
+                if sort_by == '-roas':
+                    self.assertEqual(top, rows)
+                with override_settings(USAGE_INFO_ENGINE='columnar'):
+                    columnar_rows = self.get_rows({**query_params, 'sort_by': sort_by})
+                self.assertEqual([row['channel'] for row in columnar_rows], [row['channel'] for row in rows])
+
+                pages = []
+                response = self.client.get(
+                    reverse("usage-info"), {**query_params, 'sort_by': sort_by, 'pagination': 'cursor', 'limit': 2})
+                pages.extend(response.data['results'])
+                while response.data['next']:
+                    response = self.client.get(response.data['next'])
+                    pages.extend(response.data['results'])
+                self.assertEqual(pages, rows)
+
+    def test_sorted_by_stored_metric(self):
+        query_params = {'group_by': 'date,channel', 'metrics': 'roas,ipm', 'sort_by': '-roas'}
+        with CaptureQueriesContext(connection) as queries:
+            rows = self.get_rows(query_params)
+        sql = ' '.join(query['sql'] for query in queries.captured_queries)
+        # a group is a row of the rollup, the stored metric is read and sorted by
+        self.assertIn(UsageInfoByDateChannel._meta.db_table, sql)
+        self.assertNotIn('GROUP BY', sql)
+        self.assertNotIn('NULLIF', sql)
+
+        with override_settings(USAGE_INFO_ROLLUPS=False):
+            expected = self.get_rows(query_params)
+        self.assertEqual(len(rows), len(expected))
+        self.assertEqual(
+            [(row['date'], row['channel']) for row in rows], [(row['date'], row['channel']) for row in expected])
+        for row in rows:
+            self.assertDerived(row, ('roas', 'ipm'))
+
+
+class LoadUsageInfo(APITestCase):
+    header = 'date,channel,country,os,impressions,clicks,installs,spend,revenue\n'
+
+    def load(self, content: str, *args):
+        with tempfile.NamedTemporaryFile('wt', suffix='.csv') as csvf:
+            csvf.write(content)
+            csvf.flush()
+            out = io.StringIO()
+            call_command('load_usage_info', csvf.name, *args, stdout=out, stderr=io.StringIO())
+        return out.getvalue()
+
+    def test_load_sample_dataset(self):
+        out = io.StringIO()
+        call_command('load_usage_info', str(SAMPLE_DATASET), '--chunk-size', '100', stdout=out)
+
+        with open(SAMPLE_DATASET) as csvf:
+            expected = sum(1 for _ in csvf) - 1
+        self.assertEqual(UsageInfo.objects.count(), expected)
+        self.assertIn(f'Loaded {expected} records', out.getvalue())
+        self.assertIn('rows/sec', out.getvalue())
+
+    def test_load_big_chunks(self):
+        # more rows per chunk than a single INSERT of SQLite takes
+        out = io.StringIO()
+        call_command('load_usage_info', str(SAMPLE_DATASET), stdout=out)
+
+        with open(SAMPLE_DATASET) as csvf:
+            expected = sum(1 for _ in csvf) - 1
+        self.assertGreater(expected, 500)
+        self.assertEqual(UsageInfo.objects.count(), expected)
+
+    def test_load_converts_values(self):
+        self.load(self.header + '2017-05-17,adcolony,US,android,19887,494,76,148.2,149.04\n')
+        usage_info = UsageInfo.objects.get()
+        self.assertEqual(str(usage_info.date), '2017-05-17')
+        self.assertEqual(usage_info.installs, 76)
+        self.assertEqual(usage_info.revenue, 149.04)
+
+    def test_load_invalid_row(self):
+        content = self.header + '2017-05-17,adcolony,US,android,19887,494,76,148.2,149.04\n' \
+                                '2017-05-32,adcolony,US,ios,13886,336,60,100.8,210.24\n'
+        with self.assertRaisesMessage(CommandError, 'Line 3'):
+            self.load(content)
+        self.assertEqual(UsageInfo.objects.count(), 0)
+
+    def test_load_skip_invalid_rows(self):
+        content = self.header + '2017-05-17,adcolony,US,android,19887,494,76,148.2,149.04\n' \
+                                '2017-05-17,adcolony,US,ios,-1,336,60,100.8,210.24\n' \
+                                '2017-05-17,,US,ios,13886,336,60,100.8,210.24\n'
+        self.load(content, '--skip-invalid')
+        self.assertEqual(UsageInfo.objects.count(), 1)
+
+    def test_load_not_finite_metrics(self):
+        for value in ('nan', 'inf', '-inf', '-nan'):
+            with self.subTest(value=value), self.assertRaisesMessage(CommandError, 'Got not correct spend'):
+                self.load(self.header + f'2017-05-17,adcolony,US,android,19887,494,76,{value},149.04\n')
+        self.assertEqual(UsageInfo.objects.count(), 0)
+
+    def test_load_bad_header(self):
+        with self.assertRaises(CommandError):
+            self.load('date,channel\n2017-05-17,adcolony\n')
+
+
+@unittest.skipUnless(connection.vendor == 'postgresql', 'EXPLAIN plans are checked on PostgreSQL only')
+@override_settings(USAGE_INFO_ROLLUPS=False)
+class UsageInfoIndexes(APITestCase):
+    """The README example queries should be able to use the usage info indexes"""
+    indexes = {
+        'usage_info_date_brin_idx', 'usage_info_channel_cov_idx',
+        'usage_info_country_cov_idx', 'usage_info_os_cov_idx',
+    }
+
+    @classmethod
+    def setUpTestData(cls):
+        with open(SAMPLE_DATASET) as csvf:
+            load_csv(csvf)
+        with connection.cursor() as cursor:
+            cursor.execute(f'ANALYZE {UsageInfo._meta.db_table}')
+
+    @staticmethod
+    def index_scans(query_params: dict) -> dict:
+        """Return index name -> index condition for every index scan in the query plan"""
+        view = UsageInfoView(request=Request(APIRequestFactory().get('/usage_info', query_params)))
+        sql, params = view.get_queryset().query.sql_with_params()
+        with connection.cursor() as cursor:
+            # the sample dataset is tiny, so a sequential scan would always win otherwise
+            cursor.execute('SET LOCAL enable_seqscan = off')
+            cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+            plan = cursor.fetchone()[0]
+            cursor.execute('SET LOCAL enable_seqscan = on')
+
+            # indexes of the partitions -> the indexes created on the partitioned table
+            cursor.execute(
+                'SELECT child.relname, parent.relname FROM pg_inherits '
+                'JOIN pg_class child ON child.oid = pg_inherits.inhrelid '
+                'JOIN pg_class parent ON parent.oid = pg_inherits.inhparent '
+                "WHERE child.relkind = 'i'")
+            parents = dict(cursor.fetchall())
+
+        scans, nodes = {}, [plan[0]['Plan']]
+        while nodes:
+            node = nodes.pop()
+            if 'Index Name' in node:
+                scans[parents.get(node['Index Name'], node['Index Name'])] = node.get('Index Cond')
+            nodes.extend(node.get('Plans', ()))
+        return scans
+
+    def assertIndexesUsed(self, query_params: dict, *columns: str):
+        scans = self.index_scans(query_params)
+        self.assertTrue(scans)
+        self.assertLessEqual(set(scans), self.indexes)
+        conditions = ' '.join(filter(None, scans.values()))
+        for column in columns:
+            self.assertIn(column, conditions)
+
+    def test_filter_date_to_group_by_channel_country(self):
+        self.assertIndexesUsed(
+            {'date_to': '2017-06-01', 'group_by': 'channel,country', 'sort_by': '-clicks'}, 'date')
+
+    def test_filter_date_range_os_group_by_date(self):
+        self.assertIndexesUsed(
+            {'date_from': '2017-05-01', 'date_to': '2017-05-31', 'os': 'ios', 'group_by': 'date', 'sort_by': 'date'},
+            'date')
+
+    def test_filter_date_country_group_by_os(self):
+        self.assertIndexesUsed(
+            {'date_from': '2017-06-01', 'date_to': '2017-06-01', 'countries': 'US',
+             'group_by': 'os', 'sort_by': '-revenue'}, 'date')
+
+    def test_filter_country_group_by_channel(self):
+        self.assertIndexesUsed(
+            {'cpi': '1', 'countries': 'CA', 'group_by': 'channel', 'sort_by': '-cpi'}, 'country')
+
+
+class RollupsAssertions:
+
+    @staticmethod
+    def aggregate(model, dimensions) -> dict:
+        rows = model.objects.values_list(*dimensions).annotate(
+            Sum('impressions'), Sum('clicks'), Sum('installs'), Sum('spend'), Sum('revenue'))
+        return {row[:len(dimensions)]: (*row[len(dimensions):-2], *(round(v, 6) for v in row[-2:]))
+                for row in rows}
+
+    def assertRollupsConsistent(self):
+        for rollup in rollups.ROLLUPS:
+            self.assertEqual(
+                self.aggregate(rollup, rollup.dimensions),
+                self.aggregate(UsageInfo, rollup.dimensions), rollup.__name__)
+            # the stored derived metrics are the ones of the stored sums
+            for row in rollup.objects.values(*METRIC_FIELDS, *derived.DERIVED_METRICS):
+                for name in derived.DERIVED_METRICS:
+                    expected = derived.compute(name, row)
+                    if expected is None:
+                        self.assertIsNone(row[name], rollup.__name__)
+                    else:
+                        self.assertAlmostEqual(row[name], expected, msg=rollup.__name__)
+
+
+class UsageInfoRollups(RollupsAssertions, APITestCase):
+    def test_rollups_maintained_on_load(self):
+        with open(SAMPLE_DATASET) as csvf:
+            load_csv(csvf, chunk_size=300)
+        self.assertRollupsConsistent()
+
+    def test_rollups_maintained_on_save_and_delete(self):
+        usage_info = UsageInfo.objects.create(**with_dimensions(dict(
+            date='2019-12-06', channel='adcolony', country='US', os='ios',
+            impressions='100', clicks='10', installs='2', spend='4.0', revenue='5.5')))
+        UsageInfo.objects.create(**with_dimensions(dict(
+            date='2019-12-06', channel='adcolony', country='US', os='android',
+            impressions=200, clicks=20, installs=4, spend=8.0, revenue=11.0)))
+        self.assertRollupsConsistent()
+
+        usage_info.channel = Channel.objects.create(name='facebook')
+        usage_info.save()
+        self.assertRollupsConsistent()
+
+        usage_info.delete()
+        self.assertRollupsConsistent()
+        self.assertFalse(UsageInfoByChannelCountryOs.objects.filter(channel__name='facebook').exists())
+
+    def test_rebuild(self):
+        with open(SAMPLE_DATASET) as csvf:
+            load_csv(csvf)
+        UsageInfoByDateCountryOs.objects.all().delete()
+        call_command('rebuild_usage_info_rollups', stdout=io.StringIO())
+        self.assertRollupsConsistent()
+
+    def test_verify(self):
+        with open(SAMPLE_DATASET) as csvf:
+            load_csv(csvf)
+        self.assertEqual(rollups.verify(), [])
+
+        # bypasses the rollups
+        UsageInfo.objects.filter(country__name='US', os__name='ios').update(clicks=F('clicks') + 1)
+        drifts = rollups.verify()
+        self.assertEqual({drift.rollup for drift in drifts}, set(rollups.ROLLUPS))
+        drift = next(drift for drift in drifts if drift.rollup is UsageInfoByChannelCountryOs)
+        self.assertEqual(drift.key['country'], Country.objects.get(name='US').id)
+        self.assertEqual(drift.expected['clicks'] - drift.stored['clicks'], drift.stored['record_count'])
+
+        out = io.StringIO()
+        with self.assertRaisesRegex(CommandError, f'{len(drifts)} stale rollup rows'):
+            call_command('verify_usage_info_rollups', stdout=out)
+        by_date = [drift for drift in drifts if drift.rollup is UsageInfoByDate]
+        self.assertIn(f'UsageInfoByDate: {len(by_date)} stale rows', out.getvalue())
+        version = cache.current_version()
+        call_command('verify_usage_info_rollups', '--rebuild', stdout=out)
+        self.assertRollupsConsistent()
+        self.assertEqual(rollups.verify(), [])
+        self.assertNotEqual(cache.current_version(), version)
+
+    def test_verify_pending_deltas(self):
+        with open(SAMPLE_DATASET) as csvf:
+            load_csv(csvf)
+        date, _, *row = UsageInfo.objects.values_list(*COLUMNS).first()
+        row = (date, Channel.objects.create(name='unity').id, *row)
+        UsageInfo.objects.bulk_create([UsageInfo(**{
+            UsageInfo._meta.get_field(field).attname: value for field, value in zip(COLUMNS, row)})])
+        self.assertEqual(len(rollups.verify()), len(rollups.ROLLUPS))
+
+        # the rollups of a parallel load are stale until the deltas are applied
+        rollups.store_delta([row])
+        self.assertEqual(rollups.verify(), [])
+        rollups.apply_pending()
+        self.assertEqual(rollups.verify(), [])
+        self.assertRollupsConsistent()
+
+    def test_route(self):
+        self.assertIs(rollups.route({'channel', 'country'}), UsageInfoByChannelCountryOs)
+        self.assertIs(rollups.route({'date', 'os'}), UsageInfoByDateCountryOs)
+        self.assertIs(rollups.route({'date', 'channel', 'os'}), UsageInfo)
+
+    def test_view_uses_rollup(self):
+        with open(SAMPLE_DATASET) as csvf:
+            load_csv(csvf)
+        query_params = {'countries': 'CA', 'group_by': 'channel', 'sort_by': '-clicks'}
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse("usage-info"), query_params)
+        sql = ' '.join(query['sql'] for query in queries.captured_queries)
+        self.assertIn(UsageInfoByChannelCountryOs._meta.db_table, sql)
+        self.assertNotIn(f'"{UsageInfo._meta.db_table}"', sql)
+
+        caches['usage_info'].clear()
+        with override_settings(USAGE_INFO_ROLLUPS=False):
+            expected = self.client.get(reverse("usage-info"), query_params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['count'], expected.data['count'])
+        for row, expected_row in zip(response.data['results'], expected.data['results']):
+            self.assertEqual(row['channel'], expected_row['channel'])
+            self.assertEqual(row['clicks'], expected_row['clicks'])
+            self.assertAlmostEqual(row['spend'], expected_row['spend'])
+
+
+class UsageInfoUpsert(RollupsAssertions, APITestCase):
+    header = 'date,channel,country,os,impressions,clicks,installs,spend,revenue\n'
+
+    @classmethod
+    def setUpTestData(cls):
+        with open(SAMPLE_DATASET) as csvf:
+            load_csv(csvf, chunk_size=300)
+
+    def upsert(self, content: str, **kwargs):
+        return load_csv(io.StringIO(self.header + content), upsert=True, **kwargs)
+
+    @staticmethod
+    def get_usage_info(date: str, channel: str, country: str, os: str) -> UsageInfo:
+        return UsageInfo.objects.get(date=date, channel__name=channel, country__name=country, os__name=os)
+
+    def test_reload_changes_nothing(self):
+        version = cache.current_version()
+        with open(SAMPLE_DATASET) as csvf:
+            stats = load_csv(csvf, chunk_size=300, upsert=True)
+
+        self.assertEqual((stats.rows, stats.inserted, stats.updated, stats.unchanged), (1096, 0, 0, 1096))
+        self.assertEqual(UsageInfo.objects.count(), 1096)
+        self.assertEqual(cache.current_version(), version)
+        self.assertRollupsConsistent()
+
+    def test_upsert_corrected_and_new_rows(self):
+        stats = self.upsert(
+            '2017-05-17,adcolony,US,android,19887,494,76,148.2,149.04\n'  # unchanged
+            '2017-05-17,adcolony,US,ios,13886,336,61,110.5,210.24\n'  # corrected
+            '2017-05-17,adcolony,US,windows,10,1,1,1.5,2.0\n')  # new
+
+        self.assertEqual((stats.inserted, stats.updated, stats.unchanged), (1, 1, 1))
+        self.assertEqual(UsageInfo.objects.count(), 1097)
+        corrected = self.get_usage_info('2017-05-17', 'adcolony', 'US', 'ios')
+        self.assertEqual((corrected.installs, corrected.spend), (61, 110.5))
+        self.assertRollupsConsistent()
+
+    def test_upsert_changes_only_sent(self):
+        loaded = []
+
+        def receiver(sender, rows, removed=(), **kwargs):
+            loaded.append((list(rows), list(removed)))
+
+        signals.usage_info_loaded.connect(receiver)
+        try:
+            self.upsert(
+                '2017-05-17,adcolony,US,android,19887,494,76,148.2,149.04\n'
+                '2017-05-17,adcolony,US,ios,13886,336,61,100.8,210.24\n')
+        finally:
+            signals.usage_info_loaded.disconnect(receiver)
+
+        ids = {field: dimension_ids(field, [name])[0] for field, name in
+               (('channel', 'adcolony'), ('country', 'US'), ('os', 'ios'))}
+        key = (datetime.date(2017, 5, 17), ids['channel'], ids['country'], ids['os'])
+        self.assertEqual(loaded, [([(*key, 13886, 336, 61, 100.8, 210.24)], [(*key, 13886, 336, 60, 100.8, 210.24)])])
+
+    def test_last_row_of_key_wins(self):
+        stats = self.upsert(
+            '2017-05-17,adcolony,US,ios,1,1,1,1.0,1.0\n'
+            '2017-05-17,adcolony,US,ios,2,2,2,2.0,2.0\n')
+
+        self.assertEqual((stats.rows, stats.inserted, stats.updated, stats.unchanged), (2, 0, 1, 0))
+        corrected = self.get_usage_info('2017-05-17', 'adcolony', 'US', 'ios')
+        self.assertEqual(corrected.impressions, 2)
+        self.assertRollupsConsistent()
+
+    def test_upsert_big_chunk(self):
+        # more new rows per chunk than a single INSERT of SQLite takes
+        stats = self.upsert(''.join(f'2018-01-01,channel_{i},US,ios,1,1,1,1.0,1.0\n' for i in range(600)))
+
+        self.assertEqual((stats.inserted, stats.updated, stats.unchanged), (600, 0, 0))
+        self.assertEqual(UsageInfo.objects.count(), 1696)
+        self.assertRollupsConsistent()
+
+    def test_command(self):
+        out = io.StringIO()
+        call_command('load_usage_info', str(SAMPLE_DATASET), '--upsert', stdout=out)
+        self.assertIn('Inserted 0, updated 0, unchanged 1096 records', out.getvalue())
+
+    def test_migration_stops_on_duplicates(self):
+        migration = importlib.import_module('usage_info.migrations.0008_usage_info_natural_key')
+        schema_editor = mock.Mock(connection=connection)
+        migration.check_duplicates(apps, schema_editor)
+
+        # the rows loaded twice before the unique index
+        with connection.cursor() as cursor:
+            cursor.execute(f'DROP INDEX {migration.INDEX}')
+        row = self.get_usage_info('2017-05-17', 'adcolony', 'US', 'ios')
+        row.pk = None
+        UsageInfo.objects.bulk_create([row])
+        with self.assertRaisesMessage(IntegrityError, '2017-05-17 adcolony US ios: 2 rows'):
+            migration.check_duplicates(apps, schema_editor)
+        self.assertEqual(UsageInfo.objects.count(), 1097)
+
+
+@unittest.skipUnless(connection.vendor == 'postgresql', 'the upsert of SQLite runs alone (a single writer)')
+class ConcurrentUpsert(RollupsAssertions, APITransactionTestCase):
+
+    def test_key_inserted_meanwhile(self):
+        header = UsageInfoUpsert.header
+        load_csv(io.StringIO(header + '2017-05-17,adcolony,US,ios,13886,336,60,100.8,210.24\n'))
+        row = UsageInfo.objects.get()
+        inserted = threading.Event()
+
+        def insert():
+            # not committed yet when the upsert starts
+            try:
+                with transaction.atomic():
+                    UsageInfo.objects.create(
+                        date='2017-05-18', channel=row.channel, country=row.country, os=row.os,
+                        impressions=10, clicks=1, installs=1, spend=1.5, revenue=2.0)
+                    inserted.set()
+                    time.sleep(0.5)
+            finally:
+                connection.close()
+
+        thread = threading.Thread(target=insert)
+        thread.start()
+        inserted.wait()
+        stats = load_csv(io.StringIO(header + '2017-05-18,adcolony,US,ios,20,2,2,3.0,4.0\n'), upsert=True)
+        thread.join()
+
+        self.assertEqual((stats.inserted, stats.updated, stats.unchanged), (0, 1, 0))
+        self.assertEqual(UsageInfo.objects.count(), 2)
+        self.assertRollupsConsistent()
+
+
+class ParallelLoad(RollupsAssertions, APITestCase):
+    with open(SAMPLE_DATASET) as csvf:
+        expected = sum(1 for _ in csvf) - 1
+
+    def test_split_ranges(self):
+        with open(SAMPLE_DATASET, 'rb') as file:
+            header = len(file.readline())
+            ranges = pipeline.pending_ranges(file, [], 5000)
+            content = SAMPLE_DATASET.read_bytes()
+            self.assertEqual(ranges[0][0], header)
+            self.assertEqual(ranges[-1][1], len(content))
+            self.assertTrue(all(end == start for (_, end), (start, _) in zip(ranges, ranges[1:])))
+            self.assertTrue(all(content[end - 1:end] == b'\n' for _, end in ranges[:-1]))
+            # the loaded ranges are skipped, the rest is split again
+            rest = pipeline.pending_ranges(file, ranges[2:4], 2000)
+        self.assertEqual(rest[0][0], header)
+        self.assertIn((ranges[2][0], ranges[3][1]), [(end, start) for (_, end), (start, _) in zip(rest, rest[1:])])
+        self.assertFalse(any(ranges[2][0] <= start < ranges[3][1] for start, _ in rest))
+
+    def test_load_by_chunks(self):
+        stats = pipeline.load_file(str(SAMPLE_DATASET), processes=1, chunk_bytes=5000)
+        self.assertEqual((stats.rows, stats.inserted, stats.skipped_chunks), (self.expected, self.expected, 0))
+        self.assertEqual(UsageInfo.objects.count(), self.expected)
+        self.assertEqual(UsageInfoLoadedChunk.objects.count(), stats.chunks)
+        self.assertGreater(stats.chunks, 10)
+        self.assertRollupsConsistent()
+
+    def test_resume(self):
+        calls = []
+
+        def crash(sender, **kwargs):
+            calls.append(1)
+            if len(calls) == 3:
+                raise RuntimeError('crash')
+
+        signals.usage_info_loaded.connect(crash)
+        try:
+            with self.assertRaises(RuntimeError):
+                pipeline.load_file(str(SAMPLE_DATASET), processes=1, chunk_bytes=5000)
+        finally:
+            signals.usage_info_loaded.disconnect(crash)
+        self.assertEqual(UsageInfoLoadedChunk.objects.count(), 2)
+        loaded = UsageInfo.objects.count()
+        self.assertEqual(loaded, sum(UsageInfoLoadedChunk.objects.values_list('rows', flat=True)))
+        # the loaded chunks reach the rollups when the load stops
+        self.assertFalse(UsageInfoRollupDelta.objects.exists())
+        self.assertRollupsConsistent()
+
+        # a different chunk size splits the rest of the file again
+        stats = pipeline.load_file(str(SAMPLE_DATASET), processes=1, chunk_bytes=8000)
+        self.assertEqual((stats.skipped_chunks, stats.rows), (2, self.expected - loaded))
+        self.assertEqual(UsageInfo.objects.count(), self.expected)
+        self.assertRollupsConsistent()
+
+        stats = pipeline.load_file(str(SAMPLE_DATASET), processes=1)
+        self.assertEqual((stats.rows, stats.chunks), (0, 0))
+
+    def test_deferred_rollups(self):
+        version = cache.current_version()
+        with open(SAMPLE_DATASET, 'rb') as file:
+            source = pipeline.fingerprint(file)
+            ranges = pipeline.pending_ranges(file, [], 5000)
+        # a chunk committed by a load killed before it applied the rollup deltas
+        pipeline.load_range(str(SAMPLE_DATASET), source, ranges[0], pipeline.ChunkOptions())
+        self.assertTrue(UsageInfoRollupDelta.objects.exists())
+        self.assertFalse(UsageInfoByDate.objects.exists())
+        self.assertEqual(cache.current_version(), version)
+
+        # the next load applies them along with its own ones, the data version is bumped once
+        pipeline.load_file(str(SAMPLE_DATASET), processes=1, chunk_bytes=5000)
+        self.assertFalse(UsageInfoRollupDelta.objects.exists())
+        self.assertEqual(UsageInfo.objects.count(), self.expected)
+        self.assertEqual(cache.current_version()[0], version[0] + 1)
+        self.assertRollupsConsistent()
+
+    def test_deferred_upsert(self):
+        pipeline.load_file(str(SAMPLE_DATASET), processes=1, chunk_bytes=5000)
+        with open(SAMPLE_DATASET) as csvf:
+            header, *records = csv.reader(csvf)
+        # the corrected installs of every other row
+        for record in records[::2]:
+            record[6] = str(int(record[6]) + 1)
+        with tempfile.NamedTemporaryFile('wt', suffix='.csv', newline='') as csvf:
+            csv.writer(csvf, lineterminator='\n').writerows([header, *records])
+            csvf.flush()
+            stats = pipeline.load_file(
+                csvf.name, processes=1, chunk_bytes=5000, options=pipeline.ChunkOptions(upsert=True))
+        self.assertEqual((stats.updated, stats.unchanged), (len(records[::2]), len(records[1::2])))
+        self.assertRollupsConsistent()
+
+    def test_invalid_row(self):
+        line = '2017-05-1{},adcolony,US,android,19887,494,76,148.2,149.04\n'
+        content = LoadUsageInfo.header + ''.join(line.format(day) for day in range(3)) \
+            + '2017-05-32,adcolony,US,ios,13886,336,60,100.8,210.24\n'
+        with tempfile.NamedTemporaryFile('wt', suffix='.csv') as csvf:
+            csvf.write(content)
+            csvf.flush()
+            # the chunks of 2 lines
+            second_chunk = len(LoadUsageInfo.header) + 2 * len(line.format(0))
+            with self.assertRaisesMessage(ValidationError, f'Chunk at byte {second_chunk}: Line 2'):
+                pipeline.load_file(csvf.name, processes=1, chunk_bytes=100)
+            stats = pipeline.load_file(
+                csvf.name, processes=1, chunk_bytes=100, options=pipeline.ChunkOptions(skip_invalid=True, upsert=True))
+        self.assertEqual((stats.rows, stats.rejected, stats.skipped_chunks), (1, 1, 1))
+        self.assertEqual(UsageInfo.objects.count(), 3)
+
+    def test_load_command(self):
+        out = io.StringIO()
+        call_command('load_usage_info', str(SAMPLE_DATASET), '--processes', '1', stdout=out)
+        self.assertIn(f'Loaded {self.expected} records', out.getvalue())
+        out = io.StringIO()
+        call_command('load_usage_info', str(SAMPLE_DATASET), '--processes', '1', stdout=out)
+        self.assertIn('Skipped 1 chunks loaded by a previous run', out.getvalue())
+        out = io.StringIO()
+        call_command('load_usage_info', str(SAMPLE_DATASET), '--processes', '1', '--restart', '--upsert', stdout=out)
+        self.assertIn(f'unchanged {self.expected} records', out.getvalue())
+        self.assertEqual(UsageInfo.objects.count(), self.expected)
+
+
+@unittest.skipUnless(connection.vendor == 'postgresql', 'The test database is shared by the processes on PostgreSQL')
+class ParallelLoadProcesses(RollupsAssertions, APITransactionTestCase):
+
+    def test_processes(self):
+        version = cache.current_version()
+        stats = pipeline.load_file(str(SAMPLE_DATASET), processes=3, max_connections=2, chunk_bytes=3000)
+        self.assertEqual(stats.rows, ParallelLoad.expected)
+        # bumped once, not by every chunk
+        self.assertEqual(cache.current_version()[0], version[0] + 1)
+        self.assertEqual(UsageInfo.objects.count(), ParallelLoad.expected)
+        self.assertEqual(UsageInfoLoadedChunk.objects.count(), stats.chunks)
+        self.assertRollupsConsistent()
+
+    def test_benchmark_command(self):
+        out = io.StringIO()
+        with tempfile.NamedTemporaryFile('wt', suffix='.json') as output:
+            call_command('benchmark_load_usage_info', '--rows', '3000', '--processes', '1,2', '--chunk-mb', '1',
+                         '--output', output.name, stdout=out)
+            with open(output.name) as file:
+                report = json.load(file)
+        self.assertEqual(
+            [(result['processes'], result['rows']) for result in report['results']], [(1, 3000), (2, 3000)])
+        self.assertTrue(all('lock_wait_seconds' in result for result in report['results']))
+        self.assertEqual(UsageInfo.objects.count(), 0)
+        with open(SAMPLE_DATASET) as csvf:
+            load_csv(csvf)
+        with self.assertRaisesMessage(CommandError, 'must be empty'):
+            call_command('benchmark_load_usage_info', '--rows', '10', stdout=out)
+
+
+class UsageInfoCache(BaseViewTest):
+
+    def test_cache_hit(self):
+        hits = cache.stats.hits
+        first = self.client.get(reverse("usage-info"), {"group_by": "channel", "countries": "US,CA"})
+        with CaptureQueriesContext(connection) as queries:
+            second = self.client.get(reverse("usage-info"), {"countries": "CA, US,CA", "group_by": "channel"})
+
+        self.assertEqual(first['X-Cache'], 'MISS')
+        self.assertEqual(second['X-Cache'], 'HIT')
+        self.assertEqual(cache.stats.hits, hits + 1)
+        self.assertEqual(second.data, first.data)
+        self.assertEqual(len(queries), 1)  # the data version only
+
+    def test_cache_invalidated_on_change(self):
+        first = self.client.get(reverse("usage-info"), {"group_by": "os"})
+        with open(SAMPLE_DATASET) as csvf:
+            load_csv(csvf)
+        second = self.client.get(reverse("usage-info"), {"group_by": "os"})
+
+        self.assertEqual(second['X-Cache'], 'MISS')
+        self.assertNotEqual(second.data, first.data)
+
+        UsageInfo.objects.filter(os__name='ios').first().delete()
+        self.assertEqual(self.client.get(reverse("usage-info"), {"group_by": "os"})['X-Cache'], 'MISS')
+
+    def test_errors_are_not_cached(self):
+        self.client.get(reverse("usage-info"), {"group_by": "clicks"})
+        response = self.client.get(reverse("usage-info"), {"group_by": "clicks"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class UsageInfoConditionalGet(BaseViewTest):
+
+    def get_usage_info(self, query_params: dict, **headers):
+        return self.client.get(reverse("usage-info"), query_params, **headers)
+
+    def test_not_modified(self):
+        first = self.get_usage_info({"group_by": "channel"})
+        self.assertTrue(first['ETag'].startswith('W/"'))
+        self.assertEqual(first['Cache-Control'], 'no-cache')
+        self.assertIn('Last-Modified', first)
+
+        with CaptureQueriesContext(connection) as queries:
+            second = self.get_usage_info({"group_by": "channel"}, HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(second.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(second.content, b'')
+        self.assertEqual(second['ETag'], first['ETag'])
+        self.assertEqual(len(queries), 1)  # the data version only
+
+        third = self.get_usage_info({"group_by": "channel"}, HTTP_IF_MODIFIED_SINCE=first['Last-Modified'])
+        self.assertEqual(third.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_etag_of_request(self):
+        etag = self.get_usage_info({"group_by": "channel", "countries": "US,CA"})['ETag']
+        # the same normalized query
+        self.assertEqual(self.get_usage_info({"countries": "CA,US", "group_by": "channel"})['ETag'], etag)
+        self.assertNotEqual(self.get_usage_info({"group_by": "channel", "countries": "US"})['ETag'], etag)
+        self.assertNotEqual(
+            self.get_usage_info({"group_by": "channel", "countries": "US,CA", "limit": 1})['ETag'], etag)
+
+    def test_validator_headers(self):
+        json_headers = cache.validator_headers('usage_info:1:0.0:key', (1, 0.0), 'json')
+        self.assertNotEqual(cache.validator_headers('usage_info:1:0.0:key', (1, 0.0), 'api'), json_headers)
+        self.assertNotIn('Last-Modified', json_headers)  # no data version yet
+        self.assertEqual(
+            cache.validator_headers('usage_info:1:0.0:key', (1, 1575590400.0), 'json')['Last-Modified'],
+            'Fri, 06 Dec 2019 00:00:00 GMT')
+
+    def test_modified(self):
+        first = self.get_usage_info({"group_by": "os"})
+        self.create_usage_info(
+            date='2019-12-07', channel='adcolony', country='US', os='ios', impressions='1', clicks='1', installs='1',
+            spend='1', revenue='1')
+        second = self.get_usage_info({"group_by": "os"}, HTTP_IF_NONE_MATCH=first['ETag'])
+
+        self.assertEqual(second.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(second['ETag'], first['ETag'])
+        self.assertNotEqual(second.data, first.data)
+
+    def test_errors_have_no_etag(self):
+        response = self.get_usage_info({"group_by": "clicks"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertNotIn('ETag', response)
+
+
+class UsageInfoInstrumentation(BaseViewTest):
+
+    def setUp(self):
+        super().setUp()
+        instrumentation.registry.reset()
+
+    def test_server_timing(self):
+        response = self.client.get(reverse("usage-info"), {"group_by": "channel", "sort_by": "-clicks"})
+        timing = response['Server-Timing']
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        for name in ('validate', 'cache', 'plan', 'serialize', 'render', 'total'):
+            self.assertIn(f'{name};dur=', timing)
+        self.assertRegex(timing, r'sql;dur=[\d.]+;desc="\d+ queries"')
+        self.assertRegex(timing, r'total;dur=[\d.]+$')
+
+    def test_metrics(self):
+        self.client.get(reverse("usage-info"), {"group_by": "os"})
+        self.client.get(reverse("usage-info"), {"group_by": "os"})
+        self.client.get(reverse("usage-info"), {"group_by": "clicks"})
+        metrics = self.client.get(reverse("usage-info-metrics"), {"format": "json"}).json()
+        endpoint = metrics['endpoints']['usage-info']
+
+        self.assertEqual(endpoint['requests'], 3)
+        self.assertEqual(endpoint['slow_requests'], 0)
+        self.assertEqual(endpoint['rows']['count'], 1)  # the rows of the queries run, not of the cache hits
+        self.assertEqual(endpoint['duration_ms']['total']['count'], 3)
+        self.assertEqual(endpoint['duration_ms']['total']['buckets'][-1], ['+Inf', 3])
+        self.assertIn('hits', metrics['response_cache'])
+        # the metrics endpoint itself is not counted
+        self.assertEqual(list(metrics['endpoints']), ['usage-info'])
+
+        response = self.client.get(reverse("usage-info-metrics"), {"format": "prometheus"})
+        content = response.content.decode()
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+        self.assertIn('usage_info_requests_total{endpoint="usage-info"} 3', content)
+        self.assertIn('usage_info_request_duration_seconds_count{endpoint="usage-info",phase="total"} 3', content)
+
+    @override_settings(USAGE_INFO_SLOW_REQUEST_MS=0)
+    def test_slow_request_log(self):
+        with self.assertLogs('usage_info.slow', 'WARNING') as logs:
+            self.client.get(reverse("usage-info"), {"group_by": "country", "countries": "US"})
+        record = json.loads(logs.records[0].getMessage())
+
+        self.assertEqual(record['status'], 200)
+        self.assertEqual(record['spec']['group_by'], ['country'])
+        self.assertEqual(record['query_count'], len(record['queries']))
+        self.assertTrue(any('GROUP BY' in query['sql'] for query in record['queries']))
+        self.assertEqual(instrumentation.registry.as_dict()['usage-info']['slow_requests'], 1)
+
+
+class QueryCoalescing(APITestCase):
+
+    def setUp(self):
+        caches['usage_info'].clear()
+        self.coalescer = coalescing.Coalescer()
+        self.calls = 0
+
+    def slow_query(self, result: typ.Any = 'rows', error: Exception = None) -> typ.Callable[[], typ.Any]:
+        def query():
+            self.calls += 1
+            time.sleep(0.3)
+            if error is not None:
+                raise error
+            caches['usage_info'].set('usage_info:key', result)
+            return result
+        return query
+
+    def run_concurrently(self, query: typ.Callable[[], typ.Any], count: int = 5) -> list:
+        def run(_):
+            try:
+                return self.coalescer.run('usage_info:key', query)
+            except Exception as err:
+                return err
+
+        with ThreadPoolExecutor(max_workers=count) as executor:
+            return list(executor.map(run, range(count)))
+
+    def test_in_process(self):
+        before = coalescing.stats.as_dict()
+        results = self.run_concurrently(self.slow_query())
+        after = coalescing.stats.as_dict()
+
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(sorted(results), [('rows', 'leader')] + [('rows', 'process')] * 4)
+        self.assertEqual(after['queries'] - before['queries'], 1)
+        self.assertEqual(after['coalesced_in_process'] - before['coalesced_in_process'], 4)
+        # the next call runs the query again
+        self.assertEqual(self.coalescer.run('usage_info:key', lambda: 'new rows'), ('new rows', 'leader'))
+
+    def test_error_shared(self):
+        results = self.run_concurrently(self.slow_query(error=ValueError('failed')), count=3)
+        self.assertEqual(self.calls, 1)
+        self.assertTrue(all(isinstance(result, ValueError) for result in results))
+
+    @override_settings(USAGE_INFO_COALESCE=False)
+    def test_disabled(self):
+        self.run_concurrently(self.slow_query(), count=3)
+        self.assertEqual(self.calls, 3)
+
+    def test_across_workers(self):
+        # another worker is running the query
+        caches['usage_info'].add('usage_info:key:lock', 'another worker')
+        threading.Timer(0.2, caches['usage_info'].set, ('usage_info:key', 'rows of another worker')).start()
+        self.assertEqual(self.coalescer.run('usage_info:key', self.slow_query()), ('rows of another worker', 'worker'))
+        self.assertEqual(self.calls, 0)
+
+    def test_other_worker_failed(self):
+        caches['usage_info'].add('usage_info:key:lock', 'another worker')
+        threading.Timer(0.2, caches['usage_info'].delete, ('usage_info:key:lock',)).start()
+        self.assertEqual(self.coalescer.run('usage_info:key', self.slow_query()), ('rows', 'leader'))
+        self.assertEqual(self.calls, 1)
+        self.assertIsNone(caches['usage_info'].get('usage_info:key:lock'))
+
+    def test_metrics(self):
+        response = self.client.get(reverse("usage-info-metrics"), {'format': 'prometheus'})
+        self.assertIn('usage_info_coalesced_requests_total{source="process"}', response.content.decode())
+
+    def slow_coroutine(self, result: typ.Any = 'rows') -> typ.Callable[[], typ.Awaitable]:
+        async def query():
+            self.calls += 1
+            await asyncio.sleep(0.3)
+            caches['usage_info'].set('usage_info:key', result)
+            return result
+        return query
+
+    def test_async_in_process(self):
+        async def run():
+            return await asyncio.gather(
+                *(self.coalescer.run_async('usage_info:key', self.slow_coroutine()) for _ in range(5)))
+        self.assertEqual(sorted(asyncio.run(run())), [('rows', 'leader')] + [('rows', 'process')] * 4)
+        self.assertEqual(self.calls, 1)
+        self.assertIsNone(caches['usage_info'].get('usage_info:key:lock'))
+
+    def test_async_across_workers(self):
+        caches['usage_info'].add('usage_info:key:lock', 'another worker')
+        threading.Timer(0.2, caches['usage_info'].set, ('usage_info:key', 'rows of another worker')).start()
+        self.assertEqual(asyncio.run(self.coalescer.run_async('usage_info:key', self.slow_coroutine())),
+                         ('rows of another worker', 'worker'))
+        self.assertEqual(self.calls, 0)
+
+    @unittest.skipUnless('fork' in multiprocessing.get_all_start_methods(), 'The worker processes are forked')
+    def test_worker_processes(self):
+        context = multiprocessing.get_context('fork')
+        barrier, queries, results = context.Barrier(2), context.Value('i', 0), context.SimpleQueue()
+        with tempfile.TemporaryDirectory() as directory, override_settings(CACHES={
+                **settings.CACHES, 'usage_info': {'BACKEND': 'usage_info.filecache.FileCache', 'LOCATION': directory}}):
+            workers = [context.Process(target=run_coalesced, args=(barrier, queries, results)) for _ in range(2)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join(10)
+            self.assertEqual([worker.exitcode for worker in workers], [0, 0])
+            self.assertEqual(sorted(results.get() for _ in workers), [('rows', 'leader'), ('rows', 'worker')])
+        self.assertEqual(queries.value, 1)
+
+    def test_check_cache_shared(self):
+        self.assertEqual(coalescing.check_cache_shared(), [])
+        with override_settings(CACHES={
+                **settings.CACHES, 'usage_info': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}):
+            self.assertEqual([warning.id for warning in coalescing.check_cache_shared()], ['usage_info.W001'])
+        with override_settings(USAGE_INFO_COALESCE=False, CACHES={
+                **settings.CACHES, 'usage_info': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}):
+            self.assertEqual(coalescing.check_cache_shared(), [])
+
+
+class UsageInfoCursorPagination(APITestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        with open(SAMPLE_DATASET) as csvf:
+            load_csv(csvf)
+
+    def walk(self, query_params: dict, link: str = 'next') -> list:
+        response = self.client.get(reverse("usage-info"), {**query_params, 'pagination': 'cursor', 'limit': 7})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotIn('count', response.data)
+        pages = [response.data['results']]
+        while response.data[link]:
+            response = self.client.get(response.data[link])
+            pages.append(response.data['results'])
+        return pages
+
+    def assertSamePages(self, query_params: dict):
+        expected = self.client.get(reverse("usage-info"), {**query_params, 'limit': 10000}).data['results']
+        pages = self.walk(query_params)
+        self.assertEqual([row for page in pages for row in page], expected)
+
+        # and back from the last page
+        last = self.client.get(reverse("usage-info"), {**query_params, 'pagination': 'cursor', 'limit': 7})
+        while last.data['next']:
+            last = self.client.get(last.data['next'])
+        backwards = [last.data['results']]
+        while last.data['previous']:
+            last = self.client.get(last.data['previous'])
+            backwards.append(last.data['results'])
+        # the float sums may differ in the last digits with the reversed order of the rows
+        self.assertEqual(self.rounded(backwards[::-1]), self.rounded(pages))
+
+    @staticmethod
+    def rounded(pages: list) -> list:
+        return [[{field: round(value, 6) if isinstance(value, float) else value for field, value in row.items()}
+                 for row in page] for page in pages]
+
+    def test_not_grouped(self):
+        self.assertSamePages({})
+
+    def test_not_grouped_sorted(self):
+        self.assertSamePages({'sort_by': '-date,channel'})
+
+    def test_grouped_sorted(self):
+        self.assertSamePages({'group_by': 'channel,country', 'sort_by': '-clicks'})
+
+    def test_grouped_sorted_by_cpi(self):
+        self.assertSamePages({'group_by': 'date,os', 'sort_by': '-cpi', 'cpi': '1'})
+
+    def test_no_count_query(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse("usage-info"), {'pagination': 'cursor', 'group_by': 'date'})
+        self.assertFalse(any('COUNT(' in query['sql'].upper() for query in queries.captured_queries))
+
+    def test_invalid_cursor(self):
+        response = self.client.get(reverse("usage-info"), {'pagination': 'cursor', 'cursor': 'not valid'})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_invalid_pagination(self):
+        response = self.client.get(reverse("usage-info"), {'pagination': 'pages'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class UsageInfoExport(APITestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        with open(SAMPLE_DATASET) as csvf:
+            load_csv(csvf)
+
+    def export(self, query_params: dict) -> list:
+        response = self.client.get(reverse("usage-info-export"), query_params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.streaming)
+        return b''.join(response.streaming_content).decode().splitlines()
+
+    def expected(self, query_params: dict) -> list:
+        response = self.client.get(reverse("usage-info"), {**query_params, 'limit': 10000, 'format': 'json'})
+        return json.loads(response.content)['results']
+
+    def test_export_ndjson(self):
+        query_params = {'group_by': 'date,country', 'sort_by': '-cpi', 'cpi': '1', 'os': 'ios'}
+        lines = self.export(query_params)
+        self.assertEqual([json.loads(line) for line in lines], self.expected(query_params))
+
+    def test_export_not_grouped(self):
+        query_params = {'date_from': '2017-06-01', 'sort_by': 'channel'}
+        lines = self.export({**query_params, 'format': 'ndjson'})
+        self.assertEqual([json.loads(line) for line in lines], self.expected(query_params))
+
+    def test_export_csv(self):
+        query_params = {'group_by': 'channel', 'sort_by': '-revenue', 'countries': 'US,GB'}
+        rows = list(csv.DictReader(self.export({**query_params, 'format': 'csv'})))
+        expected = self.expected(query_params)
+
+        self.assertEqual(len(rows), len(expected))
+        self.assertEqual(list(rows[0]), list(expected[0]))
+        self.assertEqual([row['channel'] for row in rows], [row['channel'] for row in expected])
+        self.assertEqual(rows[0]['date'], '')
+        self.assertEqual(int(rows[0]['clicks']), expected[0]['clicks'])
+
+    def test_export_all_rows(self):
+        self.assertEqual(len(self.export({})), UsageInfo.objects.count())
+
+    def test_export_not_valid(self):
+        response = self.client.get(reverse("usage-info-export"), {'group_by': 'clicks'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_conditional_export(self):
+        query_params = {'group_by': 'date', 'format': 'csv'}
+        response = self.client.get(reverse("usage-info-export"), query_params)
+        etag = response['ETag']
+        b''.join(response.streaming_content)
+        ndjson = self.client.get(reverse("usage-info-export"), {'group_by': 'date'})
+        self.assertNotEqual(ndjson['ETag'], etag)
+        b''.join(ndjson.streaming_content)
+
+        response = self.client.get(reverse("usage-info-export"), query_params, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response['ETag'], etag)
+
+        cache.bump_version()
+        response = self.client.get(reverse("usage-info-export"), query_params, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response['ETag'], etag)
+        b''.join(response.streaming_content)
+
+    def test_instrumented_when_streamed(self):
+        instrumentation.registry.reset()
+        response = self.client.get(reverse("usage-info-export"), {'format': 'csv'})
+        self.assertRegex(response['Server-Timing'], r'^validate;dur=[\d.]+, cache;dur=[\d.]+, plan;dur=[\d.]+')
+        self.assertNotIn('usage-info-export', instrumentation.registry.as_dict())
+
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        metrics = instrumentation.registry.as_dict()['usage-info-export']
+        self.assertEqual(metrics['requests'], 1)
+        self.assertEqual(metrics['rows']['sum'], len(lines) - 1)
+        self.assertGreaterEqual(metrics['queries']['sum'], 1)
+        self.assertLessEqual({'validate', 'cache', 'plan', 'sql', 'serialize', 'render', 'total'},
+                             set(metrics['duration_ms']))
+        phases = sum(histogram['sum'] for name, histogram in metrics['duration_ms'].items() if name != 'total')
+        self.assertLessEqual(phases, metrics['duration_ms']['total']['sum'])
+
+
+@unittest.skipIf(pa is None, 'pyarrow is not installed')
+class ColumnarFormats(APITestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        with open(SAMPLE_DATASET) as csvf:
+            load_csv(csvf)
+
+    def setUp(self):
+        caches['usage_info'].clear()
+
+    def get(self, query_params: dict, **headers):
+        response = self.client.get(reverse("usage-info"), query_params, **headers)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response
+
+    def test_arrow(self):
+        query_params = {'group_by': 'date:month,channel', 'sort_by': '-cpi', 'cpi': '1', 'limit': 1000}
+        response = self.get({**query_params, 'format': 'arrow'})
+        table = pa.ipc.open_stream(response.content).read_all()
+        expected = self.get({**query_params, 'format': 'json'}).json()
+
+        self.assertEqual(response['Content-Type'], 'application/vnd.apache.arrow.stream')
+        self.assertEqual(table.schema.field('date').type, pa.date32())
+        self.assertEqual(table.schema.field('clicks').type, pa.int64())
+        self.assertEqual(table.schema.metadata[b'count'], str(expected['count']).encode())
+        self.assertEqual(table.column_names, list(expected['results'][0]))
+        columns = table.to_pydict()
+        rows = [dict(zip(columns, values)) for values in zip(*columns.values())]
+        for row in rows:
+            row['date'] = row['date'].isoformat()
+
+        # the float sums of the two queries may differ in the last digits
+        def rounded(rows: list) -> list:
+            return [{field: round(value, 6) if isinstance(value, float) else value for field, value in row.items()}
+                    for row in rows]
+        self.assertEqual(rounded(rows), rounded(expected['results']))
+
+    def test_parquet(self):
+        response = self.get({'group_by': 'channel', 'rollup': '1', 'sort_by': 'channel', 'limit': 3},
+                            HTTP_ACCEPT='application/vnd.apache.parquet')
+        table = pq.read_table(io.BytesIO(response.content))
+
+        self.assertEqual(response['Content-Type'], 'application/vnd.apache.parquet')
+        self.assertEqual(table.num_rows, 3)
+        self.assertEqual(table.column('grouping').to_pylist(), ['channel'] * 3)
+        self.assertTrue(json.loads(table.schema.metadata[b'next']).endswith('offset=3&rollup=1&sort_by=channel'))
+
+    def test_empty(self):
+        response = self.get({'group_by': 'os', 'channels': 'unknown', 'format': 'arrow'})
+        table = pa.ipc.open_stream(response.content).read_all()
+        self.assertEqual(table.num_rows, 0)
+        self.assertEqual(table.schema.field('spend').type, pa.float64())
+
+    def test_error(self):
+        response = self.client.get(reverse("usage-info"), {'group_by': 'clicks', 'format': 'arrow'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(pa.ipc.open_stream(response.content).read_all().column_names, ['detail'])
+
+    def test_cached_apart_from_json(self):
+        self.get({'group_by': 'os', 'format': 'parquet'})
+        response = self.get({'group_by': 'os', 'format': 'json'})
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertEqual(len(response.json()['results']), 2)
+        self.assertEqual(self.get({'group_by': 'os', 'format': 'arrow'})['X-Cache'], 'HIT')
+
+
+class FastSerialization(APITestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        with open(SAMPLE_DATASET) as csvf:
+            load_csv(csvf)
+
+    def assertSameAsSerializer(self, query_params: dict):
+        view = UsageInfoView(request=Request(APIRequestFactory().get('/usage_info', query_params)))
+        plan = view.get_plan()
+        self.assertEqual(
+            plan.serializer.serialize(plan.values_list.all()), UsageInfoSerializer(plan.queryset.all(), many=True).data)
+
+    def test_not_grouped(self):
+        self.assertSameAsSerializer({'sort_by': '-revenue', 'cpi': '1'})
+
+    def test_grouped(self):
+        self.assertSameAsSerializer({'group_by': 'country,os', 'sort_by': 'os,-installs'})
+
+    def test_grouped_sorted_by_not_grouped_field(self):
+        self.assertSameAsSerializer({'group_by': 'channel', 'sort_by': 'date', 'date_to': '2017-05-20'})
+
+    def test_benchmark(self):
+        out = io.StringIO()
+        call_command('benchmark_serialization', '--limit', '100', '--repeat', '1', stdout=out)
+        self.assertIn('Speedup', out.getvalue())
+
+
+class QueryPlanCache(APITestCase):
+
+    def setUp(self):
+        compile_plan.cache_clear()
+
+    def test_parse_query_params(self):
+        spec = parse_query_params(QueryDict('os=ios&channels=vungle, adcolony,vungle&group_by=os,channel&cpi=1'))
+        self.assertEqual(
+            spec, QuerySpec(channels=('adcolony', 'vungle'), os=('ios',), group_by=('os', 'channel'), metrics=('cpi',)))
+        self.assertEqual(
+            spec, parse_query_params(QueryDict('cpi=1&group_by=os,channel&channels=adcolony,vungle&os=ios')))
+        self.assertEqual(spec.filtered_fields, {'channel', 'os'})
+
+    def test_parse_query_params_not_valid(self):
+        for query_params in ('date_from=2017-13-01', 'group_by=clicks', 'sort_by=cpi', 'pagination=page'):
+            with self.subTest(query_params=query_params), self.assertRaises(ValidationError):
+                parse_query_params(QueryDict(query_params))
+
+    def test_plan_reused(self):
+        self.client.get(reverse("usage-info"), {'group_by': 'os,country', 'countries': 'US,CA'})
+        self.client.get(reverse("usage-info"), {'countries': 'CA,US', 'group_by': 'os,country', 'limit': 5})
+        info = compile_plan.cache_info()
+        self.assertEqual((info.misses, info.hits), (1, 1))
+
+    def test_plan_cache_cleared_on_settings_change(self):
+        compile_plan_sql(get_plan(QuerySpec(group_by=('os',))), DEFAULT_DB_ALIAS)
+        with override_settings(USAGE_INFO_ROLLUPS=False):
+            self.assertEqual(compile_plan.cache_info().currsize, 0)
+            self.assertEqual(compile_plan_sql.cache_info().currsize, 0)
+            self.assertIs(get_plan(QuerySpec(group_by=('os',))).queryset.model, UsageInfo)
+
+    def test_timings(self):
+        caches['usage_info'].clear()
+        response = self.client.get(reverse("usage-info"), {'group_by': 'date'})
+        self.assertEqual(set(response.usage_info_timings), {'parse', 'plan', 'execute'})
+
+
+class DimensionTables(BaseViewTest):
+
+    def test_facts_keep_dimension_ids(self):
+        row = UsageInfo.objects.values('channel', 'country', 'os').get(date='2019-12-06')
+        self.assertEqual(row['channel'], Channel.objects.get(name='adcolony').id)
+        self.assertEqual(row['country'], Country.objects.get(name='US').id)
+
+    def test_load_adds_new_names_once(self):
+        load_csv(io.StringIO(
+            'date,channel,country,os,impressions,clicks,installs,spend,revenue\n'
+            '2017-05-17,adcolony,US,ios,13886,336,60,100.8,210.24\n'
+            '2017-05-17,vungle,US,ios,1000,30,6,10.0,20.0\n'
+            '2017-05-18,vungle,DE,ios,1000,30,6,10.0,20.0\n'), chunk_size=1)
+        self.assertEqual(Channel.objects.filter(name__in=('adcolony', 'vungle')).count(), 2)
+        self.assertEqual(UsageInfo.objects.filter(channel__name='vungle', country__name='DE').count(), 1)
+
+    def test_filter_by_names(self):
+        response = self.client.get(reverse("usage-info"), {'channels': 'facebook,adcolony', 'group_by': 'channel'})
+        self.assertEqual([row['channel'] for row in response.data['results']], ['adcolony', 'facebook'])
+
+    def test_filter_by_unknown_name(self):
+        response = self.client.get(reverse("usage-info"), {'channels': 'unknown', 'os': 'ios'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['results'], [])
+
+    def test_sort_by_name(self):
+        # ids don't follow the names
+        self.create_usage_info(
+            date='2019-12-07', channel='aaa', country='US', os='ios', impressions=1, clicks=1, installs=1,
+            spend=1.0, revenue=1.0)
+        response = self.client.get(reverse("usage-info"), {'sort_by': 'channel'})
+        self.assertEqual(
+            [row['channel'] for row in response.data['results']], ['aaa', 'adcolony', 'chartboost', 'facebook'])
+
+    def test_cache_dropped_on_data_change(self):
+        self.client.get(reverse("usage-info"), {'channels': 'vungle'})
+        self.create_usage_info(
+            date='2019-12-07', channel='vungle', country='US', os='ios', impressions=1, clicks=1, installs=1,
+            spend=1.0, revenue=1.0)
+        response = self.client.get(reverse("usage-info"), {'channels': 'vungle'})
+        self.assertEqual([row['channel'] for row in response.data['results']], ['vungle'])
+        self.assertEqual(
+            dimension_cache.get_ids('channel', ['vungle', 'unknown']), (Channel.objects.get(name='vungle').id,))
+
+
+class DimensionsMigration(RollupsAssertions, APITransactionTestCase):
+    """0006_usage_info_dimensions moves the names to the dimension tables and back"""
+    FIELDS = ('date', 'channel__name', 'country__name', 'os__name', *METRIC_FIELDS)
+    OLD_SQL = f'SELECT date, channel, country, os, {", ".join(METRIC_FIELDS)} FROM usage_info_usageinfo'
+
+    @staticmethod
+    def migrate(*targets: typ.Tuple[str, str]) -> None:
+        executor = MigrationExecutor(connection)
+        executor.migrate(list(targets or executor.loader.graph.leaf_nodes('usage_info')))
+
+    def test_reverse_and_forward(self):
+        with open(SAMPLE_DATASET) as csvf:
+            load_csv(csvf)
+        expected = sorted((str(row[0]), *row[1:]) for row in UsageInfo.objects.values_list(*self.FIELDS))
+
+        try:
+            self.migrate(('usage_info', '0005_usage_info_version'))
+            with connection.cursor() as cursor:
+                cursor.execute(self.OLD_SQL)
+                rows = sorted((str(row[0]), *row[1:]) for row in cursor.fetchall())
+                cursor.execute('SELECT SUM(record_count) FROM usage_info_usageinfobydatechannelcountry')
+                rollup_count, = cursor.fetchone()
+        finally:
+            self.migrate()
+        self.assertEqual(rows, expected)
+        self.assertEqual(rollup_count, len(expected))
+
+        migrated = sorted((str(row[0]), *row[1:]) for row in UsageInfo.objects.values_list(*self.FIELDS))
+        self.assertEqual(migrated, expected)
+        self.assertRollupsConsistent()
+
+
+class DateBuckets(APITestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        with open(SAMPLE_DATASET) as csvf:
+            load_csv(csvf)
+
+    def setUp(self):
+        caches['usage_info'].clear()
+
+    def get_results(self, query_params: dict) -> list:
+        response = self.client.get(reverse("usage-info"), {**query_params, 'limit': 10000})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data['results']
+
+    @staticmethod
+    def bucket_of(date: datetime.date, bucket: str) -> datetime.date:
+        if bucket == 'week':
+            return date - datetime.timedelta(days=date.weekday())
+        if bucket == 'month':
+            return date.replace(day=1)
+        if bucket == 'quarter':
+            return date.replace(day=1, month=(date.month - 1) // 3 * 3 + 1)
+        return date.replace(day=1, month=1)
+
+    def test_buckets(self):
+        daily = self.get_results({'group_by': 'date,os'})
+        for bucket in ('week', 'month', 'quarter', 'year'):
+            with self.subTest(bucket=bucket):
+                expected = {}
+                for row in daily:
+                    key = (self.bucket_of(row['date'], bucket), row['os'])
+                    total = expected.setdefault(key, dict.fromkeys(METRIC_FIELDS, 0))
+                    for metric in METRIC_FIELDS:
+                        total[metric] += row[metric]
+                rows = self.get_results({'group_by': f'date:{bucket},os', 'sort_by': 'date,os'})
+
+                self.assertEqual([(row['date'], row['os']) for row in rows], sorted(expected))
+                for row in rows:
+                    for metric in METRIC_FIELDS:
+                        self.assertAlmostEqual(row[metric], expected[row['date'], row['os']][metric], places=6)
+
+    def test_day_is_date(self):
+        self.assertEqual(self.get_results({'group_by': 'date:day', 'sort_by': '-clicks'}),
+                         self.get_results({'group_by': 'date', 'sort_by': '-clicks'}))
+
+    def test_sorted_by_bucket(self):
+        dates = [row['date'] for row in self.get_results({'group_by': 'date:week', 'sort_by': '-date'})]
+        self.assertEqual(dates, sorted(dates, reverse=True))
+        self.assertTrue(all(date.weekday() == 0 for date in dates))
+
+    @override_settings(USAGE_INFO_ROLLUPS=True)
+    def test_routed_to_date_rollups(self):
+        self.assertIs(get_plan(parse_query_params(QueryDict('group_by=date:month'))).queryset.model, UsageInfoByDate)
+        self.assertIs(get_plan(parse_query_params(QueryDict('group_by=date:week,os&countries=US'))).queryset.model,
+                      UsageInfoByDateCountryOs)
+
+    def test_not_valid(self):
+        for group_by in ('date,date:month', 'date:week,date:month', 'date:hour', 'date:'):
+            with self.subTest(group_by=group_by):
+                response = self.client.get(reverse("usage-info"), {'group_by': group_by})
+                self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_rollup(self):
+        rows = self.get_results({'group_by': 'date:month,channel', 'rollup': '1', 'sort_by': 'date,channel'})
+        self.assertEqual(list(dict.fromkeys(row['grouping'] for row in rows)), ['date:month,channel', 'date:month', ''])
+        months = [row for row in rows if row['grouping'] == 'date:month']
+        self.assertEqual([row['date'] for row in months], [datetime.date(2017, 5, 1), datetime.date(2017, 6, 1)])
+        self.assertEqual(sum(row['clicks'] for row in months), rows[-1]['clicks'])
+
+    def test_cursor_pagination(self):
+        query_params = {'group_by': 'date:week,os', 'sort_by': '-date,os', 'pagination': 'cursor', 'limit': 3}
+        expected = self.get_results({'group_by': 'date:week,os', 'sort_by': '-date,os'})
+        response = self.client.get(reverse("usage-info"), query_params)
+        rows = list(response.data['results'])
+        while response.data['next']:
+            response = self.client.get(response.data['next'])
+            rows.extend(response.data['results'])
+        self.assertEqual([(row['date'], row['os'], row['clicks']) for row in rows],
+                         [(row['date'], row['os'], row['clicks']) for row in expected])
+
+
+class UsageInfoTotals(APITestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        with open(SAMPLE_DATASET) as csvf:
+            load_csv(csvf)
+
+    def setUp(self):
+        caches['usage_info'].clear()
+
+    def get_rows(self, query_params: dict) -> list:
+        response = self.client.get(reverse("usage-info"), {**query_params, 'limit': 10000})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data['results']
+
+    def assertSameRows(self, rows: list, expected: list):
+        self.assertEqual(len(rows), len(expected))
+        for row, expected_row in zip(rows, expected):
+            for field, value in expected_row.items():
+                if isinstance(value, float):
+                    self.assertTrue(math.isclose(row[field], value, rel_tol=1e-12),
+                                    msg=f'{field}: {row[field]} != {value}')
+                else:
+                    self.assertEqual(row[field], value, msg=field)
+
+    def test_rollup(self):
+        query_params = {'group_by': 'channel,country', 'sort_by': '-clicks', 'cpi': '1'}
+        rows = self.get_rows({**query_params, 'rollup': '1'})
+        levels = [row.pop('grouping') for row in rows]
+        self.assertEqual(list(dict.fromkeys(levels)), ['channel,country', 'channel', ''])
+
+        self.assertSameRows([row for row, level in zip(rows, levels) if level == 'channel,country'],
+                            self.get_rows(query_params))
+        self.assertSameRows([row for row, level in zip(rows, levels) if level == 'channel'],
+                            self.get_rows({**query_params, 'group_by': 'channel'}))
+        total = rows[-1]
+        self.assertEqual((total['channel'], total['country'], total['date']), (None, None, None))
+        self.assertEqual(total['clicks'], UsageInfo.objects.aggregate(clicks=Sum('clicks'))['clicks'])
+        self.assertAlmostEqual(total['cpi'], total['spend'] / total['installs'])
+
+    def test_totals(self):
+        rows = self.get_rows({'group_by': 'os,date', 'sort_by': 'date', 'os': 'ios', 'totals': '1'})
+        self.assertEqual(rows[-1]['grouping'], '')
+        self.assertEqual({row['grouping'] for row in rows[:-1]}, {'os,date'})
+        self.assertEqual(rows[-1]['installs'], sum(row['installs'] for row in rows[:-1]))
+        dates = [row['date'] for row in rows[:-1]]
+        self.assertEqual(dates, sorted(dates))
+
+    def test_one_scan(self):
+        self.get_rows({'group_by': 'date'})  # the dimension names are loaded
+        with CaptureQueriesContext(connection) as queries:
+            self.get_rows({'group_by': 'date,channel,os', 'rollup': '1', 'date_to': '2017-05-25'})
+        self.assertEqual(sum('SUM(' in query['sql'] for query in queries.captured_queries), 1)
+
+    def test_pages(self):
+        query_params = {'group_by': 'country', 'sort_by': 'country', 'totals': '1'}
+        rows = self.get_rows(query_params)
+        response = self.client.get(reverse("usage-info"), {**query_params, 'limit': 4, 'offset': len(rows) - 4})
+        self.assertEqual(response.data['count'], len(rows))
+        self.assertEqual(response.data['results'], rows[-4:])
+
+    def test_export(self):
+        response = self.client.get(reverse("usage-info-export"), {'group_by': 'os', 'rollup': '1', 'format': 'csv'})
+        lines = list(csv.DictReader(b''.join(response.streaming_content).decode().splitlines()))
+        self.assertEqual([line['grouping'] for line in lines], ['os', 'os', ''])
+
+    def test_not_valid(self):
+        for query_params in ({'totals': '1'}, {'group_by': 'os', 'rollup': '1', 'pagination': 'cursor'}):
+            with self.subTest(**query_params):
+                response = self.client.get(reverse("usage-info"), query_params)
+                self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class TopRows(APITestCase):
+    QUERIES = (
+        {'group_by': 'country,channel', 'top': '2', 'top_by': 'revenue', 'partition_by': 'country'},
+        {'group_by': 'date:month,os', 'top': '1', 'top_by': 'cpi', 'metrics': 'cpi', 'partition_by': 'date'},
+        {'group_by': 'date,channel', 'top': '3', 'top_by': 'roas', 'metrics': 'roas', 'partition_by': 'date',
+         'sort_by': 'channel,-date'},
+        {'group_by': 'channel,os', 'top': '4', 'top_by': 'clicks', 'countries': 'US,CA'},
+        {'group_by': 'os', 'top': '2', 'top_by': 'installs', 'channels': 'unknown'},
+    )
+
+    @classmethod
+    def setUpTestData(cls):
+        with open(SAMPLE_DATASET) as csvf:
+            load_csv(csvf)
+
+    def setUp(self):
+        caches['usage_info'].clear()
+        columnar.clear()
+
+    def get_rows(self, query_params: dict) -> list:
+        caches['usage_info'].clear()
+        response = self.client.get(reverse("usage-info"), {**query_params, 'limit': 10000, 'format': 'json'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK, response.data)
+        return json.loads(response.content)['results']
+
+    def test_parse(self):
+        spec = parse_query_params(QueryDict('group_by=date:week,channel&top=3&top_by=clicks&partition_by=date'))
+        self.assertEqual((spec.top, spec.top_by, spec.partition_by), (3, 'clicks', ('date_week',)))
+        # the top rows of a partition follow each other
+        self.assertEqual(spec.sort_by, ('date_week', '-clicks'))
+        for query_params in (
+                'group_by=channel&top=3', 'group_by=channel&top_by=clicks', 'top=3&top_by=clicks',
+                'group_by=channel&top=0&top_by=clicks', 'group_by=channel&top=3&top_by=channel',
+                'group_by=channel&top=3&top_by=clicks&partition_by=os',
+                'group_by=channel&top=3&top_by=cpi',
+                'group_by=channel&top=3&top_by=clicks&totals=1',
+                'group_by=channel&top=3&top_by=clicks&pagination=cursor'):
+            with self.subTest(query_params=query_params), self.assertRaises(ValidationError):
+                parse_query_params(QueryDict(query_params))
+
+    def test_top_of_every_partition(self):
+        query_params = {'group_by': 'country,channel', 'countries': 'US,CA,GB'}
+        rows = self.get_rows({**query_params, 'top': '2', 'top_by': 'revenue', 'partition_by': 'country'})
+
+        expected = []
+        for country in ('CA', 'GB', 'US'):
+            country_rows = [row for row in self.get_rows(query_params) if row['country'] == country]
+            expected.extend(sorted(country_rows, key=lambda row: -row['revenue'])[:2])
+        self.assertEqual([(row['country'], row['channel']) for row in rows],
+                         [(row['country'], row['channel']) for row in expected])
+
+    def test_window_function(self):
+        with CaptureQueriesContext(connection) as queries:
+            rows = self.get_rows({'group_by': 'date,channel', 'top': '1', 'top_by': 'clicks', 'partition_by': 'date'})
+        self.assertIn('ROW_NUMBER', ' '.join(query['sql'] for query in queries.captured_queries))
+        self.assertEqual(len(rows), UsageInfo.objects.values('date').distinct().count())
+
+    def test_same_rows_as_heap(self):
+        for query_params in self.QUERIES:
+            with self.subTest(**query_params):
+                spec = parse_query_params(QueryDict(urlencode(query_params)))
+                plan = get_plan(spec)
+                # the window function query and the heap of every partition
+                self.assertEqual(top.execute(plan), top.select(plan.values_list.all(), plan.fields, spec))
+
+                expected = self.get_rows(query_params)
+                with override_settings(USAGE_INFO_ENGINE='columnar'):
+                    rows = self.get_rows(query_params)
+                self.assertEqual(len(rows), len(expected))
+                for row, expected_row in zip(rows, expected):
+                    self.assertEqual(row.keys(), expected_row.keys())
+                    for field, value in expected_row.items():
+                        if isinstance(value, float):
+                            self.assertAlmostEqual(row[field], value, places=6, msg=field)
+                        else:
+                            self.assertEqual(row[field], value, msg=field)
+
+
+@override_settings(USAGE_INFO_BATCH_WORKERS=1)  # the test data is not committed, other connections don't see it
+class BatchQueries(APITestCase):
+    QUERIES = [
+        'group_by=channel&sort_by=-clicks',
+        {'group_by': 'country,os', 'sort_by': 'os,-impressions', 'limit': 5, 'offset': 5},
+        {'group_by': 'date', 'sort_by': '-cpi', 'cpi': '1'},
+        {'group_by': 'channel', 'sort_by': 'date', 'limit': 20},
+        {'group_by': 'os', 'sort_by': 'cpi', 'cpi': '1', 'countries': 'CA'},
+        {'group_by': 'channel,country', 'countries': 'CA', 'sort_by': 'channel'},
+        {'date_from': '2017-06-01', 'sort_by': '-revenue', 'limit': 3},
+        {'group_by': 'date', 'pagination': 'cursor', 'limit': 2},
+        {'group_by': 'channel', 'channels': 'unknown'},
+        {'group_by': 'channel', 'channels': 'unknown', 'sort_by': 'channel'},
+        {'group_by': 'date:month,os', 'sort_by': 'date,os'},
+        {'group_by': 'date:week', 'sort_by': '-clicks', 'cpi': '1'},
+        {'group_by': 'date,channel', 'sort_by': '-roas', 'metrics': 'roas,ctr'},
+        {'group_by': 'channel,country', 'top': '2', 'top_by': 'clicks', 'partition_by': 'channel', 'limit': 10},
+    ]
+
+    @classmethod
+    def setUpTestData(cls):
+        with open(SAMPLE_DATASET) as csvf:
+            load_csv(csvf)
+
+    def setUp(self):
+        caches['usage_info'].clear()
+
+    def batch(self, queries: list):
+        return self.client.post(reverse("usage-info-batch"), {'queries': queries}, format='json')
+
+    def get(self, query: typ.Union[str, dict]):
+        caches['usage_info'].clear()
+        return self.client.get(f'{reverse("usage-info")}?{query if isinstance(query, str) else urlencode(query)}')
+
+    def assertSameData(self, data: typ.Any, expected: typ.Any):
+        """The sums of the floats may differ in the last digits (the batch may read another rollup)"""
+        if isinstance(expected, float):
+            self.assertAlmostEqual(data, expected, places=6)
+        elif isinstance(expected, (list, tuple)):
+            self.assertEqual(len(data), len(expected))
+            for value, expected_value in zip(data, expected):
+                self.assertSameData(value, expected_value)
+        elif isinstance(expected, dict):
+            self.assertEqual(list(data), list(expected))
+            for field, value in expected.items():
+                self.assertSameData(data[field], value)
+        else:
+            self.assertEqual(data, expected)
+
+    def test_same_results_as_view(self):
+        response = self.batch(self.QUERIES)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        for query, result in zip(self.QUERIES, response.data['results']):
+            with self.subTest(query=query):
+                expected = self.get(query)
+                self.assertEqual(result['status'], expected.status_code)
+                self.assertSameData(result['data'], expected.data)
+
+    @unittest.skipUnless(connection.vendor == 'postgresql', 'GROUPING SETS are supported by PostgreSQL')
+    def test_same_filters_merged(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.batch(self.QUERIES[:5])
+        self.assertEqual(len(response.data['results']), 5)
+        self.assertEqual(sum('GROUPING SETS' in query['sql'] for query in queries.captured_queries), 1)
+        # the 5th query is filtered by another country: the count and the page of UsageInfoView
+        self.assertEqual(sum('GROUPING SETS' not in query['sql'] and 'SUM(' in query['sql']
+                             for query in queries.captured_queries), 2)
+
+    def test_results_cached(self):
+        self.batch(self.QUERIES[:3])
+        response = self.client.get(reverse("usage-info"), {'group_by': 'channel', 'sort_by': '-clicks'})
+        self.assertEqual(response['X-Cache'], 'HIT')
+
+    def test_invalid_query(self):
+        response = self.batch(['group_by=clicks', 'group_by=os'])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([result['status'] for result in response.data['results']], [400, 200])
+        self.assertEqual(response.data['results'][0]['data'], self.get('group_by=clicks').data)
+
+    def test_invalid_body(self):
+        for queries in ([], [1], ['group_by=os'] * 51):
+            with self.subTest(queries=queries):
+                self.assertEqual(self.batch(queries).status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class ConcurrentBatchQueries(APITransactionTestCase):
+
+    def setUp(self):
+        with open(SAMPLE_DATASET) as csvf:
+            load_csv(csvf)
+
+    @override_settings(USAGE_INFO_BATCH_WORKERS=4)
+    def test_queries_run_in_threads(self):
+        queries = ['group_by=date&sort_by=date', 'group_by=os&os=ios', 'sort_by=-spend&limit=3',
+                   'group_by=country&date_to=2017-05-20', 'group_by=channel&channels=vungle']
+        response = self.client.post(reverse("usage-info-batch"), {'queries': queries}, format='json')
+        self.assertEqual([result['status'] for result in response.data['results']], [200] * len(queries))
+        self.assertEqual(response.data['results'][1]['data']['results'][0]['os'], 'ios')
+        self.assertEqual(len(response.data['results'][2]['data']['results']), 3)
+
+
+class ReplicasMixin:
+    """The replicas of the tests are more connections to the test database (or to a missing one)"""
+
+    def add_replicas(self, *aliases: str, **settings_dict) -> None:
+        for alias in aliases:
+            connections.databases[alias] = {**connections.databases[DEFAULT_DB_ALIAS], **settings_dict}
+            self.addCleanup(self.remove_replica, alias)
+        replicas_settings = override_settings(USAGE_INFO_REPLICAS=list(aliases))
+        replicas_settings.enable()
+        self.addCleanup(replicas_settings.disable)
+
+    @staticmethod
+    def remove_replica(alias: str) -> None:
+        connections[alias].close()
+        del connections[alias]
+        del connections.databases[alias]
+
+
+class ReadReplicas(ReplicasMixin, APITransactionTestCase):
+
+    def setUp(self):
+        with open(SAMPLE_DATASET) as csvf:
+            load_csv(csvf)
+        caches['usage_info'].clear()
+        replicas.monitor.reset()
+        self.addCleanup(replicas.monitor.reset)
+
+    def get(self, params: dict, queries: typ.Dict[str, list]):
+        """Get the usage info, collect the usage info queries sent to the databases (the keys of queries)"""
+        with contextlib.ExitStack() as stack:
+            captured = {alias: stack.enter_context(CaptureQueriesContext(connections[alias])) for alias in queries}
+            response = self.client.get(reverse('usage-info'), params)
+        for alias, context in captured.items():
+            queries[alias].extend(query['sql'] for query in context.captured_queries if 'usage_info_' in query['sql'])
+        return response
+
+    def test_round_robin(self):
+        expected = self.client.get(reverse('usage-info'), {'group_by': 'os'}).data
+        self.add_replicas('replica_a', 'replica_b')
+        queries = {DEFAULT_DB_ALIAS: [], 'replica_a': [], 'replica_b': []}
+        for limit in range(1, 5):
+            response = self.get({'group_by': 'os', 'sort_by': 'os', 'limit': limit}, queries)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(response.data['count'], expected['count'])
+        self.assertEqual(queries[DEFAULT_DB_ALIAS], [])
+        self.assertTrue(queries['replica_a'])
+        self.assertEqual(len(queries['replica_a']), len(queries['replica_b']))
+        self.assertEqual({alias: state['reads'] for alias, state in replicas.monitor.as_dict().items()},
+                         {'replica_a': 2, 'replica_b': 2})
+
+    @override_settings(USAGE_INFO_BATCH_WORKERS=2)
+    def test_batch_threads(self):
+        self.add_replicas('replica')
+        response = self.client.post(
+            reverse('usage-info-batch'), {'queries': ['group_by=os&sort_by=os', 'sort_by=-spend&limit=3']},
+            format='json')
+        self.assertEqual([result['status'] for result in response.data['results']], [200, 200])
+        self.assertEqual(replicas.monitor.as_dict()['replica']['reads'], 1)
+
+    def test_unavailable_replica(self):
+        missing = '/nonexistent/usage_info.sqlite3' if connection.vendor == 'sqlite' else 'nonexistent_usage_info'
+        self.add_replicas('replica', NAME=missing)
+        queries = {DEFAULT_DB_ALIAS: []}
+        response = self.get({'group_by': 'channel'}, queries)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(queries[DEFAULT_DB_ALIAS])
+        state = replicas.monitor.as_dict()['replica']
+        self.assertEqual((state['healthy'], state['reads']), (False, 0))
+        self.assertTrue(state['error'])
+
+    def test_lagging_replica(self):
+        self.add_replicas('replica')
+        with override_settings(USAGE_INFO_REPLICA_MAX_LAG=-1):
+            self.assertEqual(replicas.monitor.choose(), DEFAULT_DB_ALIAS)
+        self.assertEqual(replicas.monitor.as_dict()['replica']['lag'], 0)
+        # not checked again until the check interval has passed
+        self.assertEqual(replicas.monitor.choose(), DEFAULT_DB_ALIAS)
+        with override_settings(USAGE_INFO_REPLICA_CHECK_INTERVAL=0):
+            self.assertEqual(replicas.monitor.choose(), 'replica')
+
+    def test_failed_replica(self):
+        self.add_replicas('replica')
+        with self.assertRaises(DatabaseError):
+            with replicas.reads() as alias:
+                self.assertEqual(alias, 'replica')
+                raise DatabaseError('connection lost')
+        self.assertEqual(replicas.monitor.as_dict()['replica']['error'], 'connection lost')
+        self.assertEqual(replicas.monitor.choose(), DEFAULT_DB_ALIAS)
+
+    def test_routing(self):
+        self.add_replicas('replica')
+        router = replicas.ReplicaRouter()
+        self.assertEqual(UsageInfo.objects.all().db, DEFAULT_DB_ALIAS)
+        with replicas.reads():
+            self.assertEqual(UsageInfo.objects.all().db, 'replica')
+            self.assertEqual(Channel.objects.all().db, 'replica')
+            self.assertEqual(UsageInfo.objects.select_for_update().db, DEFAULT_DB_ALIAS)
+            self.assertEqual(router.db_for_write(UsageInfo), DEFAULT_DB_ALIAS)
+            self.assertIsNone(router.db_for_read(Session))
+            # the nested blocks keep the database
+            with replicas.reads() as alias:
+                self.assertEqual(alias, 'replica')
+        self.assertFalse(router.allow_migrate('replica', 'usage_info'))
+        self.assertIsNone(router.allow_migrate(DEFAULT_DB_ALIAS, 'usage_info'))
+
+    def test_metrics(self):
+        self.add_replicas('replica')
+        self.client.get(reverse('usage-info'))
+        response = self.client.get(reverse('usage-info-metrics'), {'format': 'prometheus'})
+        self.assertIn('usage_info_replica_healthy{alias="replica"} 1', response.content.decode())
+        self.assertIn('usage_info_replica_reads_total{alias="replica"} 1', response.content.decode())
+
+
+@unittest.skipIf(columnar.np is None, 'NumPy is not installed')
+class ColumnarEngine(APITestCase):
+    """
+    The columnar engine answers every query with the same rows (in the same order) as the database,
+    the float sums may differ in the last digits (the database adds the floats one by one)
+    """
+
+    QUERIES = (
+        {},
+        {'sort_by': '-revenue'},
+        {'sort_by': 'channel,-date', 'date_from': '2017-06-01'},
+        {'date_from': '2017-05-17', 'date_to': '2017-05-25', 'os': 'ios', 'countries': 'US,GB,DE'},
+        {'group_by': 'date'},
+        {'group_by': 'os', 'sort_by': '-installs'},
+        {'group_by': 'channel,country', 'sort_by': '-clicks', 'date_to': '2017-06-01'},
+        {'group_by': 'country,os', 'sort_by': 'os,-impressions'},
+        {'group_by': 'date,channel,country,os', 'cpi': '1'},
+        {'group_by': 'channel', 'sort_by': 'date', 'date_to': '2017-05-20'},
+        {'group_by': 'country', 'sort_by': '-cpi', 'cpi': '1', 'channels': 'adcolony,unityads'},
+        {'group_by': 'os', 'sort_by': 'cpi', 'cpi': '1', 'countries': 'CA'},
+        {'sort_by': 'cpi', 'cpi': '1', 'channels': 'vungle'},
+        {'group_by': 'channel', 'channels': 'unknown'},
+        {'group_by': 'date', 'date_from': '2030-01-01'},
+        {'group_by': 'date:week,os', 'sort_by': 'date,-clicks'},
+        {'group_by': 'date:month', 'sort_by': '-cpi', 'cpi': '1'},
+        {'group_by': 'date:quarter,channel', 'countries': 'US'},
+        {'group_by': 'date:year,country', 'sort_by': '-date,country'},
+        {'group_by': 'date,channel', 'sort_by': '-roas,date', 'metrics': 'roas,ctr,ipm'},
+        {'group_by': 'os', 'sort_by': 'ipm', 'metrics': 'ipm,cpi', 'countries': 'CA'},
+    )
+
+    @classmethod
+    def setUpTestData(cls):
+        with open(SAMPLE_DATASET) as csvf:
+            load_csv(csvf)
+
+    def setUp(self):
+        caches['usage_info'].clear()
+        columnar.clear()
+
+    def get_rows(self, query_params: dict, engine: str) -> list:
+        caches['usage_info'].clear()
+        with override_settings(USAGE_INFO_ENGINE=engine):
+            response = self.client.get(reverse("usage-info"), {**query_params, 'limit': 10000, 'format': 'json'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return json.loads(response.content)['results']
+
+    def assertSameRows(self, rows: list, expected: list):
+        self.assertEqual(len(rows), len(expected))
+        for row, expected_row in zip(rows, expected):
+            self.assertEqual(row.keys(), expected_row.keys())
+            for field, value in expected_row.items():
+                if isinstance(value, float):
+                    self.assertTrue(math.isclose(row[field], value, rel_tol=1e-12),
+                                    msg=f'{field}: {row[field]} != {value}')
+                else:
+                    self.assertEqual(row[field], value, msg=field)
+
+    def test_same_rows_as_database(self):
+        for query_params in self.QUERIES:
+            with self.subTest(**query_params):
+                expected = self.get_rows(query_params, 'orm')
+                rows = self.get_rows(query_params, 'columnar')
+                if 'sort_by' not in query_params:
+                    # the database does not guarantee any order
+                    key = json.dumps
+                    expected, rows = sorted(expected, key=key), sorted(rows, key=key)
+                self.assertSameRows(rows, expected)
+
+    def test_float_sums_rounded_once(self):
+        rows = self.get_rows({'group_by': 'channel', 'sort_by': 'channel'}, 'columnar')
+        for row in rows:
+            values = UsageInfo.objects.filter(channel__name=row['channel']).values_list('spend', 'revenue')
+            self.assertEqual((row['spend'], row['revenue']), tuple(map(math.fsum, zip(*values))))
+
+    def test_float_sums_not_finite(self):
+        np = columnar.np
+        groups = np.array([0, 0, 1, 1, 2])
+        sums = columnar.float_sums(groups, np.array([1.5, np.nan, 2.5, np.inf, 0.1]), 3)
+        self.assertTrue(math.isnan(sums[0]))
+        self.assertEqual(sums[1:].tolist(), [math.inf, 0.1])
+
+    def test_exact_integer_sums(self):
+        # the sums above 2 ** 53 are not exact as floats
+        version = cache.current_version()
+        snapshot = columnar.get_snapshot(version)
+        impressions = columnar.np.full(len(snapshot), 2 ** 50 + 1, dtype=columnar.np.int64)
+        columnar._snapshot = columnar.Snapshot(
+            version, {**snapshot.columns, 'impressions': impressions}, snapshot.name_ranks)
+        spec = parse_query_params(QueryDict('group_by=os'))
+        dimension_cache.refresh(version)
+        plan = get_plan(spec)
+        rows = columnar.execute(spec, plan.dimension_ids, plan.fields, version)[:]
+        counts = dict(zip(*columnar.np.unique(snapshot.columns['os'], return_counts=True)))
+        self.assertEqual({row[0]: row[1] for row in rows},
+                         {os_id: int(count) * (2 ** 50 + 1) for os_id, count in counts.items()})
+
+    def test_sorted_by_exact_integer_sums(self):
+        np = columnar.np
+        version = cache.current_version()
+        snapshot = columnar.get_snapshot(version)
+        dimension_cache.refresh(version)
+        os_ids = sorted(set(snapshot.columns['os'].tolist()), key=lambda os_id: dimension_cache.get_name('os', os_id))
+        # the same sums as floats, the tie would be broken by the os names
+        impressions = np.zeros(len(snapshot), dtype=np.int64)
+        impressions[np.argmax(snapshot.columns['os'] == os_ids[0])] = 2 ** 53
+        impressions[np.argmax(snapshot.columns['os'] == os_ids[-1])] = 2 ** 53 + 1
+        columnar._snapshot = columnar.Snapshot(
+            version, {**snapshot.columns, 'impressions': impressions}, snapshot.name_ranks)
+        for sort_by, expected in (('-impressions', [os_ids[-1], os_ids[0]]), ('impressions', [os_ids[0], os_ids[-1]])):
+            with self.subTest(sort_by=sort_by):
+                spec = parse_query_params(QueryDict(f'group_by=os&sort_by={sort_by}'))
+                plan = get_plan(spec)
+                rows = columnar.execute(spec, plan.dimension_ids, plan.fields, version)[:]
+                ordered = [row[plan.fields.index('os')] for row in rows]
+                self.assertEqual([os_id for os_id in ordered if os_id in expected], expected)
+
+    def test_pages(self):
+        query_params = {'group_by': 'date,country', 'sort_by': '-spend', 'limit': 7, 'offset': 14}
+        with override_settings(USAGE_INFO_ENGINE='columnar'):
+            response = self.client.get(reverse("usage-info"), query_params)
+        caches['usage_info'].clear()
+        expected = self.client.get(reverse("usage-info"), query_params)
+        self.assertEqual(response.data['count'], expected.data['count'])
+        self.assertSameRows(response.data['results'], expected.data['results'])
+
+    def test_export(self):
+        query_params = {'group_by': 'channel', 'sort_by': 'channel', 'format': 'ndjson'}
+        with override_settings(USAGE_INFO_ENGINE='columnar'):
+            response = self.client.get(reverse("usage-info-export"), query_params)
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertSameRows([json.loads(line) for line in lines], self.get_rows(query_params, 'orm'))
+
+    def test_snapshot_reloaded_on_data_change(self):
+        query_params = {'group_by': 'channel', 'channels': 'new'}
+        self.assertEqual(self.get_rows(query_params, 'columnar'), [])
+        load_csv(io.StringIO(
+            'date,channel,country,os,impressions,clicks,installs,spend,revenue\n'
+            '2017-06-10,new,CA,ios,10,1,1,1.5,0\n'
+            '2017-06-11,new,US,ios,10,2,1,1.0,0\n'))
+        self.assertEqual(self.get_rows(query_params, 'columnar')[0]['clicks'], 3)
+
+    def test_snapshot_loaded_once_per_version(self):
+        version = cache.current_version()
+        self.assertIs(columnar.get_snapshot(version), columnar.get_snapshot(version))
+        self.assertEqual(len(columnar.get_snapshot(version)), UsageInfo.objects.count())
+
+    def test_benchmark(self):
+        out = io.StringIO()
+        call_command('benchmark_columnar', '--query', 'group_by=os', '--repeat', '1', stdout=out)
+        self.assertIn('Speedup', out.getvalue())
+
+
+@unittest.skipUnless(connection.vendor == 'postgresql' and asyncpg is not None, 'Requires PostgreSQL and asyncpg')
+class AsyncUsageInfo(ReplicasMixin, APITransactionTestCase):
+    """The async (ASGI, asyncpg) path gives the same responses as UsageInfoView"""
+
+    def setUp(self):
+        # the asyncpg connections see the committed rows only
+        with open(SAMPLE_DATASET) as csvf:
+            load_csv(csvf)
+        caches['usage_info'].clear()
+        replicas.monitor.reset()
+        self.addCleanup(replicas.monitor.reset)
+
+    @staticmethod
+    async def request(app: AsyncUsageInfoApp, query_params: dict) -> typ.Tuple[int, dict, bytes]:
+        scope = {
+            'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET', 'scheme': 'http',
+            'path': '/usage_info', 'root_path': '', 'query_string': urlencode(query_params).encode(),
+            'headers': [(b'host', b'testserver')], 'server': ('testserver', 80), 'client': ('127.0.0.1', 5000),
+        }
+        messages = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+        async def send(message):
+            messages.append(message)
+
+        await app(scope, receive, send)
+        start, body = messages[0], b''.join(message.get('body', b'') for message in messages[1:])
+        return start['status'], {name.decode(): value.decode() for name, value in start['headers']}, body
+
+    def get_async(self, *queries: dict, concurrently: bool = False, app: AsyncUsageInfoApp = None) -> list:
+        app = app or AsyncUsageInfoApp(get_asgi_application())
+
+        async def run():
+            try:
+                if concurrently:
+                    return await asyncio.gather(*(self.request(app, query_params) for query_params in queries))
+                return [await self.request(app, query_params) for query_params in queries]
+            finally:
+                await app.close()
+        return asyncio.run(run())
+
+    def get_sync(self, query_params: dict):
+        caches['usage_info'].clear()
+        return self.client.get(reverse("usage-info"), query_params, HTTP_ACCEPT='application/json')
+
+    def test_to_asyncpg_sql(self):
+        self.assertEqual(
+            to_asyncpg_sql("SELECT * FROM t WHERE a = %s AND b LIKE 'x%%' AND c IN (%s, %s)"),
+            "SELECT * FROM t WHERE a = $1 AND b LIKE 'x%' AND c IN ($2, $3)")
+
+    def test_same_response_as_view(self):
+        queries = (
+            {},
+            {'date_from': '2017-06-01', 'date_to': '2017-06-10', 'sort_by': '-revenue,channel', 'limit': 7},
+            {'group_by': 'channel,country', 'sort_by': '-clicks', 'countries': 'US,CA', 'offset': 3},
+            {'group_by': 'date,os', 'sort_by': '-cpi', 'cpi': '1', 'os': 'ios', 'limit': 5, 'offset': 10},
+            {'group_by': 'channel', 'sort_by': 'date', 'date_to': '2017-05-20'},
+            {'group_by': 'os', 'channels': 'unknown'},
+            {'group_by': 'country', 'sort_by': 'country', 'offset': 10000},
+            {'group_by': 'date:week,os', 'sort_by': '-date,os', 'limit': 5},
+        )
+        for query_params, (status_code, headers, body) in zip(queries, self.get_async(*queries)):
+            with self.subTest(**query_params):
+                expected = self.get_sync(query_params)
+                self.assertEqual(status_code, expected.status_code)
+                self.assertEqual(headers['content-type'], expected['Content-Type'])
+                self.assertEqual(headers['etag'], expected['ETag'])
+                self.assertEqual(json.loads(body), json.loads(expected.content))
+
+    def test_not_valid(self):
+        (status_code, _, body), = self.get_async({'group_by': 'clicks'})
+        expected = self.get_sync({'group_by': 'clicks'})
+        self.assertEqual(status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(json.loads(body), json.loads(expected.content))
+
+    def test_response_cache(self):
+        query_params = {'group_by': 'os', 'sort_by': 'os'}
+        (_, first, _), (_, second, body) = self.get_async(query_params, query_params)
+        self.assertEqual((first['x-cache'], second['x-cache']), ('MISS', 'HIT'))
+        self.assertEqual(json.loads(body)['count'], 2)
+
+    def test_concurrent_requests(self):
+        queries = [{'group_by': 'date', 'sort_by': '-spend', 'limit': limit} for limit in range(1, 21)]
+        responses = self.get_async(*queries, concurrently=True)
+        self.assertEqual([len(json.loads(body)['results']) for _, _, body in responses], list(range(1, 21)))
+
+    def test_replica_reads(self):
+        self.add_replicas('replica')
+        app, aliases = AsyncUsageInfoApp(get_asgi_application()), []
+        execute = app.execute
+
+        async def tracked(alias: str, *args):
+            aliases.append(alias)
+            return await execute(alias, *args)
+        app.execute = tracked
+
+        query_params = {'group_by': 'country', 'sort_by': 'country', 'limit': 5}
+        (status_code, _, body), = self.get_async(query_params, app=app)
+        self.assertEqual(status_code, status.HTTP_200_OK)
+        self.assertEqual(set(aliases), {'replica'})
+        self.assertEqual(replicas.monitor.as_dict()['replica']['reads'], 1)
+        self.assertEqual(json.loads(body), json.loads(self.get_sync(query_params).content))
+
+    def test_unavailable_replica(self):
+        # (another alias: the thread of sync_to_async keeps its connection objects)
+        self.add_replicas('missing_replica', NAME='nonexistent_usage_info')
+        (status_code, _, body), = self.get_async({'group_by': 'os'})
+        self.assertEqual(status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(body), json.loads(self.get_sync({'group_by': 'os'}).content))
+        self.assertEqual(replicas.monitor.as_dict()['missing_replica']['reads'], 0)
+
+    def test_instrumentation(self):
+        instrumentation.registry.reset()
+        query_params = {'group_by': 'channel', 'sort_by': '-clicks', 'limit': 3}
+        (_, headers, _), = self.get_async(query_params)
+        expected = self.get_sync(query_params)['Server-Timing']
+
+        def phases(timing: str) -> typ.List[str]:
+            return [metric.split(';')[0] for metric in timing.split(', ')]
+        self.assertEqual(phases(headers['server-timing']), phases(expected))
+        self.assertRegex(headers['server-timing'], r'sql;dur=[\d.]+;desc="\d+ queries"')
+        endpoint = instrumentation.registry.as_dict()['usage-info']
+        self.assertEqual((endpoint['requests'], endpoint['rows']['count']), (2, 2))
+
+    @override_settings(USAGE_INFO_SLOW_REQUEST_MS=0)
+    def test_slow_request_log(self):
+        with self.assertLogs('usage_info.slow', 'WARNING') as logs:
+            self.get_async({'group_by': 'country', 'countries': 'US'})
+        record = json.loads(logs.records[0].getMessage())
+        self.assertEqual((record['status'], record['spec']['group_by']), (200, ['country']))
+        self.assertTrue(any('GROUP BY' in query['sql'] for query in record['queries']))
+
+    def test_coalesced(self):
+        app = AsyncUsageInfoApp(get_asgi_application())
+        paginate = app.paginate
+
+        async def slow_paginate(*args):
+            await asyncio.sleep(0.3)
+            return await paginate(*args)
+        app.paginate = slow_paginate
+
+        before = coalescing.stats.as_dict()
+        responses = self.get_async(*[{'group_by': 'date', 'sort_by': '-spend'}] * 4, concurrently=True, app=app)
+        after = coalescing.stats.as_dict()
+        self.assertEqual(sorted(headers.get('x-coalesced', 'leader') for _, headers, _ in responses),
+                         ['leader', 'process', 'process', 'process'])
+        self.assertEqual(len({body for _, _, body in responses}), 1)
+        self.assertEqual(after['queries'] - before['queries'], 1)
+
+    def test_plan_compiled_off_loop(self):
+        compile_plan.cache_clear()
+        compile_plan_sql.cache_clear()
+        threads = []
+
+        def tracked(*args):
+            threads.append(threading.current_thread())
+            return compile_values_list(*args)
+
+        with mock.patch('usage_info.asgi.compile_values_list', tracked):
+            self.get_async({'group_by': 'os', 'limit': 1}, {'group_by': 'os', 'limit': 1, 'offset': 1})
+        # the version, rows and COUNT queries once, the second page reuses them
+        self.assertEqual(len(threads), 3)
+        self.assertNotIn(threading.main_thread(), threads)
+
+    def test_cursor_pagination_served_by_django(self):
+        query_params = {'pagination': 'cursor', 'group_by': 'channel', 'sort_by': 'channel', 'limit': 2}
+        (status_code, _, body), = self.get_async(query_params)
+        self.assertEqual(status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(body)['results'], json.loads(self.get_sync(query_params).content)['results'])
+
+
+class LoadTest(LiveServerTestCase):
+
+    def test_load_test_command(self):
+        out = io.StringIO()
+        call_command(
+            'load_test_usage_info', f'{self.live_server_url}/usage_info', '--concurrency', '2', '--requests', '6',
+            '--query', 'group_by=os', '--unique', stdout=out)
+        clients, *_, errors = out.getvalue().splitlines()[-1].split()
+        self.assertEqual((clients, errors), ('2', '0'))
+
+
+class SyntheticBenchmark(APITestCase):
+    options = synthetic.Options(rows=500, days=30, channels=5, countries=10, operating_systems=2)
+
+    def test_rows_reproducible(self):
+        rows = list(synthetic.generate_rows(self.options))
+        self.assertEqual(len(rows), 500)
+        self.assertEqual(len({row[:4] for row in rows}), 500)
+        self.assertEqual(rows, list(synthetic.generate_rows(self.options)))
+        self.assertNotEqual(rows, list(synthetic.generate_rows(self.options._replace(seed=1))))
+        self.assertEqual({row[0] for row in rows}, {
+            (self.options.date_to - datetime.timedelta(days=day)).isoformat() for day in range(30)})
+
+    def test_rows_skewed(self):
+        rows = list(synthetic.generate_rows(self.options))
+        counts = synthetic.rows_per_date(self.options)
+        self.assertGreater(counts[-1], 2 * counts[0])
+        channels = [row[1] for row in rows]
+        self.assertGreater(channels.count('facebook'), channels.count('vungle'))
+
+    def test_too_many_rows(self):
+        with self.assertRaises(ValueError):
+            synthetic.rows_per_date(self.options._replace(rows=3001))
+        self.assertEqual(synthetic.rows_per_date(self.options._replace(rows=3000)), [100] * 30)
+
+    def test_generate_command(self):
+        call_command(
+            'generate_usage_info', '--rows', '500', '--days', '30', '--channels', '5', '--countries', '10',
+            '--os', '2', stdout=io.StringIO())
+        self.assertEqual(UsageInfo.objects.count(), 500)
+        with self.assertRaises(CommandError):
+            call_command('generate_usage_info', '--rows', '10', '--days', '1', '--channels', '1', '--countries', '1')
+
+    def test_benchmark_command(self):
+        call_command('generate_usage_info', '--rows', '500', '--days', '30', stdout=io.StringIO())
+        out = io.StringIO()
+        call_command('benchmark_usage_info', '--repeat', '2', '--match', 'group_by=channel,country&', stdout=out)
+        report = json.loads(out.getvalue())
+
+        self.assertEqual(report['meta']['rows'], 500)
+        self.assertEqual(len(report['results']), 41)  # a README example and the matrix
+        for result in report['results']:
+            self.assertEqual(result['status'], 200)
+            self.assertLessEqual(result['p50_ms'], result['p95_ms'])
+            self.assertGreaterEqual(result['queries'], 1)
+            self.assertIn('peak_memory_kb', result)
+
+        with tempfile.NamedTemporaryFile('wt', suffix='.json') as baseline:
+            json.dump({'results': [{**result, 'p50_ms': 0.001} for result in report['results']]}, baseline)
+            baseline.flush()
+            with self.assertRaisesMessage(CommandError, 'regressed'):
+                call_command(
+                    'benchmark_usage_info', '--repeat', '1', '--no-matrix', '--baseline', baseline.name,
+                    '--max-regression', '2', stdout=io.StringIO())
+
+
+@unittest.skipUnless(connection.vendor == 'postgresql', 'The table is partitioned on PostgreSQL only')
+@override_settings(USAGE_INFO_ROLLUPS=False)
+class UsageInfoPartitions(APITestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        with open(SAMPLE_DATASET) as csvf:
+            load_csv(csvf)
+
+    @staticmethod
+    def scanned_tables(query_params: dict) -> set:
+        view = UsageInfoView(request=Request(APIRequestFactory().get('/usage_info', query_params)))
+        sql, params = view.get_queryset().query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+            plan = cursor.fetchone()[0]
+
+        tables, nodes = set(), [plan[0]['Plan']]
+        while nodes:
+            node = nodes.pop()
+            if 'Relation Name' in node:
+                tables.add(node['Relation Name'])
+            nodes.extend(node.get('Plans', ()))
+        return tables
+
+    def test_loader_creates_partitions(self):
+        self.assertEqual(
+            partitions.list_partitions(),
+            {datetime.date(2017, 5, 1): 'usage_info_usageinfo_2017_05',
+             datetime.date(2017, 6, 1): 'usage_info_usageinfo_2017_06'})
+
+    def test_date_range_pruned_to_one_partition(self):
+        self.assertEqual(
+            self.scanned_tables({'date_from': '2017-06-01', 'date_to': '2017-06-15'}),
+            {'usage_info_usageinfo_2017_06'})
+
+    def test_grouped_date_range_pruned(self):
+        self.assertEqual(
+            self.scanned_tables({'date_from': '2017-05-20', 'date_to': '2017-06-10', 'group_by': 'channel'}),
+            {'usage_info_usageinfo_2017_05', 'usage_info_usageinfo_2017_06'})
+
+    def test_open_date_range_scans_default_partition(self):
+        self.assertEqual(
+            self.scanned_tables({'date_from': '2017-06-10'}),
+            {'usage_info_usageinfo_2017_06', partitions.DEFAULT_PARTITION})
+
+    def test_rows_moved_from_default_partition(self):
+        UsageInfo.objects.create(**with_dimensions(dict(
+            date='2019-12-06', channel='adcolony', country='US', os='ios',
+            impressions=1, clicks=1, installs=1, spend=1.0, revenue=1.0)))
+        self.assertEqual(
+            partitions.ensure_partitions([datetime.date(2019, 12, 31)]), ['usage_info_usageinfo_2019_12'])
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT count(*) FROM usage_info_usageinfo_2019_12')
+            self.assertEqual(cursor.fetchone()[0], 1)
+            cursor.execute(f'SELECT count(*) FROM {partitions.DEFAULT_PARTITION}')
+            self.assertEqual(cursor.fetchone()[0], 0)
+
+    def test_command_creates_future_partitions(self):
+        call_command('manage_usage_info_partitions', '--ahead', '2', stdout=io.StringIO())
+        current = partitions.month_start(datetime.date.today())
+        self.assertLessEqual(
+            {current, partitions.add_months(current, 1), partitions.add_months(current, 2)},
+            set(partitions.list_partitions()))
+
+    def test_command_archives_old_partitions(self):
+        with tempfile.TemporaryDirectory() as archive_dir:
+            call_command(
+                'manage_usage_info_partitions', '--ahead', '0', '--detach-before', '2017-06-15',
+                '--archive-dir', archive_dir, stdout=io.StringIO())
+            self.assertNotIn(datetime.date(2017, 5, 1), partitions.list_partitions())
+            self.assertEqual(UsageInfo.objects.filter(date__lt='2017-06-01').count(), 0)
+            self.assertFalse(UsageInfoByDate.objects.filter(date__lt='2017-06-01').exists())
+
+            with open(Path(archive_dir) / 'usage_info_usageinfo_2017_05.csv') as csvf:
+                stats = load_csv(csvf)
+        self.assertEqual(stats.rows, 552)
+        self.assertEqual(UsageInfo.objects.count(), 1096)
@@ -0,0 +1,96 @@
+"""
+Top rows of every partition: top=N&top_by=<metric>&partition_by=<grouped fields> keeps the N grouped rows
+with the largest top_by metric of every partition (of all the rows without partition_by), e.g. the top 5 channels
+by revenue in every country: group_by=country,channel&top=5&top_by=revenue&partition_by=country.
+
+The database ranks the rows with ROW_NUMBER() OVER (PARTITION BY ... ORDER BY <top_by> DESC) and returns the top
+ones only. Without the window functions, and for the rows of the columnar engine and the batch queries, the rows
+are selected in Python with a heap per partition. Both rank NULLs last and break the ties by the grouped fields.
+"""
+import heapq
+import typing as typ
+from collections import defaultdict
+
+from django.core.exceptions import EmptyResultSet
+from django.db import connections
+from django.db.models import F, Window
+from django.db.models.expressions import OrderBy
+from django.db.models.functions import RowNumber
+
+from .query import DERIVED_FIELDS, QueryPlan, QuerySpec, compile_values_list, ordering_fields
+
+RANK = 'top_rank'
+
+
+def supports_window_functions(using: str) -> bool:
+    return connections[using].features.supports_over_clause
+
+
+def rank_ordering(spec: QuerySpec) -> typ.List[OrderBy]:
+    return [F(spec.top_by).desc(nulls_last=True), *(F(field).asc() for field in spec.group_by)]
+
+
+def execute(plan: QueryPlan) -> typ.List[tuple]:
+    """
+    Get the top rows of the query plan (sorted like the query) from the database
+
+    :param plan: query plan with top rows
+    :return: values_list() tuples
+    """
+    spec, queryset = plan.spec, plan.values_list.all()
+    if not supports_window_functions(queryset.db):
+        return select(queryset, plan.fields, spec)
+
+    connection = connections[queryset.db]
+    ordering = ordering_fields(queryset)
+    ranked = queryset.order_by().annotate(**{RANK: Window(
+        RowNumber(),
+        partition_by=[F(field) for field in spec.partition_by] or None,
+        order_by=rank_ordering(spec),
+    )})
+    try:
+        sql, params, columns, convert = compile_values_list(ranked, connection)
+    except EmptyResultSet:
+        return []  # e.g. filtered by unknown names only
+
+    # a window function can't be filtered in its own query: the ranked rows are filtered (and sorted by the positions
+    # of the ordering columns) by an outer query
+    quote = connection.ops.quote_name
+    order_by = ', '.join(
+        f'{columns.index(field.lstrip("-")) + 1}{" DESC" if field.startswith("-") else ""}'
+        f'{" NULLS LAST" if field.lstrip("-") in DERIVED_FIELDS else ""}' for field in ordering)
+    sql = f'SELECT * FROM ({sql}) {quote("ranked")} WHERE {quote(RANK)} <= %s'
+    if order_by:
+        sql += f' ORDER BY {order_by}'
+    with connection.cursor() as cursor:
+        cursor.execute(sql, (*params, spec.top))
+        # the tuples of the values_list() fields, without the rank
+        return convert(cursor.fetchall())
+
+
+def select(rows: typ.Iterable[tuple], fields: typ.Sequence[str], spec: QuerySpec) -> typ.List[tuple]:
+    """
+    Keep the top rows of every partition (keeping their order)
+
+    :param rows: values_list() tuples of the query plan (or a columnar result)
+    :param fields: fields of the tuples
+    :param spec: query spec with top rows
+    :return: top rows
+    """
+    rows = list(rows)
+    value = fields.index(spec.top_by)
+    partition = [fields.index(field) for field in spec.partition_by]
+    tiebreakers = [fields.index(field) for field in spec.group_by]
+
+    def rank_key(position: int) -> tuple:
+        # the largest values first, NULLs last, then the grouped fields
+        row = rows[position]
+        metric = row[value]
+        return (metric is None, 0 if metric is None else -metric, *(row[i] for i in tiebreakers))
+
+    partitions = defaultdict(list)
+    for position, row in enumerate(rows):
+        partitions[tuple(row[i] for i in partition)].append(position)
+    selected = sorted(
+        position for positions in partitions.values() for position in heapq.nsmallest(spec.top, positions, rank_key))
+    return [rows[position] for position in selected]
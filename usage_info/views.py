@@ -1,15 +1,46 @@
-import trafaret as t
-from django.http import QueryDict
+import time
+import logging
+import itertools
+import typing as typ
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import connections
+from django.http import HttpRequest, HttpResponse, QueryDict, StreamingHttpResponse
+from django.urls import reverse
 from rest_framework import generics
+from rest_framework.request import Request
+from rest_framework.response import Response
 from rest_framework.exceptions import ParseError
-from django.db.models import Sum, query, F, FloatField, ExpressionWrapper
+from rest_framework.renderers import JSONRenderer
+from rest_framework.settings import api_settings
+from rest_framework.views import APIView, status
+from django.db.models import query
 
-from .models import UsageInfo
+from . import cache, coalescing, columnar, grouping, instrumentation, replicas, top
+from .dimensions import cache as dimension_cache
+from .pagination import UsageInfoPagination
+from .query import (
+    QuerySpec, QueryPlan, parse_query_params, parse_batch, get_plan, get_dimension_ids, grouped_fields, get_ordering,
+    param_field,
+)
+from .renderers import COLUMNAR_RENDERERS, CSVRenderer, NDJSONRenderer, PrometheusRenderer
 from .serializers import UsageInfoSerializer
-from .validator import ValidationError, date_validator, comma_separated_str
+from .validator import ValidationError
+
+logger = logging.getLogger(__name__)
+
+
+class ReplicaReadsMixin:
+    """Handle the request in a replicas.reads() block: the usage info reads go to a read replica, if any"""
+
+    def dispatch(self, request: HttpRequest, *args, **kwargs) -> HttpResponse:
+        with replicas.reads():
+            return super().dispatch(request, *args, **kwargs)
 
 
-class UsageInfoView(generics.ListAPIView):
+class UsageInfoView(ReplicaReadsMixin, generics.ListAPIView):
     """
     Available url parameters:
         date_from - get records from the specified date. e.g 2017-06-01
@@ -18,83 +49,363 @@ class UsageInfoView(generics.ListAPIView):
         countries - filter records by chosen countries. e.g 'US' or several 'US,CA,...'
         os - filter records by chosen operating system. e.g 'android' or several 'android,ios,...'
         group_by - group by one ore several fields. e.g. 'date' or 'channel,country,os,...'
+            the dates can be grouped by week, month, quarter or year, e.g. 'date:month,channel'
+            (the date of a row is the first date of the bucket, sort_by=date sorts by the bucket)
         sort_by - group by one ore several fields. e.g. 'channel' or 'installs,-revenue,os,...' ('-' means descending)
-        cpi - CPI metric (cost per install). You can include it by adding 'cpi=1'
+        metrics - derived metrics of the (grouped) rows: cpi (cost per install), ctr (click-through rate),
+            ipm (installs per thousand impressions), roas (return on ad spend), e.g. 'cpi,roas';
+            null if the denominator is 0. 'cpi=1' is the same as 'metrics=cpi'
+        top, top_by, partition_by - the grouped rows with the largest top_by metric of every partition_by group,
+            e.g. the top 5 channels by revenue in every country: 'group_by=country,channel&top=5&top_by=revenue
+            &partition_by=country' (sorted by partition_by and -top_by unless sort_by is given)
+        totals - add the grand total row to the grouped rows: 'totals=1'
+        rollup - add the subtotals of every prefix of the group_by fields and the grand total: 'rollup=1'
+            (the 'grouping' field of the rows tells the level: 'channel,country', 'channel', '' for the grand total)
+        pagination - 'offset' (default, limit/offset params) or 'cursor' (keyset pagination, limit/cursor params)
+        format - 'json' (default), 'arrow' (Arrow IPC stream) or 'parquet' (if pyarrow is installed);
+            'Accept' header is respected as well
+
+    The params are parsed to a QuerySpec and the querysets built for it are reused by the next requests
+    of the same shape (see query.py). Responses are cached per QuerySpec until the data is changed (see cache.py).
+    The responses have an ETag and Last-Modified of the data version, conditional requests of unchanged data
+    get 304 Not Modified without running the query. The identical concurrent requests share one query
+    (see coalescing.py). The queries go to a read replica if there are healthy ones (see replicas.py).
     """
     serializer_class = UsageInfoSerializer
+    pagination_class = UsageInfoPagination
+    renderer_classes = (*api_settings.DEFAULT_RENDERER_CLASSES, *COLUMNAR_RENDERERS)
 
-    @staticmethod
-    def _validate_query_params(query_params: QueryDict) -> None:
+    def list(self, request: Request, *args, **kwargs) -> Response:
+        started = time.perf_counter()
+        with instrumentation.phase('validate'):
+            spec = self.get_spec()
+        parsed = time.perf_counter()
+
+        with instrumentation.phase('cache'):
+            key = cache.response_key(request, spec, self.get_version(), columns=self.is_columnar())
+            headers = cache.validator_headers(key, self.get_version(), request.accepted_renderer.format)
+            not_modified = cache.conditional_response(request, headers)
+            if not_modified is not None:
+                return not_modified
+            data = cache.get_response(key)
+        if data is not None:
+            return Response(data, headers={'X-Cache': 'HIT', **headers})
+
+        # the identical concurrent requests share the query (see coalescing.py)
+        self._planned = parsed
+        data, source = coalescing.coalescer.run(key, lambda: self.run_query(key))
+        response = Response(data, headers={'X-Cache': 'MISS', **headers})
+        if source != coalescing.LEADER:
+            response['X-Coalesced'] = source
+
+        response.usage_info_timings = {
+            'parse': parsed - started,
+            'plan': self._planned - parsed,
+            'execute': time.perf_counter() - self._planned,
+        }
+        logger.debug(
+            'usage_info %s: %s', spec,
+            ', '.join(f'{name} {seconds * 1000:.2f}ms' for name, seconds in response.usage_info_timings.items()))
+        return response
+
+    def run_query(self, key: str) -> typ.Any:
+        """Run the query of the request, store the response data in the response cache
+
+        :param key: response cache key
+        :return: response data
         """
-        Validate all the needed query_params from the request
+        with instrumentation.phase('plan'):
+            plan = self.get_plan()
+        self._planned = time.perf_counter()
+        rows = self.get_rows(plan)
+        page = self.paginate_queryset(rows)
+        with instrumentation.phase('serialize'):
+            data = self.serialize(plan, rows if page is None else page)
+        metrics = instrumentation.current()
+        if metrics is not None:
+            metrics.rows = len(rows if page is None else page)
+        if page is not None:
+            data = self.get_paginated_response(data).data
+        with instrumentation.phase('cache'):
+            cache.set_response(key, data)
+        return data
 
-        :param query_params: query params from the request
-        :return: None
+    def get_spec(self) -> QuerySpec:
+        """
+        Parse the query params of the request (once per request)
+
+        :return: query spec
         :raise ParseError: if query parameter is not valid
         """
-        group_by_allowed_fields = {'date', 'channel', 'country', 'os'}
-        sort_by_allowed_fields = {
-            'date', 'channel', 'country', 'os', 'impressions',
-            'clicks', 'installs', 'spend', 'revenue', 'cpi'}
-        sort_by_allowed_fields = sort_by_allowed_fields | {f'-{field}' for field in sort_by_allowed_fields}
-
-        schema = t.Dict({
-            t.Key('date_from', optional=True): date_validator,
-            t.Key('date_to', optional=True): date_validator,
-            t.Key('channels', optional=True): comma_separated_str(),
-            t.Key('countries', optional=True): comma_separated_str(),
-            t.Key('os', optional=True): comma_separated_str(),
-            t.Key('group_by', optional=True): comma_separated_str(group_by_allowed_fields),
-            t.Key('sort_by', optional=True): comma_separated_str(sort_by_allowed_fields),
-        }, allow_extra='*')
+        if not hasattr(self, '_spec'):
+            try:
+                self._spec = parse_query_params(self.request.query_params)
+            except ValidationError as err:
+                raise ParseError(err)
+            metrics = instrumentation.current()
+            if metrics is not None:
+                metrics.spec = self._spec._asdict()
+        return self._spec
+
+    def get_version(self) -> typ.Tuple[int, float]:
+        """Get the data version (once per request)"""
+        if not hasattr(self, '_version'):
+            self._version = cache.current_version()
+        return self._version
+
+    def get_plan(self) -> QueryPlan:
+        # channel, country and os are stored as ids of the dimension tables
+        dimension_cache.refresh(self.get_version())
+        return get_plan(self.get_spec())
+
+    def get_rows(self, plan: QueryPlan) -> typ.Union[query.QuerySet, columnar.Result, typ.List[tuple]]:
+        """
+        Get the values_list() rows of the query plan: from the database or,
+        if USAGE_INFO_ENGINE is 'columnar', from the in-memory columnar snapshot
+        (except the keyset pagination which filters the queryset).
+        The rows with totals or subtotals come from one GROUPING SETS query (see grouping.execute_levels),
+        the top rows from a window function query (see top.py).
+        """
+        if plan.spec.has_totals:
+            return grouping.execute_levels(plan.spec, plan.dimension_ids, plan.fields)
+        keyset = self.paginator is not None and \
+            self.request.query_params.get(self.paginator.mode_query_param) == 'cursor'
+        if columnar.is_enabled() and not keyset:
+            rows = columnar.execute(plan.spec, plan.dimension_ids, plan.fields, self.get_version())
+            return top.select(rows, plan.fields, plan.spec) if plan.spec.top else rows
+        if plan.spec.top:
+            return top.execute(plan)
+        return plan.values_list.all()
+
+    @staticmethod
+    def get_representation(plan: QueryPlan) -> typ.Callable[[tuple], dict]:
+        """Get the function serializing a row of the query plan, the rows with totals get the grouping level"""
+        to_representation = plan.serializer.to_representation
+        if not plan.spec.has_totals:
+            return to_representation
+
+        def with_grouping(row: tuple) -> dict:
+            data = to_representation(row)
+            data['grouping'] = ','.join(map(param_field, row[-1]))
+            return data
+        return with_grouping
+
+    def is_columnar(self) -> bool:
+        """Check if the response is rendered column-wise (Arrow, Parquet)"""
+        return getattr(self.request.accepted_renderer, 'columnar', False)
+
+    def serialize(self, plan: QueryPlan, rows: typ.Iterable[tuple]) -> typ.Union[typ.List[dict], typ.Dict[str, list]]:
+        """Serialize the rows to dicts or, for the column oriented formats, to field -> values"""
+        if not self.is_columnar():
+            return list(map(self.get_representation(plan), rows))
+        rows = list(rows)
+        data = plan.serializer.serialize_columns(rows)
+        if plan.spec.has_totals:
+            data['grouping'] = [','.join(map(param_field, row[-1])) for row in rows]
+        return data
+
+    def get_queryset(self) -> query.QuerySet:
+        return self.get_plan().queryset.all()
+
+
+class UsageInfoExportView(UsageInfoView):
+    """
+    Export all the usage info rows at once, streamed while they are read from the database.
+    Accepts the same url parameters as UsageInfoView (except the pagination ones).
+    Format: NDJSON (default, 'format=ndjson') or CSV ('format=csv'); 'Accept' header is respected as well.
+    """
+    renderer_classes = (NDJSONRenderer, CSVRenderer)
+    pagination_class = None
+    chunk_size = 2000  # rows fetched from the (server side on PostgreSQL) cursor at once
+
+    def list(self, request: Request, *args, **kwargs) -> HttpResponse:
+        with instrumentation.phase('validate'):
+            spec = self.get_spec()
+        # the exported rows aren't stored in the response cache (they can be all the table), only validated
+        renderer = request.accepted_renderer
+        with instrumentation.phase('cache'):
+            key = cache.response_key(request, spec, self.get_version())
+            headers = cache.validator_headers(key, self.get_version(), renderer.format)
+            not_modified = cache.conditional_response(request, headers)
+            if not_modified is not None:
+                return not_modified
+
+        with instrumentation.phase('plan'):
+            plan = self.get_plan()
+        rows = self.get_rows(plan)
+        if isinstance(rows, query.QuerySet):
+            # streamed after the replicas.reads() block of the request
+            rows = rows.using(rows.db).iterator(chunk_size=self.chunk_size)
+        fields = (*plan.serializer.fields, 'grouping') if spec.has_totals else plan.serializer.fields
 
+        response = StreamingHttpResponse(
+            instrumentation.timed('render', renderer.stream(self.stream_rows(plan, rows), fields)),
+            content_type=f'{renderer.media_type}; charset={renderer.charset}')
+        response['Content-Disposition'] = f'attachment; filename="usage_info.{renderer.format}"'
+        for header, value in headers.items():
+            response[header] = value
+        return response
+
+    def stream_rows(self, plan: QueryPlan, rows: typ.Iterable[tuple]) -> typ.Iterator[dict]:
+        """
+        Serialize the rows while the response is sent, a chunk at a time: the fetch of a chunk is timed
+        as the SQL phase of the request, its serialization as the serialize phase (see InstrumentationMiddleware)
+
+        :param plan: query plan of the request
+        :param rows: values_list() rows
+        :return: representations of the rows
+        """
+        representation = self.get_representation(plan)
+        rows, count = iter(rows), 0
+        while True:
+            with instrumentation.phase('sql'):
+                chunk = list(itertools.islice(rows, self.chunk_size))
+            if not chunk:
+                break
+            with instrumentation.phase('serialize'):
+                data = list(map(representation, chunk))
+            count += len(chunk)
+            yield from data
+        metrics = instrumentation.current()
+        if metrics is not None:
+            metrics.rows = count
+
+
+class BatchItem(typ.NamedTuple):
+    """Query of a batch request"""
+    index: int
+    request: HttpRequest  # GET /usage_info request of the query
+    spec: QuerySpec
+    key: str  # response cache key
+
+
+class UsageInfoBatchView(ReplicaReadsMixin, generics.GenericAPIView):
+    """
+    Run several usage info queries in one request, e.g. the widgets of a dashboard:
+        POST {"queries": ["group_by=channel&sort_by=-clicks", {"group_by": "date", "countries": "US"}, ...]}
+
+    Every query has the url parameters of UsageInfoView, as a query string or an object. The response has
+    the results in the order of the queries: {"results": [{"status": 200, "data": <UsageInfoView response>}, ...]},
+    an invalid query gets {"status": 400, "data": {"detail": ...}}. The results are cached like the UsageInfoView ones.
+
+    The grouped queries with the same filters are answered by one GROUP BY GROUPING SETS query (PostgreSQL),
+    the rest run concurrently (USAGE_INFO_BATCH_WORKERS threads) through UsageInfoView.
+    """
+    pagination_class = UsageInfoPagination
+
+    def post(self, request: Request, *args, **kwargs) -> Response:
         try:
-            schema.check(query_params)
-        except (ValidationError, t.DataError) as err:
+            queries = parse_batch(request.data)
+        except ValidationError as err:
             raise ParseError(err)
 
-    def get_queryset(self) -> query.QuerySet:
-        queryset = UsageInfo.objects.all()
+        version = cache.current_version()
+        dimension_cache.refresh(version)
+        results: typ.List[typ.Optional[dict]] = [None] * len(queries)
+        merged = defaultdict(list)  # filters -> grouped queries
+        tasks = []
+        for index, query_string in enumerate(queries):
+            query_request = self.get_query_request(request, query_string)
+            try:
+                spec = parse_query_params(query_request.GET)
+            except ValidationError as err:
+                results[index] = {'status': status.HTTP_400_BAD_REQUEST, 'data': {'detail': str(err)}}
+                continue
+            if self.can_merge(query_request, spec):
+                item = BatchItem(index, query_request, spec, cache.response_key(query_request, spec, version))
+                data = cache.get_response(item.key)
+                if data is not None:
+                    results[index] = {'status': status.HTTP_200_OK, 'data': data}
+                else:
+                    merged[spec.filters].append(item)
+            else:
+                tasks.append((self.run_query, [BatchItem(index, query_request, spec, '')]))
 
-        self._validate_query_params(self.request.query_params)
+        for items in merged.values():
+            tasks.append((self.run_merged, items) if len(items) > 1 else (self.run_query, items))
+        for index, result in self.run_tasks(tasks):
+            results[index] = result
+        return Response({'results': results})
 
-        filter_params = {
-            'date_from': lambda date: ('date__gte', date),
-            'date_to': lambda date: ('date__lte', date),
-            'channels': lambda chs: ('channel__in', map(str.strip, chs.split(','))),
-            'countries': lambda ctr: ('country__in', map(str.strip, ctr.split(','))),
-            'os': lambda os: ('os__in', map(str.strip, os.split(','))),
-        }
+    @staticmethod
+    def get_query_request(request: Request, query_string: str) -> HttpRequest:
+        """Build the GET /usage_info request of a batch query"""
+        query_request = HttpRequest()
+        query_request.method = 'GET'
+        query_request.path = query_request.path_info = reverse('usage-info')
+        query_request.META = {**request.META, 'REQUEST_METHOD': 'GET', 'QUERY_STRING': query_string}
+        query_request.GET = QueryDict(query_string)
+        return query_request
+
+    @staticmethod
+    def can_merge(query_request: HttpRequest, spec: QuerySpec) -> bool:
+        return bool(spec.group_by) and not spec.has_totals and grouping.supports_grouping_sets() \
+            and not columnar.is_enabled() and query_request.GET.get(UsageInfoPagination.mode_query_param) != 'cursor'
+
+    @staticmethod
+    def run_tasks(tasks: typ.List[typ.Tuple[typ.Callable, typ.List[BatchItem]]]) -> typ.List[typ.Tuple[int, dict]]:
+        workers = min(settings.USAGE_INFO_BATCH_WORKERS, len(tasks))
+        if workers <= 1:
+            return [result for func, items in tasks for result in func(items)]
+
+        # the threads read from the database of the request
+        alias = replicas.current()
+
+        def run(task):
+            func, items = task
+            try:
+                with replicas.using(alias):
+                    return func(items)
+            finally:
+                # the threads are not reused, neither are their connections
+                connections.close_all()
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return [result for results in executor.map(run, tasks) for result in results]
+
+    @staticmethod
+    def run_query(items: typ.List[BatchItem]) -> typ.List[typ.Tuple[int, dict]]:
+        """Answer the query by UsageInfoView"""
+        item, = items
+        response = UsageInfoView.as_view()(item.request)
+        return [(item.index, {'status': response.status_code, 'data': response.data})]
+
+    def run_merged(self, items: typ.List[BatchItem]) -> typ.List[typ.Tuple[int, dict]]:
+        """Answer the grouped queries with the same filters by one GROUPING SETS query"""
+        spec = items[0].spec
+        sets = grouping.aggregate(spec, get_dimension_ids(spec), [grouped_fields(item.spec) for item in items])
+
+        results = []
+        for item in items:
+            plan = get_plan(item.spec)
+            rows = grouping.add_derived(sets[grouped_fields(item.spec)], item.spec.metrics)
+            rows = grouping.as_values_list(grouping.sort_rows(rows, get_ordering(item.spec)), plan.fields)
+            if item.spec.top:
+                rows = top.select(rows, plan.fields, item.spec)
+
+            paginator = self.pagination_class()
+            page = paginator.paginate_queryset(rows, Request(item.request), view=self)
+            if page is not None:
+                data = paginator.get_paginated_response(plan.serializer.serialize(page)).data
+            else:
+                data = plan.serializer.serialize(rows)
+            cache.set_response(item.key, data)
+            results.append((item.index, {'status': status.HTTP_200_OK, 'data': data}))
+        return results
+
+
+class UsageInfoMetricsView(APIView):
+    """
+    Histograms of the phase durations, SQL queries and rows of the usage info requests handled by the process
+    (see instrumentation.py), the response cache and the query coalescing counters, the health of the read replicas.
+    Format: JSON (default) or Prometheus text ('format=prometheus').
+    """
+    renderer_classes = (JSONRenderer, PrometheusRenderer)
 
-        if self.request.query_params:
-            if 'group_by' in self.request.query_params:
-                group_by = map(str.strip, self.request.query_params['group_by'].split(','))
-                queryset = UsageInfo.objects.values(*group_by).annotate(
-                    impressions=Sum('impressions'),
-                    clicks=Sum('clicks'),
-                    installs=Sum('installs', output_field=FloatField()),
-                    spend=Sum('spend', output_field=FloatField()),
-                    revenue=Sum('revenue')
-                )
-
-            cpi = self.request.query_params.get('cpi')
-            if cpi and cpi == '1':
-                queryset = queryset.annotate(
-                    cpi=ExpressionWrapper(
-                        F('spend') / F('installs'),
-                        output_field=FloatField()))
-
-            if 'sort_by' in self.request.query_params:
-                sort_by = list(map(str.strip, self.request.query_params['sort_by'].split(',')))
-                if any(cpi_val in sort_by for cpi_val in ('cpi', '-cpi')) and cpi != '1':
-                    raise ParseError('Can not sort by CPI. Please turn CPI on by adding cpi=1')
-                queryset = queryset.order_by(*sort_by)
-
-            params_to_filter = (
-                filter_params[param](val)
-                for param, val in self.request.query_params.items()
-                if param in filter_params
-            )
-            queryset = queryset.filter(**dict(params_to_filter))
-
-        return queryset
+    def get(self, request: Request, *args, **kwargs) -> Response:
+        return Response({
+            'endpoints': instrumentation.registry.as_dict(),
+            'response_cache': cache.stats.as_dict(),
+            'coalescing': coalescing.stats.as_dict(),
+            'replicas': replicas.monitor.as_dict(),
+        })